@@ -8,6 +8,7 @@ interface Props {
     poster?: string;
     autoPlay?: boolean;
     duration?: number; // Duration in seconds
+    thumbnails?: string; // WebVTT sprite track for seek previews
     onEnded?: () => void;
 }
 
@@ -183,7 +184,7 @@ function updateAudioUI(trackId: number, tracks: any[], contentDiv: HTMLElement,
     if (valueSpan) valueSpan.textContent = trackName;
 }
 
-export const VideoPlayer = ({ src, poster, autoPlay = false, duration, onEnded }: Props) => {
+export const VideoPlayer = ({ src, poster, autoPlay = false, duration, thumbnails, onEnded }: Props) => {
     const ref = useRef<APITypes>(null);
     const hlsRef = useRef<Hls | null>(null);
 
@@ -227,7 +228,11 @@ export const VideoPlayer = ({ src, poster, autoPlay = false, duration, onEnded }
             const video = document.querySelector('.plyr video') as HTMLVideoElement;
             if (!video) return;
 
-            if (Hls.isSupported()) {
+            if (/\.mp4(\?|$)/.test(src)) {
+                // Direct play: the proxy relays the source file itself
+                video.src = src;
+                if (autoPlay) video.play().catch(() => { });
+            } else if (Hls.isSupported()) {
                 hls = new Hls({
                     // Add some robust error handling configs if needed
                     enableWorker: true,
@@ -314,6 +319,7 @@ export const VideoPlayer = ({ src, poster, autoPlay = false, duration, onEnded }
                     invertTime: false,
                     displayDuration: true,
                     duration: duration,
+                    previewThumbnails: { enabled: Boolean(thumbnails), src: thumbnails || '' },
                 }}
                 onEnded={onEnded}
             />
@@ -10,6 +10,10 @@ import axios from 'axios';
  * Usage:
  * - Master playlist: /api/hls/stream.m3u8?port=8000
  * - Segments: /api/hls/segment_0_00001.ts?port=8000
+ * - fMP4 renditions: /api/hls/stream.mp4?port=8000 (byte ranges via the Range header)
+ * - Direct play: /api/hls/source.mp4?port=8000 (the source file itself, relayed by Range)
+ * - Seek previews: /api/hls/thumbnails.vtt?port=8000 (sprite sheets are rewritten like segments)
+ * - Subtitles: /api/hls/subtitles_0.m3u8?port=8000 (WebVTT chunks, each held open until extracted)
  */
 export default async function handler(req: NextApiRequest, res: NextApiResponse) {
     try {
@@ -39,8 +43,29 @@ export default async function handler(req: NextApiRequest, res: NextApiResponse)
 
         // Check if it's a playlist or a segment based on file extension
         const isPlaylist = filePath.endsWith('.m3u8');
+        const isThumbnailTrack = filePath.endsWith('.vtt');
+        // Subtitle cues are dialogue, not references: passed through untouched
+        const isSubtitleTrack = /^subtitles_\d+_\d+\.vtt$/.test(filePath);
 
-        if (isPlaylist) {
+        if (isSubtitleTrack) {
+            // The proxy answers with headers at once and holds the body until extraction reaches
+            // the chunk (up to 110 s): stream it through instead of buffering behind a short timeout
+            const response = await axios.get(upstreamUrl, {
+                responseType: 'stream',
+                timeout: 130000,
+                validateStatus: () => true,
+            });
+            res.status(response.status);
+            res.setHeader('Content-Type', 'text/vtt');
+            res.setHeader('Access-Control-Allow-Origin', '*');
+            res.flushHeaders();
+            // A dropped upstream connection must reach the player too, so it retries
+            response.data.on('error', () => res.destroy());
+            response.data.pipe(res);
+            return;
+        }
+
+        if (isPlaylist || isThumbnailTrack) {
             // For playlists, we need to rewrite URLs to include the port parameter
             const response = await axios.get(upstreamUrl, {
                 responseType: 'text',
@@ -61,10 +86,12 @@ export default async function handler(req: NextApiRequest, res: NextApiResponse)
             let playlistContent = response.data;
 
             // Rewrite relative URLs in the playlist to include port parameter
-            // Match ANY .m3u8 file (variant playlists) and ANY .ts file (segments)
-            // This handles files like: stream_0.m3u8, stream_HDHub4u_Ms_-_hin.m3u8, segment_0_00001.ts
+            // Match ANY .m3u8 file (variant playlists), .ts file (segments) and .mp4/.m4s file (fMP4)
+            // This handles files like: stream_0.m3u8, stream_HDHub4u_Ms_-_hin.m3u8, segment_0_00001.ts, stream.mp4
+            // and the sprite sheets in the thumbnail track (thumbs_00000.jpg#xywh=... keeps its fragment)
+            // and the WebVTT chunks a subtitle playlist points at (subtitles_0_00000.vtt)
             playlistContent = playlistContent.replace(
-                /([a-zA-Z0-9_\-\.]+\.(m3u8|ts))/g,
+                /([a-zA-Z0-9_\-\.]+\.(m3u8|ts|mp4|m4s|jpg|vtt))/g,
                 (match: string) => {
                     // Don't add port if it already has query params
                     if (match.includes('?')) return match;
@@ -73,14 +100,23 @@ export default async function handler(req: NextApiRequest, res: NextApiResponse)
             );
 
             // Set proper MIME type for HLS playlists (critical for mobile)
-            res.setHeader('Content-Type', 'application/vnd.apple.mpegurl');
+            res.setHeader('Content-Type', isThumbnailTrack ? 'text/vtt' : 'application/vnd.apple.mpegurl');
             res.setHeader('Access-Control-Allow-Origin', '*');
             res.setHeader('Cache-Control', 'no-cache, no-store, must-revalidate');
 
             return res.status(200).send(playlistContent);
 
         } else {
-            // For segments (.ts files), stream the binary data
+            // For segments (.ts files and fMP4 byte ranges), stream the binary data
+            // Forward Range so single-file fMP4 renditions can be addressed by EXT-X-BYTERANGE
+            const rangeHeader = req.headers.range;
+            const isFmp4 = /\.(mp4|m4s)$/.test(filePath);
+            const isSprite = filePath.endsWith('.jpg');
+            // Every viewer reaches the proxy from this server; name the real client for its egress scheduler
+            const forwardedFor = [req.headers['x-forwarded-for'], req.socket.remoteAddress].filter(Boolean).join(', ');
+            const upstreamHeaders: Record<string, string> = forwardedFor ? { 'X-Forwarded-For': forwardedFor } : {};
+            if (rangeHeader) upstreamHeaders.Range = rangeHeader;
+
             // Retry logic for segments
             let response;
             let retries = 3;
@@ -89,6 +125,7 @@ export default async function handler(req: NextApiRequest, res: NextApiResponse)
                     response = await axios.get(upstreamUrl, {
                         responseType: 'stream',
                         timeout: 60000, // Increased to 60s for slow tunnels/encoding
+                        headers: upstreamHeaders,
                     });
                     break;
                 } catch (e: any) {
@@ -102,16 +139,25 @@ export default async function handler(req: NextApiRequest, res: NextApiResponse)
             if (!response) throw new Error("Failed to fetch segment after retries");
 
             // Set proper MIME type for MPEG-TS segments (critical for mobile)
-            res.setHeader('Content-Type', 'video/MP2T');
+            res.setHeader('Content-Type', isSprite ? 'image/jpeg' : isFmp4 ? 'video/mp4' : 'video/MP2T');
             res.setHeader('Access-Control-Allow-Origin', '*');
-            res.setHeader('Cache-Control', 'public, max-age=31536000, immutable');
+            res.setHeader('Access-Control-Expose-Headers', 'Content-Length, Content-Range, Accept-Ranges');
+            // A single fMP4 file keeps growing while it is encoded, so only whole .ts segments are immutable
+            res.setHeader('Cache-Control', isFmp4 ? 'no-cache' : 'public, max-age=31536000, immutable');
 
             // Copy content length if available
             if (response.headers['content-length']) {
                 res.setHeader('Content-Length', response.headers['content-length']);
             }
+            if (response.headers['content-range']) {
+                res.setHeader('Content-Range', response.headers['content-range']);
+            }
+            if (response.headers['accept-ranges']) {
+                res.setHeader('Accept-Ranges', response.headers['accept-ranges']);
+            }
 
-            // Stream the response
+            // Stream the response (206 for byte-range requests)
+            res.status(response.status);
             response.data.pipe(res);
         }
 
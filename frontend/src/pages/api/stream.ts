@@ -1,6 +1,7 @@
 import type { NextApiRequest, NextApiResponse } from 'next';
 import { spawn, spawnSync } from 'child_process';
 import path from 'path';
+import axios from 'axios';
 import { getStream } from '@backend/stream';
 import { createProviderContext } from '@backend/provider-context';
 
@@ -31,10 +32,26 @@ if (!(global as any).hasRegisteredCleanup) {
     });
 }
 
+// Warm-up proxies starting or waiting for a viewer; hovering down a list must not spawn one per item
+const MAX_OUTSTANDING_PREPARES = 2;
+function outstandingPrepares(): number {
+    const starting = Object.values(initRegistry).filter((promise: any) => promise?.prepare).length;
+    const waiting = Object.values(proxyRegistry).filter((proxy: any) => proxy.prepared).length;
+    return starting + waiting;
+}
+
+// Prepared proxies only encode their first segments at low priority; tell them a viewer arrived
+async function promotePrepared(entry: any) {
+    if (!entry.prepared) return;
+    entry.prepared = false;
+    console.log(`▶️ PROMOTE: Prepared proxy on port ${entry.port} is now playing`);
+    await axios.post(`http://127.0.0.1:${entry.port}/play`, {}, { timeout: 2000 }).catch(() => { });
+}
+
 export default async function handler(req: NextApiRequest, res: NextApiResponse) {
     if (req.method !== 'POST') return res.status(405).end();
 
-    const { link, type = 'movie' } = req.body;
+    const { link, type = 'movie', hevc = false, prepare = false } = req.body;
 
     if (!link) {
         return res.status(400).json({ error: 'Link is required' });
@@ -56,17 +73,28 @@ export default async function handler(req: NextApiRequest, res: NextApiResponse)
         }
 
         const streamUrl = streams[0].url;
-        const cleanUrl = streamUrl;
+        // HEVC-capable clients get a passthrough session, which other clients can't join
+        const cleanUrl = hevc ? `${streamUrl}#hevc` : streamUrl;
+
+        // 0. Prepare requests only warm a session; they never count as a viewer
+        if (prepare && (proxyRegistry[cleanUrl] || initRegistry[cleanUrl])) {
+            return res.status(200).json({ prepared: true });
+        }
+        if (prepare && outstandingPrepares() >= MAX_OUTSTANDING_PREPARES) {
+            return res.status(200).json({ prepared: false });
+        }
 
         // 1. Check if already bound (Active Re-use)
         if (proxyRegistry[cleanUrl]) {
+            await promotePrepared(proxyRegistry[cleanUrl]);
             console.log(`♻️ RE-USE: Using existing proxy for ${cleanUrl.substring(0, 50)}... on port ${proxyRegistry[cleanUrl].port}`);
             proxyRegistry[cleanUrl].users += 1;
 
             return res.status(200).json({
                 streamUrl,
-                proxyUrl: `/api/hls/stream.m3u8?port=${proxyRegistry[cleanUrl].port}`,
+                proxyUrl: `/api/hls/${proxyRegistry[cleanUrl].playlist}?port=${proxyRegistry[cleanUrl].port}`,
                 duration: proxyRegistry[cleanUrl].duration,
+                thumbnails: proxyRegistry[cleanUrl].thumbnails,
                 headers: {}
             });
         }
@@ -78,6 +106,7 @@ export default async function handler(req: NextApiRequest, res: NextApiResponse)
                 const data = await initRegistry[cleanUrl];
                 // After waiting, if successful, the registry will have been updated by the initiator
                 if (proxyRegistry[cleanUrl]) {
+                    await promotePrepared(proxyRegistry[cleanUrl]);
                     proxyRegistry[cleanUrl].users += 1;
                     console.log(`✅ WAIT DONE: Joined existing proxy on port ${proxyRegistry[cleanUrl].port}`);
                     return res.status(200).json(data);
@@ -90,12 +119,12 @@ export default async function handler(req: NextApiRequest, res: NextApiResponse)
         // 3. Initiate Startup (Winner of the race)
         const startupPromise = (async () => {
             // Check it's a ZIP file
-            const isZip = cleanUrl.toLowerCase().includes('.zip');
+            const isZip = streamUrl.toLowerCase().includes('.zip');
             let zipFile = '';
 
             if (isZip) {
                 const zipHelperScript = path.resolve(process.cwd(), '../src/python/zip_helper.py');
-                const listProcess = spawnSync('python', [zipHelperScript, 'list', '--url', cleanUrl], { encoding: 'utf-8' });
+                const listProcess = spawnSync('python', [zipHelperScript, 'list', '--url', streamUrl], { encoding: 'utf-8' });
                 if (!listProcess.error) {
                     try {
                         const videoFiles = JSON.parse(listProcess.stdout);
@@ -106,8 +135,15 @@ export default async function handler(req: NextApiRequest, res: NextApiResponse)
 
             const proxyScript = path.resolve(process.cwd(), '../src/python/stream_proxy.py');
             const basePort = 8000;
-            const spawnArgs: string[] = [proxyScript, '--url', cleanUrl, '--port', basePort.toString(), '--host', '0.0.0.0'];
+            const spawnArgs: string[] = [proxyScript, '--url', streamUrl, '--port', basePort.toString(), '--host', '0.0.0.0'];
             if (isZip && zipFile) spawnArgs.push('--zip-file', zipFile);
+            else spawnArgs.push('--fast-start', '6');
+            // Opt-in: the sprite job reads the whole source a second time, straight from the upstream
+            const thumbnails = Boolean(process.env.PROXY_THUMBNAILS) && !(isZip && zipFile);
+            if (thumbnails) spawnArgs.push('--thumbnails');
+            if (hevc) spawnArgs.push('--hevc-passthrough');
+            if (prepare) spawnArgs.push('--prepare', '3', '--prepare-ttl', '120');
+            if (process.env.PROXY_SERVE_WORKERS) spawnArgs.push('--serve-workers', process.env.PROXY_SERVE_WORKERS, '--uvloop');
 
             console.log('🚀 SPAWNING Proxy:', spawnArgs);
             const pythonProcess = spawn('python', spawnArgs);
@@ -119,6 +155,10 @@ export default async function handler(req: NextApiRequest, res: NextApiResponse)
 
                 const timeout = setTimeout(() => {
                     delete initRegistry[cleanUrl];
+                    // Nobody will ever learn its port: don't leave it running
+                    try {
+                        pythonProcess.kill('SIGKILL');
+                    } catch (e) { }
                     reject(new Error('Proxy startup timed out (120s)'));
                 }, 120000);
 
@@ -132,12 +172,17 @@ export default async function handler(req: NextApiRequest, res: NextApiResponse)
                                     if (event.event === 'bound') {
                                         proxyPort = event.port;
                                         detectedDuration = event.duration;
+                                        // stream.m3u8, or source.mp4 when the proxy direct-plays the file
+                                        const playlist = String(event.hls || '').split('/').pop() || 'stream.m3u8';
                                         console.log(`✅ BOUND: Port ${proxyPort}`);
 
                                         proxyRegistry[cleanUrl] = {
                                             port: proxyPort,
+                                            playlist,
                                             duration: detectedDuration,
-                                            users: 1,
+                                            users: prepare ? 0 : 1,
+                                            prepared: Boolean(event.prepared),
+                                            thumbnails: thumbnails && playlist === 'stream.m3u8',
                                             process: pythonProcess, // Store process ref for cleanup
                                             lastAccessed: Date.now()
                                         };
@@ -148,8 +193,9 @@ export default async function handler(req: NextApiRequest, res: NextApiResponse)
 
                                         resolve({
                                             streamUrl,
-                                            proxyUrl: `/api/hls/stream.m3u8?port=${proxyPort}`,
+                                            proxyUrl: `/api/hls/${playlist}?port=${proxyPort}`,
                                             duration: detectedDuration,
+                                            thumbnails: proxyRegistry[cleanUrl].thumbnails,
                                             headers: {}
                                         });
                                     }
@@ -170,6 +216,9 @@ export default async function handler(req: NextApiRequest, res: NextApiResponse)
                         clearTimeout(timeout);
                         delete initRegistry[cleanUrl];
                         reject(new Error(`Proxy exited early with code ${code}`));
+                    } else if (proxyRegistry[cleanUrl]?.process === pythonProcess) {
+                        // Expired prepared sessions (and idle proxies) must not be re-used
+                        delete proxyRegistry[cleanUrl];
                     }
                 });
 
@@ -177,8 +226,13 @@ export default async function handler(req: NextApiRequest, res: NextApiResponse)
             });
         })();
 
+        // Tagged so outstandingPrepares() can count warm-ups still starting
+        (startupPromise as any).prepare = Boolean(prepare);
         initRegistry[cleanUrl] = startupPromise;
         const resultData = await startupPromise;
+        if (prepare) {
+            return res.status(200).json({ prepared: true });
+        }
         return res.status(200).json(resultData);
 
     } catch (error: any) {
@@ -1,7 +1,7 @@
 import { useRouter } from 'next/router';
 import { useEffect, useState } from 'react';
 import Head from 'next/head';
-import { getMeta, startStream, stopStream } from '@/services/apiClient';
+import { getMeta, startStream, stopStream, supportsHevc } from '@/services/apiClient';
 import { ArrowLeft, Loader2 } from 'lucide-react';
 import dynamic from 'next/dynamic';
 import { motion, AnimatePresence } from 'framer-motion';
@@ -45,6 +45,7 @@ export default function WatchPage() {
     const [streamUrl, setStreamUrl] = useState('');
     const [currentPort, setCurrentPort] = useState<number | null>(null);
     const [exactDuration, setExactDuration] = useState<number | undefined>(undefined);
+    const [hasThumbnails, setHasThumbnails] = useState(false);
     const [loading, setLoading] = useState(true);
     const [error, setError] = useState('');
     const [status, setStatus] = useState('Initializing stream...');
@@ -158,6 +159,7 @@ export default function WatchPage() {
             setStreamUrl('');
             setCurrentPort(null); // Force cleanup of previous proxy
             setExactDuration(undefined);
+            setHasThumbnails(false);
             setShowNextOverlay(false);
             // Don't reset dynamic next info here, let its own useEffect handle it
 
@@ -166,7 +168,7 @@ export default function WatchPage() {
                 const decodedLink = decodeURIComponent(link as string);
 
                 setStatus('Starting proxy server...');
-                const data = await startStream(decodedLink, type as string);
+                const data = await startStream(decodedLink, type as string, supportsHevc());
 
                 if (data.proxyUrl) {
                     setStreamUrl(data.proxyUrl);
@@ -180,6 +182,7 @@ export default function WatchPage() {
                     if (data.duration) {
                         setExactDuration(data.duration);
                     }
+                    setHasThumbnails(Boolean(data.thumbnails));
                 } else {
                     throw new Error('No stream URL returned');
                 }
@@ -233,6 +236,8 @@ export default function WatchPage() {
                         <div className="w-full max-w-6xl relative group">
                             <VideoPlayer
                                 src={streamUrl}
+                                // Served next to the playlist by the stream proxy, when it builds them
+                                thumbnails={hasThumbnails && streamUrl.includes('stream.m3u8') ? streamUrl.replace('stream.m3u8', 'thumbnails.vtt') : undefined}
                                 autoPlay
                                 duration={exactDuration || durationSec}
                                 onEnded={() => {
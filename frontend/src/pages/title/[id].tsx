@@ -1,13 +1,17 @@
 import { useRouter } from 'next/router';
 import { useEffect, useState } from 'react';
 import Head from 'next/head';
-import { getMeta } from '@/services/apiClient';
+import { getMeta, prepareStream, supportsHevc } from '@/services/apiClient';
 import type { Info } from '@/types/api';
 import { Play, Star, Calendar, Clock, Film, ChevronLeft, Copy, Check } from 'lucide-react';
 import Link from 'next/link';
 import { motion, useMotionValue, useTransform, useSpring, AnimatePresence } from 'framer-motion';
 import { useRef } from 'react';
 
+// How long the pointer or focus has to rest on a link before its stream is warmed
+const PREPARE_DWELL_MS = 400;
+const MAX_PAGE_PREPARES = 2;
+
 export default function TitleDetails() {
     const router = useRouter();
     const { id } = router.query;
@@ -34,6 +38,32 @@ export default function TitleDetails() {
         fetchMeta();
     }, [id]);
 
+    // Warm the proxy once the user shows intent to play (resting on a link, not passing over it),
+    // at most once per link and with only a couple of warm-ups in flight
+    const preparedLinks = useRef(new Set<string>());
+    const preparesInFlight = useRef(0);
+    const prepareTimer = useRef<ReturnType<typeof setTimeout> | null>(null);
+    const cancelPrepare = () => {
+        if (prepareTimer.current) clearTimeout(prepareTimer.current);
+        prepareTimer.current = null;
+    };
+    const handlePrepare = (link: string, type: string) => {
+        cancelPrepare();
+        if (preparedLinks.current.has(link)) return;
+        prepareTimer.current = setTimeout(async () => {
+            prepareTimer.current = null;
+            if (preparesInFlight.current >= MAX_PAGE_PREPARES) return;
+            preparedLinks.current.add(link);
+            preparesInFlight.current += 1;
+            try {
+                await prepareStream(link, type, supportsHevc());
+            } finally {
+                preparesInFlight.current -= 1;
+            }
+        }, PREPARE_DWELL_MS);
+    };
+    useEffect(() => cancelPrepare, []);
+
     const handlePlay = async (link: string, type: string, nextEpisode?: { link: string; title: string }) => {
         const query: any = {
             link: encodeURIComponent(link),
@@ -150,7 +180,7 @@ export default function TitleDetails() {
 
                             <div className="space-y-8 pt-6 border-t border-zinc-800/50">
                                 {meta.type === 'series' && meta.seasons && meta.seasons.length > 0 ? (
-                                    <SeriesView seasons={meta.seasons} onPlay={(link, nextEp) => handlePlay(link, 'series', nextEp)} />
+                                    <SeriesView seasons={meta.seasons} onPlay={(link, nextEp) => handlePlay(link, 'series', nextEp)} onPrepare={(link) => handlePrepare(link, 'series')} onCancelPrepare={cancelPrepare} />
                                 ) : (
                                     <div className="space-y-6">
                                         <h3 className="text-2xl font-black text-white flex items-center gap-3">
@@ -177,6 +207,10 @@ export default function TitleDetails() {
                                                             <button
                                                                 key={lIdx}
                                                                 onClick={() => handlePlay(link.link, meta.type)}
+                                                                onMouseEnter={() => handlePrepare(link.link, meta.type)}
+                                                                onFocus={() => handlePrepare(link.link, meta.type)}
+                                                                onMouseLeave={cancelPrepare}
+                                                                onBlur={cancelPrepare}
                                                                 className="flex grow items-center justify-center gap-2 rounded-xl bg-white px-6 py-3 text-sm font-black text-black hover:bg-zinc-200 hover:scale-[1.03] active:scale-95 transition-all shadow-xl"
                                                             >
                                                                 <Play className="h-4 w-4 fill-current" />
@@ -259,7 +293,7 @@ function TiltCard({ image, title }: { image: string, title: string }) {
     );
 }
 
-function SeriesView({ seasons, onPlay }: { seasons: NonNullable<Info['seasons']>; onPlay: (link: string, nextEp?: { link: string; title: string }) => void }) {
+function SeriesView({ seasons, onPlay, onPrepare, onCancelPrepare }: { seasons: NonNullable<Info['seasons']>; onPlay: (link: string, nextEp?: { link: string; title: string }) => void; onPrepare: (link: string) => void; onCancelPrepare: () => void }) {
     const [selectedSeason, setSelectedSeason] = useState(seasons[0]);
 
     return (
@@ -343,6 +377,10 @@ function SeriesView({ seasons, onPlay }: { seasons: NonNullable<Info['seasons']>
                                 <button
                                     key={idx}
                                     onClick={() => onPlay(episode.link, finalNextEp)}
+                                    onMouseEnter={() => onPrepare(episode.link)}
+                                    onFocus={() => onPrepare(episode.link)}
+                                    onMouseLeave={onCancelPrepare}
+                                    onBlur={onCancelPrepare}
                                     className="group flex items-center gap-5 rounded-2xl border border-zinc-800/40 bg-zinc-900/40 p-4 text-left hover:border-red-600/50 hover:bg-zinc-900 transition-all duration-300 shadow-md hover:shadow-red-600/10"
                                 >
                                     <div className="flex h-12 w-12 shrink-0 items-center justify-center rounded-2xl bg-zinc-800 text-zinc-400 group-hover:bg-red-600 group-hover:text-white transition-all duration-300 shadow-inner group-hover:rotate-6">
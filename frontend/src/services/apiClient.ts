@@ -18,11 +18,26 @@ export const getMeta = async (link: string): Promise<Info> => {
     return data;
 };
 
-export const startStream = async (link: string, type: string = 'movie') => {
-    const { data } = await apiClient.post('/stream', { link, type });
+export const startStream = async (link: string, type: string = 'movie', hevc: boolean = false) => {
+    const { data } = await apiClient.post('/stream', { link, type, hevc });
     return data;
 };
 
+// Warms a proxy for a title the user is likely to play; a later startStream attaches instantly
+export const prepareStream = async (link: string, type: string = 'movie', hevc: boolean = false) => {
+    try {
+        await apiClient.post('/stream', { link, type, hevc, prepare: true });
+    } catch (err) {
+        console.warn('Failed to prepare stream', err);
+    }
+};
+
+// True when the browser can decode HEVC in fMP4, so the proxy can copy HEVC sources instead of re-encoding
+export const supportsHevc = (): boolean => {
+    if (typeof window === 'undefined' || typeof MediaSource === 'undefined') return false;
+    return MediaSource.isTypeSupported('video/mp4; codecs="hvc1.1.6.L120.90"');
+};
+
 export const stopStream = async (port: number) => {
     try {
         console.log(`[apiClient] Signaling shutdown for port ${port}...`);
@@ -0,0 +1,386 @@
+import asyncio
+import heapq
+import ipaddress
+import itertools
+import mimetypes
+import re
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from aiohttp import web
+
+from relay import parse_range
+
+EGRESS_CHUNK = 64 * 1024
+READ_BLOCK = 1024 * 1024
+
+# A segment starting within this many seconds of the client's playhead is
+# needed to keep playing; anything further out is read-ahead
+URGENT_WINDOW = 12.0
+# A request this far outside the client's known timeline is a seek
+SEEK_SLACK = 2.0
+# Smoothing for the per-client rate that orders same-priority clients
+RATE_HALF_LIFE = 2.0
+CLIENT_IDLE = 120
+# Playlists are re-read for segment times at most this often
+TIMELINE_REFRESH = 1.0
+
+BYTERANGE = re.compile(r"#EXT-X-BYTERANGE:(\d+)(?:@(\d+))?")
+MEDIA_URI = re.compile(r'URI="([^"]+)"')
+
+
+def is_loopback(address: str | None) -> bool:
+    try:
+        ip = ipaddress.ip_address(address or "")
+    except ValueError:
+        return False
+    # Dual-stack sockets report IPv4 peers as ::ffff:a.b.c.d
+    return (getattr(ip, "ipv4_mapped", None) or ip).is_loopback
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def reserve(self, size: int) -> float:
+        """Takes size tokens, going into debt if needed; returns how long to wait before sending."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= size
+        return max(0.0, -self.tokens / self.rate)
+
+
+@dataclass
+class ClientState:
+    bytes_sent: int = 0
+    requests: int = 0
+    urgent_requests: int = 0
+    # Segments asked for at or behind the estimated playhead: the player was (about to be) stalled
+    late_requests: int = 0
+    seeks: int = 0
+    waited: float = 0.0
+    rate: float = 0.0
+    rate_updated: float = field(default_factory=time.monotonic)
+    last_seen: float = field(default_factory=time.monotonic)
+    # Playhead model: playback advances in real time from the anchor, up to what was delivered
+    anchor_pos: float | None = None
+    anchor_wall: float = 0.0
+    furthest_end: float = 0.0
+    bucket: TokenBucket | None = None
+
+    def playhead(self, now: float) -> float | None:
+        if self.anchor_pos is None:
+            return None
+        position = self.anchor_pos + (now - self.anchor_wall)
+        if position >= self.furthest_end:
+            # Played everything it has: it is waiting at the edge
+            self.anchor_pos, self.anchor_wall = self.furthest_end, now
+            return self.furthest_end
+        return position
+
+    def add_bytes(self, size: int, now: float) -> None:
+        self.bytes_sent += size
+        elapsed = now - self.rate_updated
+        decay = 0.5 ** (elapsed / RATE_HALF_LIFE)
+        self.rate = self.rate * decay + size * (1 - decay) / max(elapsed, 1e-3)
+        self.rate_updated = now
+
+
+class EgressScheduler:
+    """
+    Shares the serving uplink between the viewers of a session.
+
+    Media segments are streamed in small chunks instead of sendfile, so every
+    chunk can be accounted to its client and paced. With an uplink budget,
+    chunks of segments close to a client's playhead are sent before
+    speculative read-ahead, and among equals the client that got the least
+    recently goes first. An optional per-client cap keeps one fast link from
+    pulling far ahead in the first place.
+
+    Playheads are estimated from the segment timeline of the playlists
+    clients actually play, found from the entry playlist: a client plays in real time from the segment it started or
+    seeked to, and can't be past the end of what it has been sent.
+    """
+
+    def __init__(
+        self,
+        hls_dir: Path,
+        uplink_rate: float = 0,
+        client_rate: float = 0,
+        urgent_window: float = URGENT_WINDOW,
+        entry: str = "stream.m3u8",
+    ):
+        """Rates are in bytes/s; 0 leaves that limit off. entry is the playlist players load."""
+        self.hls_dir = hls_dir
+        self.entry = entry
+        self.uplink_rate = uplink_rate
+        self.client_rate = client_rate
+        self.urgent_window = urgent_window
+        self.clients: dict[str, ClientState] = {}
+        self._uplink = TokenBucket(uplink_rate, 4 * EGRESS_CHUNK) if uplink_rate else None
+        self._waiting: list = []
+        self._sequence = itertools.count()
+        self._wake = asyncio.Event()
+        self._dispatcher: asyncio.Task | None = None
+        # uri -> [(byte offset or None, start, duration)]
+        self._timeline: dict[str, list[tuple[int | None, float, float]]] = {}
+        self._timeline_stamp: tuple = ()
+        self._timeline_checked = 0.0
+
+    @staticmethod
+    def client_id(request: web.Request) -> str:
+        remote = request.remote or "unknown"
+        if not is_loopback(remote):
+            # Straight from the viewer: its X-Forwarded-For is whatever it chose to send
+            return remote
+        # Behind the Node route every viewer arrives from loopback. Node appends the
+        # address it saw; anything before that came from the client.
+        forwarded = request.headers.get("X-Forwarded-For", "").split(",")[-1].strip()
+        return forwarded or remote
+
+    def _client(self, client_id: str) -> ClientState:
+        now = time.monotonic()
+        for stale in [key for key, state in self.clients.items() if now - state.last_seen > CLIENT_IDLE]:
+            del self.clients[stale]
+        state = self.clients.get(client_id)
+        if state is None:
+            state = self.clients[client_id] = ClientState()
+            if self.client_rate:
+                state.bucket = TokenBucket(self.client_rate, 4 * EGRESS_CHUNK)
+        state.last_seen = now
+        return state
+
+    def _refresh_timeline(self) -> None:
+        now = time.monotonic()
+        if now - self._timeline_checked < TIMELINE_REFRESH:
+            return
+        self._timeline_checked = now
+        playlists = self._played_playlists()
+        try:
+            stamp = tuple((p.name, p.stat().st_mtime_ns) for p in playlists)
+        except OSError:
+            return
+        if stamp == self._timeline_stamp:
+            return
+        self._timeline_stamp = stamp
+        timeline: dict[str, list] = {}
+        for playlist in playlists:
+            try:
+                lines = playlist.read_text(errors="ignore").splitlines()
+            except OSError:
+                continue
+            entries: dict[str, list] = {}
+            position = 0.0
+            duration = None
+            offset = None
+            next_offset: dict[str, int] = {}
+            for line in lines:
+                line = line.strip()
+                if line.startswith("#EXTINF:"):
+                    try:
+                        duration = float(line[8:].split(",")[0])
+                    except ValueError:
+                        duration = None
+                elif match := BYTERANGE.match(line):
+                    offset = (int(match.group(2)), int(match.group(1))) if match.group(2) else (None, int(match.group(1)))
+                elif line and not line.startswith("#") and duration is not None:
+                    uri = line.split("?")[0]
+                    start_byte = None
+                    if offset is not None:
+                        start_byte = offset[0] if offset[0] is not None else next_offset.get(uri, 0)
+                        next_offset[uri] = start_byte + offset[1]
+                    entries.setdefault(uri, []).append((start_byte, position, duration))
+                    position += duration
+                    duration = None
+                    offset = None
+            for uri, found in entries.items():
+                # A file listed by two playlists keeps the first one's times
+                timeline.setdefault(uri, found)
+        for entries in timeline.values():
+            entries.sort(key=lambda entry: entry[0] or 0)
+        self._timeline = timeline
+
+    def _played_playlists(self) -> list[Path]:
+        """
+        The media playlists players load: the variants and renditions of the
+        entry playlist when it is a master, else the entry itself. Side
+        playlists (a fast-start session's startup and main encodes, VOD job
+        playlists) count from their own start, not the film's.
+        """
+        entry = self.hls_dir / self.entry
+        try:
+            lines = entry.read_text(errors="ignore").splitlines()
+        except OSError:
+            return []
+        variants, renditions = [], []
+        variant_next = False
+        for line in lines:
+            line = line.strip()
+            if line.startswith("#EXT-X-MEDIA:"):
+                if match := MEDIA_URI.search(line):
+                    renditions.append(match.group(1))
+            elif line.startswith("#EXT-X-STREAM-INF:"):
+                variant_next = True
+            elif line and not line.startswith("#") and variant_next:
+                variants.append(line)
+                variant_next = False
+        if not variants:
+            return [entry]
+        # Variants first, so the video's times win for any file a rendition shares
+        return [self.hls_dir / uri.split("?")[0] for uri in dict.fromkeys(variants + renditions)]
+
+    def segment_time(self, name: str, byte_start: int = 0) -> tuple[float, float] | None:
+        """(start, duration) of the segment a request for name at byte_start falls in."""
+        self._refresh_timeline()
+        entries = self._timeline.get(name)
+        if not entries:
+            return None
+        found = entries[0]
+        for entry in entries:
+            if entry[0] is None or entry[0] > byte_start:
+                break
+            found = entry
+        return found[1], found[2]
+
+    def _note_request(self, state: ClientState, timing: tuple[float, float] | None) -> None:
+        state.requests += 1
+        if timing is None:
+            return
+        start, duration = timing
+        now = time.monotonic()
+        playhead = state.playhead(now)
+        if playhead is None or start < playhead - SEEK_SLACK or start > state.furthest_end + SEEK_SLACK:
+            if playhead is not None:
+                state.seeks += 1
+            state.anchor_pos, state.anchor_wall = start, now
+            state.furthest_end = start + duration
+            return
+        if start <= playhead:
+            state.late_requests += 1
+        state.furthest_end = max(state.furthest_end, start + duration)
+
+    def _urgent(self, state: ClientState, timing: tuple[float, float] | None) -> bool:
+        if timing is None:
+            return True
+        playhead = state.playhead(time.monotonic())
+        return playhead is None or timing[0] - playhead < self.urgent_window
+
+    async def _dispatch(self) -> None:
+        while True:
+            while not self._waiting:
+                self._wake.clear()
+                await self._wake.wait()
+            *_, size, future = heapq.heappop(self._waiting)
+            if future.done():
+                # Its client went away while queued
+                continue
+            delay = self._uplink.reserve(size)
+            if delay:
+                await asyncio.sleep(delay)
+            if not future.done():
+                future.set_result(None)
+
+    async def _acquire(self, state: ClientState, urgent: bool, size: int) -> None:
+        started = time.monotonic()
+        if state.bucket is not None:
+            delay = state.bucket.reserve(size)
+            if delay:
+                await asyncio.sleep(delay)
+        if self._uplink is not None:
+            if self._dispatcher is None:
+                self._dispatcher = asyncio.create_task(self._dispatch())
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._waiting, (0 if urgent else 1, state.rate, next(self._sequence), size, future))
+            self._wake.set()
+            try:
+                await future
+            finally:
+                future.cancel()
+        state.waited += time.monotonic() - started
+
+    async def serve(self, request: web.Request, path: Path, name: str | None = None) -> web.StreamResponse:
+        """
+        Serves a media file (with Range) paced and accounted to the requesting
+        client. name is the URI the playlists use, when the file is named differently.
+        """
+        try:
+            size = path.stat().st_size
+        except OSError:
+            raise web.HTTPNotFound()
+        start, end = 0, size - 1
+        status = 200
+        range_header = request.headers.get("Range")
+        if range_header:
+            parsed = parse_range(range_header, size)
+            if parsed is None:
+                raise web.HTTPRequestRangeNotSatisfiable(headers={"Content-Range": f"bytes */{size}"})
+            start, end = parsed
+            status = 206
+
+        state = self._client(self.client_id(request))
+        timing = self.segment_time(name or path.name, start)
+        self._note_request(state, timing)
+        if self._urgent(state, timing):
+            state.urgent_requests += 1
+
+        content_type, _ = mimetypes.guess_type(path.name)
+        response = web.StreamResponse(status=status, headers={"Accept-Ranges": "bytes"})
+        response.content_type = content_type or "application/octet-stream"
+        response.content_length = end - start + 1
+        if status == 206:
+            response.headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        await response.prepare(request)
+        if request.method == "HEAD":
+            return response
+
+        with path.open("rb") as source:
+            position = start
+            while position <= end:
+                source.seek(position)
+                block = await asyncio.to_thread(source.read, min(READ_BLOCK, end - position + 1))
+                if not block:
+                    break
+                for offset in range(0, len(block), EGRESS_CHUNK):
+                    piece = block[offset:offset + EGRESS_CHUNK]
+                    await self._acquire(state, self._urgent(state, timing), len(piece))
+                    await response.write(piece)
+                    state.add_bytes(len(piece), time.monotonic())
+                position += len(block)
+        await response.write_eof()
+        return response
+
+    @property
+    def stats(self) -> dict:
+        now = time.monotonic()
+        clients = []
+        for client_id, state in self.clients.items():
+            playhead = state.playhead(now)
+            clients.append({
+                "client": client_id,
+                "bytes": state.bytes_sent,
+                "rate_bps": round(state.rate * 8),
+                "requests": state.requests,
+                "urgent_requests": state.urgent_requests,
+                "late_requests": state.late_requests,
+                "seeks": state.seeks,
+                "waited_s": round(state.waited, 3),
+                "playhead": round(playhead, 1) if playhead is not None else None,
+                "buffered_s": round(state.furthest_end - playhead, 1) if playhead is not None else None,
+            })
+        return {
+            "uplink_bps": round(self.uplink_rate * 8),
+            "client_cap_bps": round(self.client_rate * 8),
+            "queued_chunks": len(self._waiting),
+            "clients": clients,
+        }
+
+    async def stop(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+        for *_, future in self._waiting:
+            future.cancel()
@@ -0,0 +1,341 @@
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator, List
+
+import requests
+
+# Survives proxy restarts (unlike the per-session temp dir), so a title that
+# is played again skips the probe and already knows its keyframe layout
+CACHE_DIR = Path(tempfile.gettempdir()) / "hls_proxy_cache"
+
+# Enough for the EBML header, SeekHead, Info and Tracks of any sane Matroska file
+MKV_HEAD_BYTES = 256 * 1024
+MP4_HEAD_BYTES = 64 * 1024
+
+EBML_HEADER = 0x1A45DFA3
+SEGMENT = 0x18538067
+SEEK_HEAD = 0x114D9B74
+SEEK = 0x4DBB
+SEEK_ID = 0x53AB
+SEEK_POSITION = 0x53AC
+INFO = 0x1549A966
+TIMESTAMP_SCALE = 0x2AD7B1
+TRACKS = 0x1654AE6B
+TRACK_ENTRY = 0xAE
+TRACK_NUMBER = 0xD7
+TRACK_TYPE = 0x83
+CLUSTER = 0x1F43B675
+CUES = 0x1C53BB6B
+CUE_POINT = 0xBB
+CUE_TIME = 0xB3
+CUE_TRACK_POSITIONS = 0xB7
+CUE_TRACK = 0xF7
+CUE_CLUSTER_POSITION = 0xF1
+
+
+def cache_key(url: str, size: int | None = None) -> str:
+    """Identifies a source; the size acts as a validator when the relay knows it."""
+    return hashlib.sha1(f"{url}|{size}".encode()).hexdigest()
+
+
+def load_cached(cache_dir: Path, key: str, kind: str) -> dict | None:
+    try:
+        return json.loads((cache_dir / f"{key}.{kind}.json").read_text())
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+def store_cached(cache_dir: Path, key: str, kind: str, data: dict) -> None:
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        path = cache_dir / f"{key}.{kind}.json"
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(data))
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Warning: Could not write {kind} cache ({e})")
+
+
+@dataclass
+class KeyframeIndex:
+    times: List[float]
+    offsets: List[int | None]
+    source: str
+
+    def to_dict(self) -> dict:
+        return {"source": self.source, "times": self.times, "offsets": self.offsets}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "KeyframeIndex | None":
+        if not data or len(data.get("times", [])) < 2:
+            return None
+        return cls(times=data["times"], offsets=data.get("offsets") or [None] * len(data["times"]), source=data.get("source", "cache"))
+
+    def plan_segments(self, target: float, duration: float) -> List[tuple[float, float]]:
+        """
+        Groups keyframes into segments of at least target seconds.
+        Returns (start, duration) pairs covering the whole source; every start
+        except the first is a source keyframe.
+        """
+        cuts = [0.0]
+        for t in self.times:
+            # Don't leave a sliver of a segment at the very end
+            if t - cuts[-1] >= target and duration - t >= target / 2:
+                cuts.append(t)
+        return [(start, round(end - start, 6)) for start, end in zip(cuts, cuts[1:] + [duration])]
+
+
+def fetch_range(url: str, start: int, length: int, headers: dict) -> bytes:
+    response = requests.get(url, headers={**headers, "Range": f"bytes={start}-{start + length - 1}"}, timeout=15)
+    if response.status_code not in (200, 206):
+        raise OSError(f"HTTP {response.status_code}")
+    # A server ignoring Range sends the whole file from 0
+    return response.content if response.status_code == 206 else response.content[start:start + length]
+
+
+def read_vint(data: bytes, pos: int, keep_marker: bool = False) -> tuple[int, int]:
+    """Decodes an EBML variable-length integer; returns (value, length)."""
+    first = data[pos]
+    if first == 0:
+        raise ValueError("Invalid EBML length descriptor")
+    length = 9 - first.bit_length()
+    if pos + length > len(data):
+        raise IndexError("Truncated EBML element")
+    value = first if keep_marker else first & ((1 << (8 - length)) - 1)
+    for byte in data[pos + 1:pos + length]:
+        value = (value << 8) | byte
+    return value, length
+
+
+def iter_elements(data: bytes, start: int, end: int) -> Iterator[tuple[int, int, int | None]]:
+    """Yields (id, body offset, body size) for the elements in data[start:end]."""
+    pos = start
+    while pos < min(end, len(data)):
+        try:
+            element_id, id_length = read_vint(data, pos, keep_marker=True)
+            size, size_length = read_vint(data, pos + id_length)
+        except (ValueError, IndexError):
+            return
+        body = pos + id_length + size_length
+        if size == (1 << (7 * size_length)) - 1:
+            # Unknown size (live muxers); only the children can tell where it ends
+            yield element_id, body, None
+            return
+        yield element_id, body, size
+        pos = body + size
+
+
+def read_uint(data: bytes, body: int, size: int) -> int:
+    return int.from_bytes(data[body:body + size], "big")
+
+
+def read_mkv_cues(url: str, headers: dict) -> KeyframeIndex | None:
+    """
+    Reads video keyframe times and cluster offsets from a Matroska file's
+    Cues, using a couple of range requests instead of scanning the file.
+    Returns None for other containers or files without usable Cues.
+    """
+    head = fetch_range(url, 0, MKV_HEAD_BYTES, headers)
+    if len(head) < 4 or int.from_bytes(head[:4], "big") != EBML_HEADER:
+        return None
+
+    segment_start = None
+    segment_end = len(head)
+    for element_id, body, size in iter_elements(head, 0, len(head)):
+        if element_id == SEGMENT:
+            segment_start = body
+            if size is not None:
+                segment_end = body + size
+            break
+    if segment_start is None:
+        return None
+
+    def element_data(element_id: int, body: int, size: int) -> tuple[bytes, int]:
+        # Top-level elements past the head buffer are fetched on their own
+        if body + size <= len(head):
+            return head, body
+        return fetch_range(url, body, size, headers), 0
+
+    timestamp_scale = 1_000_000
+    video_track = None
+    cues_position = None
+    cues_element = None
+    for element_id, body, size in iter_elements(head, segment_start, segment_end):
+        if size is None or element_id == CLUSTER:
+            break
+        if element_id == SEEK_HEAD:
+            data, offset = element_data(element_id, body, size)
+            for seek_id, seek_body, seek_size in iter_elements(data, offset, offset + size):
+                if seek_id != SEEK:
+                    continue
+                target = position = None
+                for child_id, child_body, child_size in iter_elements(data, seek_body, seek_body + seek_size):
+                    if child_id == SEEK_ID:
+                        target = read_uint(data, child_body, child_size)
+                    elif child_id == SEEK_POSITION:
+                        position = read_uint(data, child_body, child_size)
+                if target == CUES and position is not None:
+                    cues_position = segment_start + position
+        elif element_id == INFO:
+            data, offset = element_data(element_id, body, size)
+            for child_id, child_body, child_size in iter_elements(data, offset, offset + size):
+                if child_id == TIMESTAMP_SCALE:
+                    timestamp_scale = read_uint(data, child_body, child_size)
+        elif element_id == TRACKS:
+            data, offset = element_data(element_id, body, size)
+            for entry_id, entry_body, entry_size in iter_elements(data, offset, offset + size):
+                if entry_id != TRACK_ENTRY:
+                    continue
+                number = track_type = None
+                for child_id, child_body, child_size in iter_elements(data, entry_body, entry_body + entry_size):
+                    if child_id == TRACK_NUMBER:
+                        number = read_uint(data, child_body, child_size)
+                    elif child_id == TRACK_TYPE:
+                        track_type = read_uint(data, child_body, child_size)
+                if track_type == 1 and video_track is None:
+                    video_track = number
+        elif element_id == CUES:
+            cues_element = element_data(element_id, body, size) + (size,)
+
+    if video_track is None:
+        return None
+    if cues_element is None:
+        if cues_position is None:
+            return None
+        # Read the Cues header first to learn how big the element is
+        header = fetch_range(url, cues_position, 16, headers)
+        element_id, id_length = read_vint(header, 0, keep_marker=True)
+        size, size_length = read_vint(header, id_length)
+        if element_id != CUES:
+            return None
+        cues_element = (fetch_range(url, cues_position + id_length + size_length, size, headers), 0, size)
+
+    data, offset, size = cues_element
+    points: dict[float, int | None] = {}
+    for point_id, point_body, point_size in iter_elements(data, offset, offset + size):
+        if point_id != CUE_POINT:
+            continue
+        cue_time = None
+        cluster_position = None
+        for child_id, child_body, child_size in iter_elements(data, point_body, point_body + point_size):
+            if child_id == CUE_TIME:
+                cue_time = read_uint(data, child_body, child_size)
+            elif child_id == CUE_TRACK_POSITIONS:
+                track = position = None
+                for grand_id, grand_body, grand_size in iter_elements(data, child_body, child_body + child_size):
+                    if grand_id == CUE_TRACK:
+                        track = read_uint(data, grand_body, grand_size)
+                    elif grand_id == CUE_CLUSTER_POSITION:
+                        position = read_uint(data, grand_body, grand_size)
+                if track == video_track and position is not None:
+                    cluster_position = segment_start + position
+        if cue_time is not None and cluster_position is not None:
+            points[round(cue_time * timestamp_scale / 1e9, 3)] = cluster_position
+
+    if len(points) < 2:
+        return None
+    times = sorted(points)
+    return KeyframeIndex(times=times, offsets=[points[t] for t in times], source="cues")
+
+
+def mp4_moov_first(url: str, headers: dict) -> bool:
+    """
+    True for an MP4/MOV whose moov box comes before mdat ("fast start"),
+    which a browser can play progressively over Range requests.
+    """
+    head = fetch_range(url, 0, MP4_HEAD_BYTES, headers)
+    pos = 0
+    # ftyp, free/wide and friends are small; a handful of boxes is plenty
+    for _ in range(16):
+        if pos + 16 <= len(head) or len(head) < MP4_HEAD_BYTES:
+            header = head[pos:pos + 16]
+        else:
+            # The next box header lies past the first read
+            header = fetch_range(url, pos, 16, headers)
+        if len(header) < 8:
+            return False
+        size = int.from_bytes(header[:4], "big")
+        box_type = header[4:8]
+        if box_type == b"moov":
+            return True
+        if box_type == b"mdat" or size == 0:
+            return False
+        if size == 1:
+            # 64-bit size follows the type
+            if len(header) < 16:
+                return False
+            size = int.from_bytes(header[8:16], "big")
+        if size < 8:
+            return False
+        pos += size
+    return False
+
+
+async def scan_keyframes(url: str, headers: dict) -> KeyframeIndex | None:
+    """
+    Lists video keyframes by demuxing the whole file with ffprobe. Nothing is
+    decoded, but every byte is read, so this only runs as a background pass.
+    """
+    cmd = [
+        "ffprobe",
+        "-v", "error",
+        "-select_streams", "v:0",
+        "-show_entries", "packet=pts_time,pos,flags",
+        "-of", "csv=p=0",
+    ]
+    if url.startswith("http"):
+        cmd.extend(["-headers", "".join(f"{k}: {v}\r\n" for k, v in headers.items())])
+    cmd.append(url)
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+    except OSError as e:
+        print(f"Warning: Keyframe scan failed ({e})")
+        return None
+    try:
+        stdout, _ = await proc.communicate()
+    finally:
+        # Cancelled with the session: don't leave ffprobe reading the file
+        if proc.returncode is None:
+            proc.kill()
+    if proc.returncode != 0:
+        print(f"Warning: Keyframe scan exited with code {proc.returncode}")
+        return None
+
+    points: dict[float, int | None] = {}
+    for line in stdout.decode(errors="ignore").splitlines():
+        fields = line.split(",")
+        if len(fields) < 3 or not fields[2].startswith("K"):
+            continue
+        try:
+            time = round(float(fields[0]), 3)
+        except ValueError:
+            continue
+        points[time] = int(fields[1]) if fields[1].isdigit() else None
+    if len(points) < 2:
+        return None
+    times = sorted(points)
+    return KeyframeIndex(times=times, offsets=[points[t] for t in times], source="scan")
+
+
+def load_keyframe_index(cache_dir: Path, key: str, url: str, headers: dict) -> KeyframeIndex | None:
+    """Returns the cached index, or reads it from the container's cues and caches it."""
+    index = KeyframeIndex.from_dict(load_cached(cache_dir, key, "keyframes"))
+    if index is not None:
+        return index
+    try:
+        index = read_mkv_cues(url, headers)
+    except (requests.RequestException, OSError, ValueError, IndexError) as e:
+        print(f"Warning: Could not read container cues ({e})")
+        return None
+    if index is not None:
+        store_cached(cache_dir, key, "keyframes", index.to_dict())
+    return index
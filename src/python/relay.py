@@ -0,0 +1,418 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import aiohttp
+from aiohttp import web
+
+CHUNK_SIZE = 1024 * 1024
+
+# Upper bound on how many missing, adjacent chunks one upstream request covers
+MAX_SPAN_CHUNKS = 8
+UPSTREAM_RETRIES = 3
+
+# Concurrent upstream requests the read-ahead stage may have open
+READ_AHEAD_SPANS = 2
+
+# Spans in a row below min_throughput before the relay moves to the next fallback
+SLOW_SPANS = 3
+
+
+def parse_range(header: str, size: int) -> tuple[int, int] | None:
+    """
+    Parses a single 'bytes=' range against a resource of the given size.
+    Returns inclusive (start, end), or None if it can't be satisfied.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if not first:
+            # Suffix range: the last N bytes
+            length = int(last)
+            if length <= 0:
+                return None
+            return max(size - length, 0), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return None
+    return start, min(end, size - 1)
+
+
+class UpstreamRelay:
+    """
+    Loopback HTTP server fronting one upstream media URL.
+
+    ffprobe, ffmpeg and the ZIP reader all read through it, so the container
+    header and cues fetched by one are served to the others from cache, and
+    every upstream request reuses one keep-alive pool carrying the configured
+    headers. Chunks live in a memory LRU backed by a bounded disk cache;
+    concurrent requests for the same chunk share one upstream fetch, and
+    adjacent missing chunks are coalesced into a single ranged request.
+
+    It also acts as a jitter buffer: a read-ahead stage keeps fetching up
+    to read_ahead bytes past every active reader, so a short CDN stall is
+    absorbed by the buffer instead of stalling the decoder. Read-ahead that
+    doesn't fit in memory spills to the disk cache.
+
+    Given fallbacks (other URL/header pairs serving the same bytes, best
+    first), it moves to the next one when the current upstream keeps failing
+    or stays below min_throughput bytes/s.
+    """
+
+    def __init__(
+        self,
+        upstream_url: str,
+        headers: dict,
+        cache_dir: Path,
+        memory_limit: int = 64 * CHUNK_SIZE,
+        disk_limit: int = 2 * 1024 ** 3,
+        chunk_size: int = CHUNK_SIZE,
+        read_ahead: int = 32 * CHUNK_SIZE,
+        fallbacks: list[tuple[str, dict]] | None = None,
+        min_throughput: float = 0,
+    ):
+        self.upstream_url = upstream_url
+        self.headers = headers
+        self.fallbacks = list(fallbacks or [])
+        self.min_throughput = min_throughput
+        self.cache_dir = cache_dir
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.chunk_size = chunk_size
+        self.read_ahead = read_ahead
+
+        self.size: int | None = None
+        self.content_type = "application/octet-stream"
+        self.url: str | None = None
+
+        self._memory: OrderedDict[int, bytes] = OrderedDict()
+        self._memory_bytes = 0
+        self._disk: OrderedDict[int, int] = OrderedDict()
+        self._disk_bytes = 0
+        self._inflight: dict[int, asyncio.Future] = {}
+        self._fetch_tasks: set[asyncio.Task] = set()
+        self._session: aiohttp.ClientSession | None = None
+        self._runner: web.AppRunner | None = None
+
+        # Read position of every open response, keyed by id()
+        self._cursors: dict[int, int] = {}
+        self._ahead_tasks: set[asyncio.Task] = set()
+        self._read_ahead_task: asyncio.Task | None = None
+        self._slow_spans = 0
+
+        self.stats = {
+            "upstream_requests": 0,
+            "upstream_bytes": 0,
+            "served_bytes": 0,
+            "memory_hits": 0,
+            "disk_hits": 0,
+            # Reads that had to wait on the upstream
+            "stalls": 0,
+            "buffer": {"target_bytes": read_ahead, "buffered_bytes": 0, "fill": 1.0, "readers": 0},
+            "upstream": upstream_url,
+            "switches": 0,
+        }
+
+    @property
+    def chunk_count(self) -> int:
+        return math.ceil(self.size / self.chunk_size) if self.size else 0
+
+    def _chunk_len(self, index: int) -> int:
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+    def _chunk_path(self, index: int) -> Path:
+        return self.cache_dir / f"{index:08d}.chunk"
+
+    async def start(self) -> str | None:
+        """
+        Learns the upstream size and starts serving on a loopback port.
+        Returns the local URL, or None if the upstream can't serve ranges.
+        """
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # Headers go on each request, so a switch to a fallback takes effect at once
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit_per_host=4, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=15, sock_read=30),
+            auto_decompress=False,
+        )
+        try:
+            if not await self._probe():
+                return None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"Warning: Relay could not reach upstream ({e})")
+            return None
+
+        app = web.Application()
+        app.router.add_route("GET", "/source", self.handle)
+        app.router.add_route("HEAD", "/source", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host="127.0.0.1", port=0)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.url = f"http://127.0.0.1:{port}/source"
+        if self.read_ahead > 0:
+            self._read_ahead_task = asyncio.create_task(self._read_ahead_loop())
+        return self.url
+
+    async def stop(self) -> None:
+        if self._read_ahead_task is not None:
+            self._read_ahead_task.cancel()
+        for task in self._fetch_tasks:
+            task.cancel()
+        if self._runner is not None:
+            await self._runner.cleanup()
+        if self._session is not None:
+            await self._session.close()
+
+    async def _probe(self) -> bool:
+        async with self._session.get(self.upstream_url, headers={**self.headers, "Range": f"bytes=0-{self.chunk_size - 1}"}) as resp:
+            self.stats["upstream_requests"] += 1
+            total = resp.headers.get("Content-Range", "").rpartition("/")[2]
+            if resp.status != 206 or not total.isdigit():
+                print(f"Warning: Upstream does not support range requests (HTTP {resp.status}), relay disabled")
+                return False
+            self.size = int(total)
+            self.content_type = resp.headers.get("Content-Type", self.content_type)
+            data = await resp.read()
+        self.stats["upstream_bytes"] += len(data)
+        await self._store(0, data[:self._chunk_len(0)])
+        return True
+
+    async def _store(self, index: int, data: bytes) -> None:
+        self._memory[index] = data
+        self._memory.move_to_end(index)
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.memory_limit and len(self._memory) > 1:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+        # Write-through, so chunks evicted from memory are still local
+        if index not in self._disk:
+            try:
+                await asyncio.to_thread(self._chunk_path(index).write_bytes, data)
+            except OSError as e:
+                print(f"Warning: Relay disk cache write failed ({e})")
+                return
+            self._disk[index] = len(data)
+            self._disk_bytes += len(data)
+            while self._disk_bytes > self.disk_limit and len(self._disk) > 1:
+                evicted_index, evicted_len = self._disk.popitem(last=False)
+                self._disk_bytes -= evicted_len
+                self._chunk_path(evicted_index).unlink(missing_ok=True)
+
+    def _cached(self, index: int) -> bool:
+        return index in self._memory or index in self._disk
+
+    async def get_chunk(self, index: int, want_last: int | None = None) -> bytes:
+        data = self._memory.get(index)
+        if data is not None:
+            self._memory.move_to_end(index)
+            self.stats["memory_hits"] += 1
+            return data
+
+        if index in self._disk:
+            try:
+                data = await asyncio.to_thread(self._chunk_path(index).read_bytes)
+                self._disk.move_to_end(index)
+                self.stats["disk_hits"] += 1
+                await self._store(index, data)
+                return data
+            except OSError:
+                self._disk_bytes -= self._disk.pop(index, 0)
+
+        future = self._inflight.get(index)
+        if future is None:
+            self._schedule_span(index, want_last if want_last is not None else index)
+            future = self._inflight[index]
+        self.stats["stalls"] += 1
+        # Shielded so one consumer disconnecting doesn't cancel the fetch others wait on
+        return await asyncio.shield(future)
+
+    def _buffered_ahead(self, position: int) -> int:
+        """Bytes past position that are already local, counted up to the first gap."""
+        index = position // self.chunk_size
+        if not self._cached(index):
+            return 0
+        while index + 1 < self.chunk_count and self._cached(index + 1):
+            index += 1
+        return min((index + 1) * self.chunk_size, self.size) - position
+
+    async def _read_ahead_loop(self, interval: float = 0.1) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            worst_fill = 1.0
+            worst_buffered = self.read_ahead
+            for position in list(self._cursors.values()):
+                target = min(self.read_ahead, self.size - position)
+                if target <= 0:
+                    continue
+                buffered = self._buffered_ahead(position)
+                if buffered / target < worst_fill:
+                    worst_fill, worst_buffered = buffered / target, buffered
+                if buffered >= target or len(self._ahead_tasks) >= READ_AHEAD_SPANS:
+                    continue
+                # First missing chunk past the buffered run that nobody is fetching yet
+                last = (position + target - 1) // self.chunk_size
+                index = (position + buffered) // self.chunk_size
+                while index <= last and (self._cached(index) or index in self._inflight):
+                    index += 1
+                if index > last:
+                    continue
+                self._schedule_span(index, last)
+                # Track the span so read-ahead never opens more than READ_AHEAD_SPANS requests
+                waiter = asyncio.create_task(self._await_chunk(index))
+                self._ahead_tasks.add(waiter)
+                waiter.add_done_callback(self._ahead_tasks.discard)
+            self.stats["buffer"] = {
+                "target_bytes": self.read_ahead,
+                "buffered_bytes": worst_buffered,
+                "fill": round(worst_fill, 3),
+                "readers": len(self._cursors),
+            }
+
+    async def _await_chunk(self, index: int) -> None:
+        future = self._inflight.get(index)
+        if future is None:
+            return
+        try:
+            await asyncio.shield(future)
+        except ConnectionError:
+            pass
+
+    def _schedule_span(self, first: int, want_last: int) -> None:
+        last = first
+        limit = min(want_last, first + MAX_SPAN_CHUNKS - 1, self.chunk_count - 1)
+        while last < limit and not self._cached(last + 1) and (last + 1) not in self._inflight:
+            last += 1
+        loop = asyncio.get_running_loop()
+        for index in range(first, last + 1):
+            self._inflight[index] = loop.create_future()
+        task = asyncio.create_task(self._fetch_span(first, last))
+        self._fetch_tasks.add(task)
+        task.add_done_callback(self._fetch_tasks.discard)
+
+    def _switch_upstream(self, reason: str) -> bool:
+        if not self.fallbacks:
+            return False
+        self.upstream_url, self.headers = self.fallbacks.pop(0)
+        self._slow_spans = 0
+        self.stats["upstream"] = self.upstream_url
+        self.stats["switches"] += 1
+        print(f"Relay switching upstream to {self.upstream_url} ({reason})")
+        return True
+
+    def _record_throughput(self, received: int, elapsed: float) -> None:
+        if not self.min_throughput or received < self.chunk_size:
+            return
+        if received / max(elapsed, 1e-3) >= self.min_throughput:
+            self._slow_spans = 0
+            return
+        self._slow_spans += 1
+        if self._slow_spans >= SLOW_SPANS:
+            self._switch_upstream(f"below {self.min_throughput * 8 / 1e6:.1f} Mbit/s for {SLOW_SPANS} spans")
+
+    async def _fetch_span(self, first: int, last: int) -> None:
+        index = first
+        error: Exception | None = None
+        attempt = 0
+        while attempt < UPSTREAM_RETRIES:
+            start = index * self.chunk_size
+            end = min((last + 1) * self.chunk_size, self.size) - 1
+            upstream_url = self.upstream_url
+            started = time.monotonic()
+            try:
+                async with self._session.get(upstream_url, headers={**self.headers, "Range": f"bytes={start}-{end}"}) as resp:
+                    self.stats["upstream_requests"] += 1
+                    if resp.status != 206:
+                        raise ConnectionError(f"upstream returned HTTP {resp.status} for a range request")
+                    buffer = bytearray()
+                    async for piece in resp.content.iter_chunked(64 * 1024):
+                        self.stats["upstream_bytes"] += len(piece)
+                        buffer += piece
+                        while index <= last and len(buffer) >= self._chunk_len(index):
+                            length = self._chunk_len(index)
+                            data = bytes(buffer[:length])
+                            del buffer[:length]
+                            await self._store(index, data)
+                            future = self._inflight.pop(index, None)
+                            if future is not None and not future.done():
+                                future.set_result(data)
+                            index += 1
+                if index > last:
+                    if upstream_url == self.upstream_url:
+                        self._record_throughput(end - start + 1, time.monotonic() - started)
+                    return
+                raise ConnectionError("upstream closed the connection early")
+            except (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError) as e:
+                # Resume from the first chunk we didn't get
+                error = e
+                attempt += 1
+                if attempt == UPSTREAM_RETRIES and upstream_url == self.upstream_url and self._switch_upstream(f"read failed: {e}"):
+                    # A fresh upstream gets a fresh set of retries
+                    attempt = 0
+                    continue
+                if upstream_url != self.upstream_url:
+                    # Another span already moved on; retry there right away
+                    attempt = 0
+                    continue
+                print(f"Warning: Relay upstream read failed ({e}), retrying...")
+                await asyncio.sleep(0.5 * 2 ** (attempt - 1))
+
+        for pending in range(index, last + 1):
+            future = self._inflight.pop(pending, None)
+            if future is not None and not future.done():
+                future.set_exception(ConnectionError(f"upstream read failed: {error}"))
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        """Serves the source with Range support; also mounted by the proxy for direct play."""
+        start, end = 0, self.size - 1
+        status = 200
+        range_header = request.headers.get("Range")
+        if range_header:
+            parsed = parse_range(range_header, self.size)
+            if parsed is None:
+                raise web.HTTPRequestRangeNotSatisfiable(headers={"Content-Range": f"bytes */{self.size}"})
+            start, end = parsed
+            status = 206
+
+        headers = {
+            "Accept-Ranges": "bytes",
+            "Content-Type": self.content_type,
+            "Content-Length": str(end - start + 1),
+        }
+        if status == 206:
+            headers["Content-Range"] = f"bytes {start}-{end}/{self.size}"
+        response = web.StreamResponse(status=status, headers=headers)
+        await response.prepare(request)
+        if request.method == "HEAD":
+            return response
+
+        position = start
+        cursor = id(response)
+        self._cursors[cursor] = position
+        try:
+            while position <= end:
+                index = position // self.chunk_size
+                data = await self.get_chunk(index, want_last=end // self.chunk_size)
+                offset = position - index * self.chunk_size
+                piece = data[offset:offset + (end - position + 1)]
+                await response.write(piece)
+                position += len(piece)
+                self._cursors[cursor] = position
+                self.stats["served_bytes"] += len(piece)
+        except ConnectionResetError:
+            # ffmpeg seeks by dropping the connection and opening a new range
+            pass
+        except ConnectionError as e:
+            print(f"Warning: Relay aborted a response ({e})")
+        finally:
+            self._cursors.pop(cursor, None)
+        return response
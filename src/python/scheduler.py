@@ -0,0 +1,308 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import List
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+# Every proxy on the host shares this job table, so ten proxies starting at
+# once see each other's load instead of each assuming it owns the machine
+SCHEDULER_DIR = Path(tempfile.gettempdir()) / "hls_proxy_scheduler"
+STATE_FILE = "jobs.json"
+LOCK_FILE = "jobs.lock"
+
+# Jobs that stop heartbeating (crashed or SIGKILLed proxies) are dropped after this
+HEARTBEAT_TTL = 30
+
+PRIORITIES = {"play": 0, "prepare": 1, "background": 2}
+
+# A playing session below this speed is no longer keeping up with real time
+REALTIME_MARGIN = 1.05
+
+
+@dataclass
+class Lease:
+    job_id: str
+    priority: str
+    threads: int
+    gpu: bool = False
+    cores: List[int] = field(default_factory=list)
+    degraded: bool = False
+
+
+class TranscodeScheduler:
+    """
+    Admits transcode jobs against a host-wide CPU and GPU encoder budget.
+
+    Playing sessions are never refused: when the host is full they wait a
+    short while and are then admitted degraded (fewer threads, lower
+    resolution). Prepare and background jobs queue until there is headroom
+    beyond the share reserved for playback.
+    """
+
+    def __init__(
+        self,
+        cpu_budget: int | None = None,
+        gpu_sessions: int = 3,
+        reserve_for_play: float = 0.25,
+        pin_cores: bool = False,
+        state_dir: Path = SCHEDULER_DIR,
+    ):
+        self.cpu_budget = cpu_budget or os.cpu_count() or 1
+        self.gpu_sessions = gpu_sessions
+        self.reserve_for_play = reserve_for_play
+        self.pin_cores = pin_cores
+        self.state_dir = state_dir
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+
+    @contextmanager
+    def _lock(self):
+        # An OS lock on the file, not the file's existence: it is released when
+        # its owner exits or is killed, and never taken from an owner still alive
+        fd = os.open(self.state_dir / LOCK_FILE, os.O_CREAT | os.O_RDWR)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            else:
+                while True:
+                    try:
+                        # Locks the first byte; the file is never read or written
+                        msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+                        break
+                    except OSError:
+                        time.sleep(0.05)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                else:
+                    msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        finally:
+            os.close(fd)
+
+    def _load(self) -> dict:
+        try:
+            jobs = json.loads((self.state_dir / STATE_FILE).read_text()).get("jobs", {})
+        except (FileNotFoundError, json.JSONDecodeError):
+            jobs = {}
+        now = time.time()
+        return {job_id: job for job_id, job in jobs.items() if now - job.get("heartbeat", 0) < HEARTBEAT_TTL}
+
+    def _save(self, jobs: dict) -> None:
+        state_path = self.state_dir / STATE_FILE
+        tmp_path = state_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps({"jobs": jobs}, indent=2))
+        os.replace(tmp_path, state_path)
+
+    def snapshot(self) -> dict:
+        with self._lock():
+            jobs = self._load()
+        return {
+            "cpu_budget": self.cpu_budget,
+            "threads_in_use": sum(job["threads"] for job in jobs.values()),
+            "gpu_in_use": sum(1 for job in jobs.values() if job.get("gpu")),
+            "jobs": jobs,
+        }
+
+    def _pick_cores(self, jobs: dict, count: int) -> List[int]:
+        taken = {core for job in jobs.values() for core in job.get("cores", [])}
+        free = [core for core in range(self.cpu_budget) if core not in taken]
+        # Share cores with other jobs rather than hand out fewer than asked
+        return (free + [core for core in range(self.cpu_budget) if core in taken])[:count]
+
+    def try_admit(
+        self,
+        priority: str,
+        want_threads: int,
+        min_threads: int = 1,
+        gpu: bool = False,
+        force: bool = False,
+        job_id: str | None = None,
+    ) -> Lease | None:
+        """
+        Returns a lease if the job fits now, otherwise None.
+        With force=True a job that doesn't fit is admitted degraded instead.
+        """
+        with self._lock():
+            jobs = self._load()
+            in_use = sum(job["threads"] for job in jobs.values())
+            free = self.cpu_budget - in_use
+
+            # Don't stack new work on a host where playback is already behind
+            saturated = any(
+                job["priority"] == "play" and job.get("speed") is not None and job["speed"] < REALTIME_MARGIN
+                for job in jobs.values()
+            )
+            if saturated:
+                free = min(free, 0)
+
+            if priority != "play":
+                free -= int(self.cpu_budget * self.reserve_for_play)
+
+            if gpu and sum(1 for job in jobs.values() if job.get("gpu")) >= self.gpu_sessions:
+                # Encoder sessions are a hard limit on consumer cards; fall back to CPU
+                gpu = False
+
+            if free >= want_threads:
+                threads, degraded = want_threads, False
+            elif free >= min_threads:
+                threads, degraded = free, True
+            elif force:
+                threads, degraded = min_threads, True
+            else:
+                return None
+
+            lease = Lease(
+                job_id=job_id or uuid.uuid4().hex[:12],
+                priority=priority,
+                threads=threads,
+                gpu=gpu,
+                cores=self._pick_cores(jobs, threads) if self.pin_cores else [],
+                degraded=degraded,
+            )
+            now = time.time()
+            jobs[lease.job_id] = {
+                "pid": os.getpid(),
+                "priority": priority,
+                "threads": threads,
+                "gpu": gpu,
+                "cores": lease.cores,
+                "degraded": degraded,
+                "speed": None,
+                "started": now,
+                "heartbeat": now,
+            }
+            self._save(jobs)
+            return lease
+
+    async def admit(
+        self,
+        priority: str,
+        want_threads: int,
+        min_threads: int = 1,
+        gpu: bool = False,
+        queue_timeout: float = 10,
+        give_up_after: float | None = None,
+    ) -> Lease:
+        """
+        Waits for capacity. Playing sessions give up waiting after
+        queue_timeout and run degraded; other priorities wait until
+        give_up_after seconds, then raise TimeoutError (None waits indefinitely).
+        """
+        waited = 0.0
+        announced = False
+        while True:
+            force = priority == "play" and waited >= queue_timeout
+            lease = await asyncio.to_thread(self.try_admit, priority, want_threads, min_threads, gpu, force)
+            if lease is not None:
+                return lease
+            if give_up_after is not None and waited >= give_up_after:
+                raise TimeoutError(f"No capacity for a {priority} job after {waited:g}s")
+            if not announced:
+                print(f"Scheduler: host is busy, queueing {priority} job...")
+                announced = True
+            await asyncio.sleep(1)
+            waited += 1
+
+    def heartbeat(self, lease: Lease, speed: float | None = None) -> None:
+        with self._lock():
+            jobs = self._load()
+            job = jobs.get(lease.job_id)
+            if job is None:
+                # Expired while we were stalled; re-register with the same grant
+                job = {
+                    "pid": os.getpid(),
+                    "priority": lease.priority,
+                    "threads": lease.threads,
+                    "gpu": lease.gpu,
+                    "cores": lease.cores,
+                    "degraded": lease.degraded,
+                    "started": time.time(),
+                }
+                jobs[lease.job_id] = job
+            job["heartbeat"] = time.time()
+            if speed is not None:
+                job["speed"] = speed
+            self._save(jobs)
+
+    def promote(self, lease: Lease, priority: str) -> None:
+        """Moves a running job to another class, e.g. a prepared session that starts playing."""
+        lease.priority = priority
+        with self._lock():
+            jobs = self._load()
+            if lease.job_id in jobs:
+                jobs[lease.job_id]["priority"] = priority
+                self._save(jobs)
+
+    def release(self, lease: Lease) -> None:
+        with self._lock():
+            jobs = self._load()
+            if jobs.pop(lease.job_id, None) is not None:
+                self._save(jobs)
+
+
+def apply_process_limits(pid: int, lease: Lease) -> None:
+    """Pins the process to the lease's cores and lowers the priority of background work."""
+    if lease.cores and hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(pid, lease.cores)
+        except OSError as e:
+            print(f"Warning: Could not set CPU affinity ({e})")
+    # Not prepare jobs: they become playback when promoted, and an unprivileged
+    # process can't take its nice value back. Admission keeps them out of the
+    # playback reserve already.
+    if lease.priority == "background" and hasattr(os, "setpriority"):
+        try:
+            os.setpriority(os.PRIO_PROCESS, pid, 19)
+        except OSError as e:
+            print(f"Warning: Could not lower process priority ({e})")
+
+
+def apply_idle_priority(pid: int) -> None:
+    """Lets a side job run only on CPU time no other process wants."""
+    if hasattr(os, "sched_setscheduler") and hasattr(os, "SCHED_IDLE"):
+        try:
+            os.sched_setscheduler(pid, os.SCHED_IDLE, os.sched_param(0))
+            return
+        except OSError:
+            pass
+    if hasattr(os, "setpriority"):
+        try:
+            os.setpriority(os.PRIO_PROCESS, pid, 19)
+        except OSError as e:
+            print(f"Warning: Could not lower process priority ({e})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Host-wide transcode scheduler")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("status", help="Show admitted transcode jobs")
+    subparsers.add_parser("reset", help="Forget all admitted jobs")
+
+    args = parser.parse_args()
+    scheduler = TranscodeScheduler()
+
+    if args.command == "status":
+        print(json.dumps(scheduler.snapshot(), indent=2))
+    elif args.command == "reset":
+        with scheduler._lock():
+            scheduler._save({})
+        print("Scheduler state cleared.", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
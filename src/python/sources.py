@@ -0,0 +1,236 @@
+import argparse
+import asyncio
+import json
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import List
+from urllib.parse import urlparse
+
+import aiohttp
+
+from keyframes import CACHE_DIR
+
+SOURCES_FILE = CACHE_DIR / "sources.json"
+
+BROWSER_UA = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36"
+
+# Selectable by name with --header-profile; "default" is whatever HEADERS/--headers hold
+BUILTIN_PROFILES = {
+    "none": {},
+    "browser": {"User-Agent": BROWSER_UA, "Accept": "*/*"},
+}
+
+# Enough for TCP to ramp up past slow start, small enough to be cheap per candidate
+PROBE_BYTES = 512 * 1024
+RACE_TIMEOUT = 8
+# Once something answered, stragglers get this long to beat it
+RACE_GRACE = 1.5
+# Candidates are ranked by the time they'd take to deliver this much
+SCORE_BYTES = 8 * 1024 * 1024
+
+
+@dataclass
+class Candidate:
+    url: str
+    profile: str
+    headers: dict
+    ttfb: float | None = None
+    throughput: float | None = None
+    size: int | None = None
+    error: str | None = None
+    cached: bool = field(default=False, compare=False)
+
+    @property
+    def host(self) -> str:
+        return urlparse(self.url).netloc
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and self.ttfb is not None
+
+    @property
+    def score(self) -> float:
+        """Expected seconds to fetch SCORE_BYTES; lower is better."""
+        if not self.ok:
+            return float("inf")
+        return self.ttfb + SCORE_BYTES / max(self.throughput or 1.0, 1.0)
+
+    def describe(self) -> str:
+        if not self.ok:
+            return f"{self.host} [{self.profile}]: {self.error}"
+        return (
+            f"{self.host} [{self.profile}]: TTFB {self.ttfb * 1000:.0f} ms, "
+            f"{self.throughput * 8 / 1e6:.1f} Mbit/s"
+        )
+
+
+def parse_profiles(values: List[str] | None, default_headers: dict) -> dict[str, dict]:
+    """
+    Resolves --header-profile values: a built-in name, or a JSON dict of
+    headers (optionally {"name": ..., "headers": {...}}).
+    """
+    profiles = {"default": dict(default_headers)}
+    for position, value in enumerate(values or [], start=1):
+        if value in BUILTIN_PROFILES:
+            profiles[value] = dict(BUILTIN_PROFILES[value])
+            continue
+        try:
+            parsed = json.loads(value)
+        except json.JSONDecodeError:
+            print(f"Warning: Unknown header profile {value!r}, ignoring.")
+            continue
+        if isinstance(parsed, dict) and isinstance(parsed.get("headers"), dict):
+            profiles[str(parsed.get("name") or f"custom{position}")] = parsed["headers"]
+        elif isinstance(parsed, dict):
+            profiles[f"custom{position}"] = parsed
+        else:
+            print(f"Warning: Header profile {value!r} is not a JSON object, ignoring.")
+    return profiles
+
+
+def load_winners(path: Path = SOURCES_FILE) -> dict:
+    try:
+        return json.loads(path.read_text())
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def remember_winners(candidates: List[Candidate], path: Path = SOURCES_FILE) -> None:
+    """Stores the best working profile of every host that answered."""
+    winners = load_winners(path)
+    for candidate in sorted(candidates, key=lambda c: c.score, reverse=True):
+        if candidate.ok:
+            winners[candidate.host] = {
+                "profile": candidate.profile,
+                "headers": candidate.headers,
+                "ttfb": round(candidate.ttfb, 4),
+                "throughput": round(candidate.throughput),
+                "updated": time.time(),
+            }
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(winners, indent=2))
+    except OSError as e:
+        print(f"Warning: Could not save source winners ({e})")
+
+
+async def probe_candidate(session: aiohttp.ClientSession, candidate: Candidate, probe_bytes: int = PROBE_BYTES) -> Candidate:
+    """
+    One small ranged GET: the status line gives TTFB and confirms Range
+    support (so no separate HEAD), Content-Range gives the size, and the
+    body gives a throughput sample.
+    """
+    headers = {**candidate.headers, "Range": f"bytes=0-{probe_bytes - 1}"}
+    started = time.monotonic()
+    try:
+        async with session.get(candidate.url, headers=headers, allow_redirects=True) as resp:
+            first_byte = time.monotonic()
+            total = resp.headers.get("Content-Range", "").rpartition("/")[2]
+            if resp.status != 206 or not total.isdigit():
+                candidate.error = f"HTTP {resp.status}" + ("" if resp.status >= 400 else " without range support")
+                return candidate
+            received = 0
+            async for piece in resp.content.iter_chunked(64 * 1024):
+                received += len(piece)
+            finished = time.monotonic()
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        candidate.error = str(e) or type(e).__name__
+        return candidate
+    candidate.size = int(total)
+    candidate.ttfb = first_byte - started
+    candidate.throughput = received / max(finished - first_byte, 1e-3)
+    return candidate
+
+
+async def race(candidates: List[Candidate], timeout: float = RACE_TIMEOUT, grace: float = RACE_GRACE) -> None:
+    """
+    Probes all candidates at once. Returns when all have answered, once the
+    grace period after the first success runs out, or at the timeout; the
+    ones still pending are marked as timed out.
+    """
+    if not candidates:
+        return
+    async with aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=0, force_close=True),
+        timeout=aiohttp.ClientTimeout(total=timeout, sock_connect=timeout),
+        auto_decompress=False,
+    ) as session:
+        tasks = {asyncio.create_task(probe_candidate(session, c)): c for c in candidates}
+        pending = set(tasks)
+        deadline = time.monotonic() + timeout
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            if any(task.result().ok for task in done):
+                deadline = min(deadline, time.monotonic() + grace)
+        for task in pending:
+            task.cancel()
+            tasks[task].error = "timed out"
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+async def select_source(
+    urls: List[str],
+    profiles: dict[str, dict],
+    winners_file: Path = SOURCES_FILE,
+) -> List[Candidate]:
+    """
+    Races every URL x header profile and returns the working candidates,
+    best first. A host with a remembered winner is only probed with that
+    profile, unless it stops working.
+    """
+    winners = load_winners(winners_file)
+    candidates = [Candidate(url, name, headers) for url in urls for name, headers in profiles.items()]
+
+    first_round = []
+    for candidate in candidates:
+        remembered = winners.get(candidate.host)
+        if remembered is None or not any(c.host == candidate.host and c.headers == remembered.get("headers") for c in candidates):
+            first_round.append(candidate)
+        elif candidate.headers == remembered.get("headers"):
+            candidate.cached = True
+            first_round.append(candidate)
+    await race(first_round)
+    tried = first_round
+    if not any(c.ok for c in first_round):
+        # The remembered profiles stopped working: race everything else
+        probed = {id(c) for c in first_round}
+        rest = [c for c in candidates if id(c) not in probed]
+        await race(rest)
+        tried = first_round + rest
+
+    for candidate in tried:
+        print(f"  {candidate.describe()}{' (remembered)' if candidate.cached else ''}")
+    working = [c for c in tried if c.ok]
+    if not working:
+        return []
+
+    # A mirror serving a different file must never be switched to mid-stream
+    primary = next((c for c in sorted(working, key=lambda c: c.score) if c.url == urls[0]), None)
+    size = primary.size if primary else min(working, key=lambda c: c.score).size
+    mismatched = [c for c in working if c.size != size]
+    for candidate in mismatched:
+        print(f"Warning: {candidate.host} serves {candidate.size} bytes, expected {size}; not using it")
+    working = sorted((c for c in working if c.size == size), key=lambda c: c.score)
+    remember_winners(working, winners_file)
+    return working
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Race source URLs and header profiles, best first")
+    parser.add_argument("urls", nargs="+", help="Candidate URLs for the same file")
+    parser.add_argument("--headers", help="JSON dict of headers for the default profile")
+    parser.add_argument("--header-profile", action="append", help=f"Extra profile: one of {', '.join(BUILTIN_PROFILES)} or a JSON dict")
+    parser.add_argument("--sources-file", type=Path, default=SOURCES_FILE, help="Where per-host winners are remembered")
+    args = parser.parse_args()
+
+    profiles = parse_profiles(args.header_profile, json.loads(args.headers) if args.headers else {})
+    ranked = asyncio.run(select_source(args.urls, profiles, args.sources_file))
+    print(json.dumps([{"url": c.url, "profile": c.profile, "ttfb": c.ttfb, "throughput": c.throughput} for c in ranked], indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,12 @@
 import argparse
 import asyncio
+import math
+import os
 import shutil
 import sys
 import tempfile
 from pathlib import Path
-from typing import List
+from typing import Awaitable, Callable, List
 import json
 import subprocess
 import mimetypes
@@ -12,12 +14,24 @@ import mimetypes
 # Explicitly register HLS MIME types for mobile compatibility
 mimetypes.add_type('application/vnd.apple.mpegurl', '.m3u8')
 mimetypes.add_type('video/MP2T', '.ts')
+mimetypes.add_type('video/mp4', '.mp4')
+mimetypes.add_type('video/iso.segment', '.m4s')
 
+import re
 import time
 
 
+import aiohttp
 from aiohttp import web
 
+from egress import EgressScheduler, is_loopback
+from keyframes import CACHE_DIR, KeyframeIndex, cache_key, load_cached, load_keyframe_index, mp4_moov_first, scan_keyframes, store_cached
+from relay import UpstreamRelay
+from sources import SOURCES_FILE, parse_profiles, select_source
+from scheduler import PRIORITIES, Lease, TranscodeScheduler, apply_idle_priority, apply_process_limits
+from tuning import lookup_tuning
+from workers import ServeWorkers, bind_shared_socket, reuse_port_supported, run_event_loop
+
 # Global idle timeout manager
 class IdleTimeout:
     def __init__(self, timeout_seconds: int, stop_event: asyncio.Event):
@@ -157,10 +171,13 @@ HTML_TEMPLATE = """
           settings: ['captions', 'quality', 'speed'],
           seekTime: 10,
           keyboard: {{ focused: true, global: true }},
+          previewThumbnails: {{ enabled: {thumbnails_enabled}, src: '/hls/thumbnails.vtt' }},
         }});
 
-        // Initialize HLS
-        if (Hls.isSupported()) {{
+        // Direct play: the browser reads the MP4 itself
+        if (source.endsWith('.mp4')) {{
+          video.src = source;
+        }} else if (Hls.isSupported()) {{
           const hls = new Hls();
           hls.loadSource(source);
           hls.attachMedia(video);
@@ -335,10 +352,21 @@ HEADERS = {
     "Cache-Control": "no-cache",
 }
 
+def probe_fallback() -> dict:
+    """What get_video_metadata returns when the probe fails: one unnamed audio track, nothing else known."""
+    return {
+        "tracks": [{"index": 0, "lang": "und", "title": "Unknown"}],
+        "duration": None,
+        "video": None,
+        "format": None,
+        "subtitles": [],
+    }
+
+
 def get_video_metadata(source_url: str) -> dict:
     """
-    Probes the source URL to find audio tracks and duration.
-    Returns a dict: {'tracks': [...], 'duration': 1234.5}
+    Probes the source URL to find audio tracks, duration and the video codec.
+    Returns a dict: {'tracks': [...], 'duration': 1234.5, 'video': {'codec': 'hevc', ...}}
     """
     # Format headers for ffprobe/ffmpeg
     headers_str = "".join(f"{k}: {v}\r\n" for k, v in HEADERS.items())
@@ -346,7 +374,7 @@ def get_video_metadata(source_url: str) -> dict:
     # Validation
     if not source_url.startswith("http"):
          print(f"Warning: Skipping ffprobe for non-http URL: {source_url}")
-         return {"tracks": [{"index": 0, "lang": "und", "title": "Unknown"}], "duration": None}
+         return probe_fallback()
 
     cmd = [
         "ffprobe",
@@ -355,7 +383,7 @@ def get_video_metadata(source_url: str) -> dict:
         "-headers", headers_str,
         "-analyzeduration", "1000000",
         "-probesize", "1000000",
-        "-show_entries", "format=duration:stream=index,codec_type,tags:stream_tags=language,title,handler_name",
+        "-show_entries", "format=duration,format_name:stream=index,codec_type,codec_name,width,height,pix_fmt,tags:stream_tags=language,title,handler_name",
         source_url
     ]
     
@@ -370,11 +398,11 @@ def get_video_metadata(source_url: str) -> dict:
             print(f"Warning: ffprobe returned exit code {result.returncode}")
             if result.stderr:
                 print(f"ffprobe stderr: {result.stderr.strip()[:200]}")
-            return {"tracks": [{"index": 0, "lang": "und", "title": "Unknown"}], "duration": None}
+            return probe_fallback()
         
         if not result.stdout.strip():
             print("Warning: ffprobe returned empty stdout")
-            return {"tracks": [{"index": 0, "lang": "und", "title": "Unknown"}], "duration": None}
+            return probe_fallback()
 
         data = json.loads(result.stdout)
         format_info = data.get("format", {})
@@ -388,7 +416,28 @@ def get_video_metadata(source_url: str) -> dict:
         streams = data.get("streams", [])
         
         tracks = []
+        subtitles = []
+        video = None
         for s in streams:
+            if s.get("codec_type") == "video" and video is None:
+                video = {
+                    "codec": s.get("codec_name"),
+                    "width": s.get("width"),
+                    "height": s.get("height"),
+                    "pix_fmt": s.get("pix_fmt"),
+                }
+                continue
+            if s.get("codec_type") == "subtitle":
+                # Bitmap formats (PGS, VobSub) can't become WebVTT without OCR
+                if s.get("codec_name") in TEXT_SUBTITLE_CODECS:
+                    tags = s.get("tags", {})
+                    subtitles.append({
+                        "index": s.get("index"),
+                        "lang": tags.get("language", "und"),
+                        "title": tags.get("title") or "",
+                        "codec": s.get("codec_name"),
+                    })
+                continue
             if s.get("codec_type") != "audio":
                  continue
             tags = s.get("tags", {})
@@ -399,20 +448,24 @@ def get_video_metadata(source_url: str) -> dict:
             tracks.append({
                 "index": s.get("index"),
                 "lang": lang,
-                "title": title
+                "title": title,
+                "codec": s.get("codec_name"),
             })
             
         return {
             "tracks": tracks if tracks else [{"index": 0, "lang": "und", "title": "Unknown"}],
-            "duration": duration
+            "duration": duration,
+            "video": video,
+            "format": format_info.get("format_name"),
+            "subtitles": subtitles,
         }
 
     except subprocess.TimeoutExpired:
         print("Warning: ffprobe timed out after 20 seconds")
-        return {"tracks": [{"index": 0, "lang": "und", "title": "Unknown"}], "duration": None}
+        return probe_fallback()
     except Exception as e:
         print(f"Warning: Internal error during ffprobe: {str(e)}")
-        return {"tracks": [{"index": 0, "lang": "und", "title": "Unknown"}], "duration": None}
+        return probe_fallback()
 
 
 async def detect_gpu_encoder() -> tuple[str, str, str, List[str]]:
@@ -454,6 +507,65 @@ async def detect_gpu_encoder() -> tuple[str, str, str, List[str]]:
     return "libx264", "veryfast", "-tune zerolatency", []
 
 
+# Subtitle codecs ffmpeg can convert to WebVTT
+TEXT_SUBTITLE_CODECS = {"subrip", "srt", "ass", "ssa", "webvtt", "mov_text", "text"}
+
+# ffmpeg's mpegts muxer starts timestamps at 1.4s (muxdelay + muxpreload);
+# WebVTT cues are mapped onto that clock
+TS_START_PTS = 126000
+
+# A dead alternate-audio encode is restarted on request at most this often
+AUDIO_RELAUNCHES = 3
+
+# How long a subtitle request is held open for a running extraction. The
+# headers go out at once, so only hls.js's overall fragment load timeout
+# (120 s by default) applies; closing just before it makes the player retry.
+SUBTITLE_WAIT = 110
+# Subtitle playlists list each track as WebVTT chunks of this many seconds,
+# each served as soon as the read-rate capped extraction has passed it
+SUBTITLE_CHUNK = 60
+VTT_TIME = re.compile(r"(?:(\d+):)?(\d+):(\d+)\.(\d+)")
+
+# What every browser's <video> plays from a progressive MP4
+DIRECT_PLAY_VIDEO = {"h264"}
+DIRECT_PLAY_AUDIO = {"aac", "mp3"}
+DIRECT_PLAY_PIX_FMTS = {"yuv420p", "yuvj420p"}
+
+
+def can_direct_play(metadata: dict, hevc: bool = False) -> bool:
+    """
+    True when the probed source could go to the browser untouched: an MP4
+    with browser-decodable video and a single browser-decodable audio track
+    (alternate tracks need the HLS audio groups).
+    """
+    video = metadata.get("video") or {}
+    video_codecs = DIRECT_PLAY_VIDEO | ({"hevc"} if hevc else set())
+    tracks = metadata.get("tracks") or []
+    return (
+        "mp4" in (metadata.get("format") or "").split(",")
+        and video.get("codec") in video_codecs
+        and video.get("pix_fmt") in DIRECT_PLAY_PIX_FMTS
+        and len(tracks) == 1
+        and tracks[0].get("codec") in DIRECT_PLAY_AUDIO
+    )
+
+
+def audio_track_name(track: dict, position: int, kind: str = "Audio") -> str:
+    """Unique rendition NAME for a track (required by the HLS spec)."""
+    lang = track.get("lang", "und")
+    title = track.get("title", "")
+    # Combine title and language, or just use language if title is generic/missing
+    base_name = title if title else f"{kind} {position+1}"
+    return f"{base_name} - {lang}" if lang != "und" else f"{base_name} {position+1}"
+
+
+def parse_bitrate(value: str) -> int:
+    """'3500k' -> 3500000, '5M' -> 5000000."""
+    value = value.strip().lower()
+    multiplier = {"k": 1_000, "m": 1_000_000}.get(value[-1:], 1)
+    return int(float(value.rstrip("km")) * multiplier)
+
+
 def build_ffmpeg_command(
     source_url: str,
     output_dir: Path,
@@ -465,9 +577,22 @@ def build_ffmpeg_command(
     encoder_opts: str,
     hw_accel_args: List[str],
     audio_tracks: List[dict],
+    playlist_name: str = "stream.m3u8",
+    segment_filename: str | None = None,
+    start_time: float = 0,
+    duration_limit: float | None = None,
+    scale_height: int | None = None,
+    start_number: int = 0,
+    threads: int | None = None,
+    segment_format: str = "ts",
+    video_copy: bool = False,
+    keyframe_grid: bool = False,
+    segment_times: List[float] | None = None,
+    append_list: bool = False,
+    omit_endlist: bool = False,
 ) -> List[str]:
     # Master playlist name (what the browser loads)
-    master_playlist_name = "stream.m3u8"
+    master_playlist_name = playlist_name
     
     # Use relative paths for ffmpeg to avoid Windows path issues
     # The process will be run with cwd=output_dir
@@ -481,21 +606,32 @@ def build_ffmpeg_command(
         "ffmpeg",
         "-y",
         "-loglevel", "info",
+        # Machine-readable progress on stdout (speed feeds the scheduler)
+        "-nostats",
+        "-progress", "pipe:1",
     ]
 
     # Only add headers if input is HTTP(S)
     if source_url.startswith("http"):
         cmd.extend(["-headers", headers_str])
 
-    # Add hardware acceleration args (before input)
-    if hw_accel_args:
+    # Add hardware acceleration args (before input); nothing is decoded when copying
+    if hw_accel_args and not video_copy:
         cmd.extend(hw_accel_args)
 
+    # Input seek for the full-quality half of a fast-start session
+    if start_time > 0:
+        cmd.extend(["-ss", f"{start_time:.3f}"])
+
     cmd.extend([
         "-i", source_url,
         "-map", "0:v:0", # Always map first video
     ])
 
+    # Stop after the fast-start window
+    if duration_limit:
+        cmd.extend(["-t", f"{duration_limit:.3f}"])
+
     # Map all detected audio tracks
     var_map_parts = ["v:0,agroup:audio,default:yes"]
     
@@ -512,9 +648,7 @@ def build_ffmpeg_command(
             cmd.extend([f"-metadata:s:a:{i}", f"language={lang}"])
             
             # Ensure unique NAME for HLS manifest (required by spec)
-            # Combine title and language, or just use language if title is generic/missing
-            base_name = title if title else f"Audio {i+1}"
-            unique_name = f"{base_name} - {lang}" if lang != "und" else f"{base_name} {i+1}"
+            unique_name = audio_track_name(track, i)
             
             # Sanitize for ffmpeg argument
             safe_name = unique_name.replace(",", "").replace(" ", "_").replace(":", "")
@@ -530,29 +664,107 @@ def build_ffmpeg_command(
 
     var_stream_map = " ".join(var_map_parts)
 
-    cmd.extend([
-        "-c:v", encoder,
-        "-preset", encoder_preset,
-    ])
+    if video_copy:
+        # Passthrough for clients that decode the source codec natively.
+        # hvc1 is the sample entry Safari/Chrome expect for HEVC in fMP4.
+        cmd.extend(["-c:v", "copy", "-tag:v", "hvc1"])
+    else:
+        cmd.extend([
+            "-c:v", encoder,
+            "-preset", encoder_preset,
+        ])
+
+        # Add encoder specific options
+        if encoder_opts:
+            cmd.extend(encoder_opts.split())
+
+        # Thread count granted by the scheduler
+        if threads:
+            cmd.extend(["-threads", str(threads)])
+
+        # Downscale on the device the frames live on
+        if scale_height:
+            if "cuda" in hw_accel_args:
+                cmd.extend(["-vf", f"scale_cuda=-2:{scale_height}"])
+            elif "qsv" in hw_accel_args:
+                cmd.extend(["-vf", f"scale_qsv=-1:{scale_height}"])
+            else:
+                cmd.extend(["-vf", f"scale=-2:{scale_height}"])
+
+        # Planned cuts from the keyframe index; -force_key_frames counts from the job's -ss
+        if segment_times:
+            cmd.extend(["-force_key_frames", ",".join(f"{t - start_time:.3f}" for t in segment_times)])
+        # Fast-start sessions are cut from two encodes, and lazily encoded audio
+        # renditions are cut on a fixed grid, so keyframes must sit on that grid
+        elif start_time > 0 or duration_limit or keyframe_grid:
+            cmd.extend(["-force_key_frames", f"expr:gte(t,n_forced*{segment_duration})"])
 
-    # Add encoder specific options
-    if encoder_opts:
-        cmd.extend(encoder_opts.split())
-        
     # Use relative path for output, relying on CWD
-    playlist_path = "stream.m3u8"
+    playlist_path = master_playlist_name
     
+    if not video_copy:
+        cmd.extend(["-b:v", video_bitrate])
+
     cmd.extend([
-        "-b:v", video_bitrate,
         "-c:a", "aac",
         "-b:a", audio_bitrate,
         "-ac", "2",
-        
+    ])
+
+    # Keep timestamps continuous across the fast-start hand-over
+    if start_time > 0:
+        cmd.extend(["-output_ts_offset", f"{start_time:.3f}"])
+
+    if segment_times is not None:
+        # The segment muxer cuts at the first keyframe at or after each listed
+        # (output) time, so segments match the plan exactly; its list only
+        # names segments that are complete
+        cmd.extend(["-f", "segment", "-segment_format", "mpegts"])
+        if segment_times:
+            cmd.extend([
+                "-segment_times", ",".join(f"{t:.3f}" for t in segment_times),
+                # Absorbs rounding between the forced keyframe and the listed time
+                "-segment_time_delta", "0.05",
+            ])
+        else:
+            cmd.extend(["-segment_time", "86400"])
+        cmd.extend([
+            "-segment_start_number", str(start_number),
+            "-segment_list", playlist_path,
+            "-segment_list_type", "m3u8",
+            segment_filename,
+        ])
+        return cmd
+
+    cmd.extend([
         "-f", "hls",
         "-hls_time", str(segment_duration),
         "-hls_list_size", "0", 
-        
-        
+        "-start_number", str(start_number),
+    ])
+
+    if segment_format == "fmp4":
+        # One CMAF file per rendition addressed with EXT-X-BYTERANGE instead of
+        # a file per segment; the static route answers the Range requests
+        cmd.extend([
+            "-hls_segment_type", "fmp4",
+            "-hls_flags", "single_file",
+            "-hls_segment_filename", segment_filename or f"{Path(master_playlist_name).stem}.mp4",
+        ])
+    elif segment_filename:
+        cmd.extend(["-hls_segment_filename", segment_filename])
+
+    # Resuming an interrupted encode: keep the segments already listed, and
+    # never mark the list finished, since ffmpeg writes ENDLIST even when killed
+    hls_flags = []
+    if append_list and segment_format != "fmp4":
+        hls_flags.append("append_list")
+    if omit_endlist and segment_format != "fmp4":
+        hls_flags.append("omit_endlist")
+    if hls_flags:
+        cmd.extend(["-hls_flags", "+".join(hls_flags)])
+
+    cmd.extend([
         # Output the playlist (absolute path)
         playlist_path,
     ])
@@ -560,6 +772,539 @@ def build_ffmpeg_command(
     return cmd
 
 
+def build_audio_command(
+    source_url: str,
+    track_position: int,
+    segment_duration: int,
+    audio_bitrate: str,
+    playlist_name: str,
+    segment_format: str = "ts",
+) -> List[str]:
+    """
+    Audio-only encode of one track for a lazily started alternate rendition.
+    Nothing but the chosen audio stream is decoded.
+    """
+    headers_str = "".join(f"{k}: {v}\r\n" for k, v in HEADERS.items())
+    stem = Path(playlist_name).stem
+
+    cmd = ["ffmpeg", "-y", "-loglevel", "info", "-nostats", "-progress", "pipe:1"]
+    if source_url.startswith("http"):
+        cmd.extend(["-headers", headers_str])
+    cmd.extend([
+        "-i", source_url,
+        "-map", f"0:a:{track_position}",
+        "-vn", "-sn", "-dn",
+        "-c:a", "aac",
+        "-b:a", audio_bitrate,
+        "-ac", "2",
+        "-f", "hls",
+        # Same grid as the video's forced keyframes keeps segments aligned
+        "-hls_time", str(segment_duration),
+        "-hls_list_size", "0",
+    ])
+    if segment_format == "fmp4":
+        cmd.extend([
+            "-hls_segment_type", "fmp4",
+            "-hls_flags", "single_file",
+            "-hls_segment_filename", f"{stem}.mp4",
+        ])
+    else:
+        cmd.extend(["-hls_segment_filename", f"{stem}_%05d.ts"])
+    cmd.append(playlist_name)
+    return cmd
+
+
+def build_thumbnail_command(
+    source_url: str,
+    interval: int,
+    width: int,
+    height: int,
+    columns: int,
+    rows: int,
+    readrate: float,
+) -> List[str]:
+    """
+    Keyframe-only decode into tiled JPEG sprite sheets, one tile per interval.
+    The fps filter repeats the last keyframe across long GOPs, so tile n of
+    sheet k always stands for time (k * columns * rows + n) * interval.
+    """
+    headers_str = "".join(f"{k}: {v}\r\n" for k, v in HEADERS.items())
+
+    cmd = ["ffmpeg", "-y", "-loglevel", "error", "-nostats"]
+    if source_url.startswith("http"):
+        cmd.extend(["-headers", headers_str])
+    cmd.extend([
+        # Never decode anything but keyframes
+        "-skip_frame", "nokey",
+        # Pace the read so previews don't take bandwidth from playback
+        "-readrate", str(readrate),
+        "-i", source_url,
+        "-map", "0:v:0",
+        "-an", "-sn", "-dn",
+        "-vf", f"fps=1/{interval},scale={width}:{height},tile={columns}x{rows}",
+        "-q:v", "5",
+        "-threads", "1",
+        "-start_number", "0",
+        # Each sheet appears under its name only once it is fully written
+        "-atomic_writing", "1",
+        "thumbs_%05d.jpg",
+    ])
+    return cmd
+
+
+class AudioRenditions:
+    """
+    Alternate audio tracks advertised in the master playlist but only
+    encoded, by a separate audio-only ffmpeg, once a player asks for them.
+    The default track stays muxed into the video rendition.
+    """
+
+    def __init__(
+        self,
+        output_dir: Path,
+        source_url: str,
+        tracks: List[dict],
+        segment_duration: int,
+        audio_bitrate: str,
+        segment_format: str,
+        startup_timeout: int,
+    ):
+        self.output_dir = output_dir
+        self.source_url = source_url
+        self.tracks = tracks
+        self.segment_duration = segment_duration
+        self.audio_bitrate = audio_bitrate
+        self.segment_format = segment_format
+        self.startup_timeout = startup_timeout
+        self.procs: dict[int, asyncio.subprocess.Process] = {}
+        self.relaunches: dict[int, int] = {}
+        self._log_tasks: List[asyncio.Task] = []
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def playlist_name(position: int) -> str:
+        return f"audio_{position}.m3u8"
+
+    def media_lines(self) -> List[str]:
+        lines = []
+        for position, track in enumerate(self.tracks):
+            name = audio_track_name(track, position).replace('"', "'")
+            attrs = [
+                "TYPE=AUDIO",
+                'GROUP-ID="audio"',
+                f'NAME="{name}"',
+                f'LANGUAGE="{track.get("lang", "und")}"',
+                f'DEFAULT={"YES" if position == 0 else "NO"}',
+                f'AUTOSELECT={"YES" if position == 0 else "NO"}',
+            ]
+            # The default track has no URI: it is carried in the video rendition
+            if position > 0:
+                attrs.append(f'URI="{self.playlist_name(position)}"')
+            lines.append("#EXT-X-MEDIA:" + ",".join(attrs))
+        return lines
+
+    async def ensure(self, position: int) -> Path:
+        """Starts the track's encoder if needed (again, if it died) and waits for its playlist."""
+        playlist_path = self.output_dir / self.playlist_name(position)
+        async with self._lock:
+            proc = self.procs.get(position)
+            if proc is not None and proc.returncode not in (None, 0):
+                if self.relaunches.get(position, 0) >= AUDIO_RELAUNCHES:
+                    raise RuntimeError(f"Audio track {position} encode keeps failing (code {proc.returncode})")
+                self.relaunches[position] = self.relaunches.get(position, 0) + 1
+                print(f"Audio track {position} encode exited with code {proc.returncode}, restarting...")
+                del self.procs[position]
+            if position not in self.procs:
+                print(f"Audio track {position} requested, starting audio-only encode...")
+                cmd = build_audio_command(
+                    self.source_url,
+                    position,
+                    self.segment_duration,
+                    self.audio_bitrate,
+                    self.playlist_name(position),
+                    self.segment_format,
+                )
+                proc = await launch_ffmpeg(cmd, self.output_dir)
+                self.procs[position] = proc
+                self._log_tasks.extend([
+                    asyncio.create_task(pipe_progress(proc.stdout, f"ffmpeg-audio{position}", {})),
+                    asyncio.create_task(pipe_stream(proc.stderr, f"ffmpeg-audio{position}")),
+                ])
+        await wait_for_playlist(playlist_path, self.startup_timeout)
+        return playlist_path
+
+    async def stop(self) -> None:
+        for proc in self.procs.values():
+            if proc.returncode is None:
+                proc.terminate()
+                try:
+                    await asyncio.wait_for(proc.wait(), timeout=5)
+                except asyncio.TimeoutError:
+                    proc.kill()
+                    await proc.wait()
+        for task in self._log_tasks:
+            task.cancel()
+
+
+def build_subtitle_command(source_url: str, stream_index: int, output_path: Path, readrate: float) -> List[str]:
+    """
+    Subtitle-only conversion of one stream to WebVTT. The whole file is
+    demuxed to reach every cue, but no audio or video is decoded. Progress
+    goes to stdout, and every cue is flushed to the file as it is muxed.
+    """
+    headers_str = "".join(f"{k}: {v}\r\n" for k, v in HEADERS.items())
+    cmd = ["ffmpeg", "-y", "-loglevel", "error", "-nostats", "-progress", "pipe:1"]
+    if source_url.startswith("http"):
+        cmd.extend(["-headers", headers_str])
+    cmd.extend([
+        # Pace the read so the pass over the whole file doesn't take bandwidth from playback
+        "-readrate", str(readrate),
+        "-i", source_url,
+        "-map", f"0:{stream_index}",
+        "-vn", "-an", "-dn",
+        "-c:s", "webvtt",
+        "-flush_packets", "1",
+        "-f", "webvtt",
+        str(output_path),
+    ])
+    return cmd
+
+
+def vtt_seconds(stamp: str) -> float:
+    match = VTT_TIME.match(stamp.strip())
+    if match is None:
+        raise ValueError(f"Bad WebVTT timestamp {stamp!r}")
+    hours, minutes, seconds, millis = match.groups()
+    return int(hours or 0) * 3600 + int(minutes) * 60 + int(seconds) + int(millis) / 1000
+
+
+def parse_vtt_cues(text: str, complete: bool = True) -> List[tuple[float, float, str]]:
+    """
+    (start, end, block) for every cue of a WebVTT file. An incomplete file
+    (still being written) drops its last block, which may be cut short.
+    """
+    blocks = text.replace("\r\n", "\n").split("\n\n")
+    if not complete:
+        blocks = blocks[:-1]
+    cues = []
+    for block in blocks:
+        lines = block.strip("\n").split("\n")
+        timing = next((line for line in lines if "-->" in line), None)
+        if timing is None:
+            # The header, NOTE and STYLE blocks
+            continue
+        start, _, end = timing.partition("-->")
+        try:
+            cues.append((vtt_seconds(start), vtt_seconds(end.split()[0]), "\n".join(lines)))
+        except (ValueError, IndexError):
+            continue
+    return cues
+
+
+class SubtitleTracks:
+    """
+    Text subtitle streams advertised as a SUBTITLES group and converted to
+    WebVTT, by a separate subtitle-only ffmpeg, once a player asks for them.
+    The extraction reads the upstream directly, at a capped rate: it demuxes
+    the whole file, which would otherwise flush the relay's cache and compete
+    with playback. Each track's playlist lists SUBTITLE_CHUNK-second WebVTT
+    chunks, and a chunk is served as soon as the extraction has passed it.
+    Converted tracks are kept in the persistent cache, so a title played
+    again serves them without running ffmpeg at all.
+    """
+
+    def __init__(
+        self,
+        output_dir: Path,
+        source_url: str,
+        tracks: List[dict],
+        duration: float,
+        cache_dir: Path,
+        cache_key: str,
+        segment_format: str,
+        readrate: float = 8,
+    ):
+        self.output_dir = output_dir
+        self.source_url = source_url
+        self.tracks = tracks
+        self.duration = duration
+        self.cache_dir = cache_dir
+        self.cache_key = cache_key
+        self.segment_format = segment_format
+        self.readrate = readrate
+        self.chunks = max(1, math.ceil(duration / SUBTITLE_CHUNK))
+        self.procs: dict[int, asyncio.subprocess.Process] = {}
+        # Per track: ffmpeg's -progress values, out_time being how far the cues are written
+        self.progress: dict[int, dict] = {}
+        self._log_tasks: List[asyncio.Task] = []
+        self._lock = asyncio.Lock()
+        self.stats = {"tracks": len(tracks), "extracted": 0, "cache_hits": 0}
+
+    @staticmethod
+    def playlist_name(position: int) -> str:
+        return f"subtitles_{position}.m3u8"
+
+    @staticmethod
+    def chunk_name(position: int, chunk: int) -> str:
+        return f"subtitles_{position}_{chunk:05d}.vtt"
+
+    def chunk_span(self, chunk: int) -> tuple[float, float]:
+        start = chunk * SUBTITLE_CHUNK
+        return start, min(start + SUBTITLE_CHUNK, self.duration)
+
+    def cache_path(self, position: int) -> Path:
+        return self.cache_dir / f"{self.cache_key}.sub{self.tracks[position]['index']}.vtt"
+
+    def media_lines(self) -> List[str]:
+        lines = []
+        for position, track in enumerate(self.tracks):
+            name = audio_track_name(track, position, "Subtitles").replace('"', "'")
+            lines.append("#EXT-X-MEDIA:" + ",".join([
+                "TYPE=SUBTITLES",
+                'GROUP-ID="subs"',
+                f'NAME="{name}"',
+                f'LANGUAGE="{track.get("lang", "und")}"',
+                "DEFAULT=NO",
+                "AUTOSELECT=NO",
+                f'URI="{self.playlist_name(position)}"',
+            ]))
+        return lines
+
+    def write_playlists(self) -> None:
+        for position in range(len(self.tracks)):
+            lines = [
+                "#EXTM3U",
+                "#EXT-X-VERSION:3",
+                f"#EXT-X-TARGETDURATION:{SUBTITLE_CHUNK}",
+                "#EXT-X-MEDIA-SEQUENCE:0",
+                "#EXT-X-PLAYLIST-TYPE:VOD",
+            ]
+            for chunk in range(self.chunks):
+                start, end = self.chunk_span(chunk)
+                lines.append(f"#EXTINF:{end - start:.3f},")
+                lines.append(self.chunk_name(position, chunk))
+            lines.append("#EXT-X-ENDLIST")
+            (self.output_dir / self.playlist_name(position)).write_text("\n".join(lines) + "\n")
+
+    async def prefetch(self, position: int) -> None:
+        """Starts extraction when a player loads the track's playlist."""
+        async with self._lock:
+            if position in self.procs or self.cache_path(position).exists():
+                return
+            print(f"Subtitle track {position} requested, extracting to WebVTT...")
+            partial = self.cache_path(position).with_suffix(".partial")
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            cmd = build_subtitle_command(self.source_url, self.tracks[position]["index"], partial, self.readrate)
+            proc = await launch_ffmpeg(cmd, self.output_dir)
+            self.procs[position] = proc
+            self.progress[position] = {}
+            self._log_tasks.extend([
+                asyncio.create_task(pipe_progress(proc.stdout, f"ffmpeg-subs{position}", self.progress[position], log_interval=30)),
+                asyncio.create_task(pipe_stream(proc.stderr, f"ffmpeg-subs{position}")),
+                asyncio.create_task(self._finish(position, proc, partial)),
+            ])
+
+    async def _finish(self, position: int, proc: asyncio.subprocess.Process, partial: Path) -> None:
+        if await proc.wait() == 0:
+            os.replace(partial, self.cache_path(position))
+            self.stats["extracted"] += 1
+            print(f"Subtitle track {position} extracted and cached.")
+        else:
+            print(f"Subtitle extraction for track {position} failed with code {proc.returncode}.")
+            partial.unlink(missing_ok=True)
+            # The next request tries again
+            async with self._lock:
+                self.procs.pop(position, None)
+
+    def extracted_until(self, position: int) -> float:
+        """How far into the title the track's cues are on disk."""
+        if self.cache_path(position).exists():
+            return math.inf
+        proc = self.procs.get(position)
+        if proc is None:
+            return 0.0
+        if proc.returncode == 0:
+            # Done; _finish is about to move the file into the cache
+            return math.inf
+        # Output times only advance: every cue starting before out_time is written
+        return self.progress.get(position, {}).get("out_time", 0.0)
+
+    def chunk_ready(self, position: int, chunk: int) -> bool:
+        return self.extracted_until(position) >= self.chunk_span(chunk)[1]
+
+    async def render_vtt(self, position: int, chunk: int, wait: float = SUBTITLE_WAIT) -> str:
+        """Returns one chunk of the track, waiting up to wait seconds for the extraction to pass it."""
+        path = self.cache_path(position)
+        if path.exists() and position not in self.procs:
+            self.stats["cache_hits"] += 1
+        await self.prefetch(position)
+        elapsed = 0.0
+        while not self.chunk_ready(position, chunk):
+            if position not in self.procs:
+                raise RuntimeError("Subtitle extraction failed")
+            if elapsed >= wait:
+                raise TimeoutError("Subtitles are still being extracted")
+            await asyncio.sleep(0.25)
+            elapsed += 0.25
+        complete = path.exists()
+        if not complete:
+            path = path.with_suffix(".partial")
+        try:
+            text = path.read_text(encoding="utf-8", errors="replace")
+        except FileNotFoundError:
+            # Moved into the cache between the check and the read
+            path = self.cache_path(position)
+            text, complete = path.read_text(encoding="utf-8", errors="replace"), True
+        start, end = self.chunk_span(chunk)
+        # A cue crossing a chunk boundary goes in both; players drop the duplicate
+        cues = [block for cue_start, cue_end, block in parse_vtt_cues(text, complete) if cue_start < end and cue_end > start]
+        header = ["WEBVTT"]
+        if self.segment_format == "ts":
+            # Align cue times with the TS segments' clock
+            header.append(f"X-TIMESTAMP-MAP=MPEGTS:{TS_START_PTS},LOCAL:00:00:00.000")
+        return "\n\n".join(["\n".join(header), *cues]) + "\n"
+
+    async def stop(self) -> None:
+        for proc in self.procs.values():
+            if proc.returncode is None:
+                proc.terminate()
+                try:
+                    await asyncio.wait_for(proc.wait(), timeout=5)
+                except asyncio.TimeoutError:
+                    proc.kill()
+                    await proc.wait()
+        for task in self._log_tasks:
+            task.cancel()
+
+
+def write_master_playlist(
+    playlist_path: Path,
+    video_playlist: str,
+    video_bitrate: str,
+    audio_bitrate: str,
+    segment_format: str,
+    audio_renditions: AudioRenditions | None = None,
+    subtitles: SubtitleTracks | None = None,
+) -> None:
+    """Master playlist grouping the video rendition with alternate audio and subtitle tracks."""
+    lines = ["#EXTM3U", "#EXT-X-VERSION:7" if segment_format == "fmp4" else "#EXT-X-VERSION:4"]
+    stream_attrs = [f"BANDWIDTH={parse_bitrate(video_bitrate) + parse_bitrate(audio_bitrate)}"]
+    if audio_renditions is not None:
+        lines.extend(audio_renditions.media_lines())
+        stream_attrs.append('AUDIO="audio"')
+    if subtitles is not None:
+        lines.extend(subtitles.media_lines())
+        stream_attrs.append('SUBTITLES="subs"')
+    lines.append("#EXT-X-STREAM-INF:" + ",".join(stream_attrs))
+    lines.append(video_playlist)
+    playlist_path.write_text("\n".join(lines) + "\n")
+
+
+class ThumbnailSprites:
+    """
+    Trick-play previews. A side job decodes only keyframes at thumbnail size
+    and tiles them into sprite sheets described by a WebVTT track. It runs at
+    idle CPU priority and reads the upstream directly, so its pass over the
+    whole file doesn't evict what playback needs from the relay's cache.
+    Each sheet is served as soon as it is complete.
+    """
+
+    def __init__(
+        self,
+        output_dir: Path,
+        source_url: str,
+        duration: float | None,
+        video_info: dict | None,
+        interval: int = 10,
+        width: int = 160,
+        columns: int = 5,
+        rows: int = 5,
+        readrate: float = 8,
+    ):
+        self.output_dir = output_dir
+        self.source_url = source_url
+        self.duration = duration
+        self.interval = interval
+        self.width = width
+        self.columns = columns
+        self.rows = rows
+        self.readrate = readrate
+        aspect = 9 / 16
+        if video_info and video_info.get("width") and video_info.get("height"):
+            aspect = video_info["height"] / video_info["width"]
+        # Even height keeps the JPEG encoder's chroma subsampling happy
+        self.height = max(2, round(width * aspect / 2) * 2)
+        self.proc: asyncio.subprocess.Process | None = None
+        self._log_task: asyncio.Task | None = None
+
+    @staticmethod
+    def sheet_name(index: int) -> str:
+        return f"thumbs_{index:05d}.jpg"
+
+    async def start(self) -> None:
+        if self.proc is not None:
+            return
+        cmd = build_thumbnail_command(
+            self.source_url,
+            self.interval,
+            self.width,
+            self.height,
+            self.columns,
+            self.rows,
+            self.readrate,
+        )
+        self.proc = await launch_ffmpeg(cmd, self.output_dir)
+        apply_idle_priority(self.proc.pid)
+        self._log_task = asyncio.create_task(pipe_stream(self.proc.stderr, "ffmpeg-thumbs"))
+
+    def completed_sheets(self) -> int:
+        # Written atomically: a sheet that exists is complete
+        count = 0
+        while (self.output_dir / self.sheet_name(count)).exists():
+            count += 1
+        return count
+
+    def render_vtt(self) -> str:
+        per_sheet = self.columns * self.rows
+        if self.duration:
+            total = math.ceil(self.duration / self.interval)
+        else:
+            total = self.completed_sheets() * per_sheet
+
+        def stamp(seconds: float) -> str:
+            hours, rest = divmod(seconds, 3600)
+            minutes, secs = divmod(rest, 60)
+            return f"{int(hours):02d}:{int(minutes):02d}:{secs:06.3f}"
+
+        # Cues for sheets that don't exist yet are fine: the player retries
+        # the image on the next hover, by which time it may be there
+        lines = ["WEBVTT", ""]
+        for index in range(total):
+            start = index * self.interval
+            end = min(start + self.interval, self.duration) if self.duration else start + self.interval
+            sheet, tile = divmod(index, per_sheet)
+            row, column = divmod(tile, self.columns)
+            lines.append(f"{stamp(start)} --> {stamp(end)}")
+            lines.append(f"{self.sheet_name(sheet)}#xywh={column * self.width},{row * self.height},{self.width},{self.height}")
+            lines.append("")
+        return "\n".join(lines)
+
+    @property
+    def stats(self) -> dict:
+        return {"sheets": self.completed_sheets(), "interval": self.interval}
+
+    async def stop(self) -> None:
+        if self.proc is not None and self.proc.returncode is None:
+            self.proc.terminate()
+            try:
+                await asyncio.wait_for(self.proc.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                self.proc.kill()
+                await self.proc.wait()
+        if self._log_task is not None:
+            self._log_task.cancel()
+
+
 async def pipe_stream(stream: asyncio.StreamReader | None, prefix: str) -> None:
     if stream is None:
         return
@@ -573,6 +1318,40 @@ async def pipe_stream(stream: asyncio.StreamReader | None, prefix: str) -> None:
         pass
 
 
+async def pipe_progress(stream: asyncio.StreamReader | None, prefix: str, stats: dict, log_interval: float = 10) -> None:
+    """
+    Consumes ffmpeg's -progress output, keeping the latest values in stats
+    and logging a compact status line every log_interval seconds.
+    """
+    if stream is None:
+        return
+    last_log = 0.0
+    try:
+        while True:
+            line = await stream.readline()
+            if not line:
+                break
+            key, _, value = line.decode(errors="ignore").strip().partition("=")
+            if key == "speed":
+                try:
+                    stats["speed"] = float(value.rstrip("x"))
+                except ValueError:
+                    pass
+            elif key == "out_time_us":
+                try:
+                    stats["out_time"] = int(value) / 1_000_000
+                except ValueError:
+                    pass
+            elif key == "fps":
+                stats["fps"] = value
+            elif key == "progress":
+                if time.time() - last_log >= log_interval or value == "end":
+                    last_log = time.time()
+                    print(f"[{prefix}] time={stats.get('out_time', 0):.1f}s fps={stats.get('fps', '?')} speed={stats.get('speed', '?')}x")
+    except asyncio.CancelledError:
+        pass
+
+
 async def wait_for_playlist(playlist_path: Path, timeout: int) -> None:
     elapsed = 0.0
     interval = 0.25
@@ -584,22 +1363,399 @@ async def wait_for_playlist(playlist_path: Path, timeout: int) -> None:
     raise TimeoutError("Timed out waiting for HLS playlist to be generated")
 
 
+async def launch_ffmpeg(cmd: List[str], cwd: Path, stdin=None) -> asyncio.subprocess.Process:
+    try:
+        return await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=stdin,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            cwd=str(cwd)
+        )
+    except FileNotFoundError as exc:
+        raise RuntimeError(
+            "ffmpeg binary not found. Install it and ensure it is available on PATH."
+        ) from exc
 
-def create_app(hls_dir: Path, playlist_name: str, source_url: str, using_gpu: bool, idle_manager: IdleTimeout) -> web.Application:
-    @web.middleware
-    async def cors_middleware(request, handler):
-        response = await handler(request)
+
+def read_media_playlist(path: Path) -> tuple[List[str], List[str], bool]:
+    """
+    Splits an ffmpeg media playlist into (header lines, segment lines, ended).
+    Segment lines keep their tags (EXTINF, BYTERANGE, MAP...) next to the URI.
+    """
+    if not path.exists():
+        return [], [], False
+    lines = [line.strip() for line in path.read_text(errors="ignore").splitlines() if line.strip()]
+    header: List[str] = []
+    segments: List[str] = []
+    pending: List[str] = []
+    ended = False
+    for line in lines:
+        if line == "#EXT-X-ENDLIST":
+            ended = True
+        elif line.startswith("#EXTM3U") or line.startswith(("#EXT-X-VERSION", "#EXT-X-TARGETDURATION", "#EXT-X-MEDIA-SEQUENCE", "#EXT-X-PLAYLIST-TYPE", "#EXT-X-INDEPENDENT-SEGMENTS")):
+            if not segments and not pending:
+                header.append(line)
+        elif line.startswith("#"):
+            pending.append(line)
+        else:
+            # A URI closes the segment; ffmpeg writes the playlist atomically so
+            # we never see a tag without its URI except at the very end
+            segments.extend(pending)
+            segments.append(line)
+            pending = []
+    return header, segments, ended
+
+
+class FastStartPlaylist:
+    """
+    Stitches the low-cost startup rendition and the full-quality rendition
+    into the single playlist the player loads, with a discontinuity at the
+    hand-over point.
+    """
+
+    def __init__(self, output_dir: Path, playlist_name: str, startup_name: str, main_name: str):
+        self.output_dir = output_dir
+        self.playlist_path = output_dir / playlist_name
+        self.startup_path = output_dir / startup_name
+        self.main_path = output_dir / main_name
+
+    def startup_ready(self) -> bool:
+        _, segments, _ = read_media_playlist(self.startup_path)
+        return any(not line.startswith("#") for line in segments)
+
+    def render(self) -> str | None:
+        startup_header, startup_segments, startup_ended = read_media_playlist(self.startup_path)
+        if not startup_segments:
+            return None
+
+        target_duration = 0
+        version = 3
+        for line in startup_header:
+            if line.startswith("#EXT-X-TARGETDURATION:"):
+                target_duration = max(target_duration, int(line.split(":", 1)[1]))
+            elif line.startswith("#EXT-X-VERSION:"):
+                # fMP4 renditions need version 7 for EXT-X-MAP
+                version = max(version, int(line.split(":", 1)[1]))
+
+        body = list(startup_segments)
+        ended = False
+        if startup_ended:
+            main_header, main_segments, ended = read_media_playlist(self.main_path)
+            for line in main_header:
+                if line.startswith("#EXT-X-TARGETDURATION:"):
+                    target_duration = max(target_duration, int(line.split(":", 1)[1]))
+            if main_segments:
+                body.append("#EXT-X-DISCONTINUITY")
+                body.extend(main_segments)
+
+        lines = [
+            "#EXTM3U",
+            f"#EXT-X-VERSION:{version}",
+            f"#EXT-X-TARGETDURATION:{target_duration or 1}",
+            "#EXT-X-MEDIA-SEQUENCE:0",
+            *body,
+        ]
+        if ended:
+            lines.append("#EXT-X-ENDLIST")
+        return "\n".join(lines) + "\n"
+
+    def write(self) -> None:
+        content = self.render()
+        if content is None:
+            return
+        # Replace atomically so the static handler never serves a half-written file
+        tmp_path = self.playlist_path.with_suffix(".tmp")
+        tmp_path.write_text(content)
+        os.replace(tmp_path, self.playlist_path)
+
+    async def run(self, stop_event: asyncio.Event, interval: float = 0.5) -> None:
+        while not stop_event.is_set():
+            try:
+                self.write()
+            except OSError as e:
+                print(f"Warning: Could not update fast-start playlist ({e})")
+            await asyncio.sleep(interval)
+
+
+
+# Segments per VOD job: keeps the -force_key_frames/-segment_times lists short
+VOD_JOB_SPAN = 150
+# How far ahead of a job's progress a request may be before it starts another job
+VOD_LOOKAHEAD = 3
+# Concurrent jobs, so viewers at different positions don't keep killing each
+# other's encode. They split the session's lease threads between them, never
+# below VOD_JOB_MIN_THREADS each, so a small lease runs fewer jobs.
+VOD_MAX_JOBS = 3
+VOD_JOB_MIN_THREADS = 2
+# A job a viewer waited on this recently is never stopped to make room for another
+VOD_JOB_ACTIVE = 5
+
+
+class VodJob:
+    """One ffmpeg process encoding segments [first, last) of the plan."""
+
+    def __init__(self, name: str, first: int, last: int, proc: asyncio.subprocess.Process, requested: float):
+        self.name = name
+        self.first = first
+        self.last = last
+        self.proc = proc
+        # Last time a viewer waited on this job; the stalest job is the one replaced
+        self.requested = requested
+        self.stopped = False
+        self.error: int | None = None
+
+    def running(self) -> bool:
+        return self.proc.returncode is None
+
+
+class VodSession:
+    """
+    Serves a complete VOD playlist cut on the source's keyframes, so the
+    player knows the exact duration up front and can seek anywhere.
+
+    Segments are produced by ffmpeg jobs covering a span of the plan. A
+    request for a segment no running job will reach soon starts another job
+    there; every planned segment starts on a source keyframe, so the job's
+    -ss lands on it without decoding frames only to drop them. Up to
+    max_jobs run at once, so viewers at different positions of the same
+    title each keep theirs; beyond that the job nobody asked for the longest
+    is stopped, unless it was asked for in the last VOD_JOB_ACTIVE seconds,
+    in which case the new position waits for a slot. With a single slot the
+    job is always replaced, as a seek has nowhere else to go. Each job writes
+    its own files, so a segment being served is never rewritten by another job.
+    """
+
+    def __init__(
+        self,
+        output_dir: Path,
+        plan: List[tuple[float, float]],
+        launch: Callable[[int, int, bool, str], Awaitable[asyncio.subprocess.Process]],
+        segment_timeout: int,
+        span: int = VOD_JOB_SPAN,
+        lookahead: int = VOD_LOOKAHEAD,
+        max_jobs: int = VOD_MAX_JOBS,
+    ):
+        self.output_dir = output_dir
+        self.plan = plan
+        self.launch = launch
+        self.segment_timeout = segment_timeout
+        self.span = span
+        self.lookahead = lookahead
+        self.max_jobs = max(1, max_jobs)
+        # Segment index -> file of the job that finished it first
+        self.ready: dict[int, str] = {}
+        self.jobs: List[VodJob] = []
+        # Jobs stop chaining at this segment until release() (prepared sessions)
+        self.hold_at: int | None = None
+        self.error: int | None = None
+        self.stats = {"segments": len(plan), "ready": 0, "restarts": 0, "jobs": 0}
+        self._serial = 0
+        self._tasks: List[asyncio.Task] = []
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def segment_name(index: int) -> str:
+        return f"seg_{index:05d}.ts"
+
+    @staticmethod
+    def job_playlist(name: str) -> str:
+        return f"{name}.m3u8"
+
+    @staticmethod
+    def job_segment_pattern(name: str) -> str:
+        return f"{name}_%05d.ts"
+
+    @property
+    def procs(self) -> List[asyncio.subprocess.Process]:
+        return [job.proc for job in self.jobs if job.running()]
+
+    def write_playlist(self, playlist_path: Path, discontinuity_at: int = 0) -> None:
+        target_duration = math.ceil(max(duration for _, duration in self.plan))
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:3",
+            f"#EXT-X-TARGETDURATION:{target_duration}",
+            "#EXT-X-MEDIA-SEQUENCE:0",
+            "#EXT-X-PLAYLIST-TYPE:VOD",
+        ]
+        for index, (_, duration) in enumerate(self.plan):
+            # The fast-start span is encoded with a different profile
+            if index and index == discontinuity_at:
+                lines.append("#EXT-X-DISCONTINUITY")
+            lines.append(f"#EXTINF:{duration:.6f},")
+            lines.append(self.segment_name(index))
+        lines.append("#EXT-X-ENDLIST")
+        playlist_path.write_text("\n".join(lines) + "\n")
+
+    def refresh(self) -> None:
+        """Picks up segments the jobs have finished."""
+        for job in self.jobs:
+            _, segments, _ = read_media_playlist(self.output_dir / self.job_playlist(job.name))
+            for line in segments:
+                if not line.startswith("#"):
+                    self.ready.setdefault(int(Path(line).stem.rsplit("_", 1)[1]), line)
+        self.stats["ready"] = len(self.ready)
+        self.stats["jobs"] = sum(1 for job in self.jobs if job.running())
+
+    def head(self, job: VodJob) -> int:
+        """Last segment of the job's span that is ready, or the one before its first."""
+        index = job.first - 1
+        while index + 1 in self.ready and index + 1 < job.last:
+            index += 1
+        return index
+
+    def next_missing(self, start: int) -> int | None:
+        return next((index for index in range(start, len(self.plan)) if index not in self.ready), None)
+
+    def running(self) -> bool:
+        return any(job.running() for job in self.jobs)
+
+    def _job_for(self, index: int) -> VodJob | None:
+        """The running job that will reach index soon, if any."""
+        return next(
+            (job for job in self.jobs if job.running() and job.first <= index < job.last and index - self.head(job) <= self.lookahead),
+            None,
+        )
+
+    async def start(self, first: int, cheap: bool = False, last: int | None = None) -> None:
+        async with self._lock:
+            await self._start(first, cheap, last)
+
+    async def _start(self, first: int, cheap: bool = False, last: int | None = None, requested: float | None = None) -> bool:
+        """Starts a job at first; False if every slot is busy with a watched job."""
+        running = [job for job in self.jobs if job.running()]
+        while len(running) >= self.max_jobs:
+            stalest = min(running, key=lambda job: job.requested)
+            if self.max_jobs > 1 and time.monotonic() - stalest.requested < VOD_JOB_ACTIVE:
+                return False
+            running.remove(stalest)
+            await self._stop_job(stalest)
+        end = min(len(self.plan), last or first + self.span)
+        # Stop short of segments that are done or that another job starts at
+        end = next((index for index in range(first, end) if index in self.ready), end)
+        end = min([end] + [job.first for job in running if job.first > first])
+        self._serial += 1
+        name = f"job_{self._serial:04d}"
+        self.error = None
+        proc = await self.launch(first, end, cheap, name)
+        job = VodJob(name, first, end, proc, requested or time.monotonic())
+        self.jobs.append(job)
+        self._tasks.append(asyncio.create_task(self._follow(job)))
+        return True
+
+    async def _stop_job(self, job: VodJob) -> None:
+        # Mark first so _follow doesn't mistake the termination for a failure
+        job.stopped = True
+        if job.running():
+            job.proc.terminate()
+            try:
+                await asyncio.wait_for(job.proc.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                job.proc.kill()
+                await job.proc.wait()
+        self.refresh()
+
+    async def _follow(self, job: VodJob) -> None:
+        returncode = await job.proc.wait()
+        if job.stopped:
+            return
+        self.refresh()
+        if returncode != 0:
+            print(f"ffmpeg exited with code {returncode}.")
+            job.error = self.error = returncode
+            return
+        # Chain the next job; the session lives on until it goes idle
+        upcoming = self.next_missing(job.last)
+        if upcoming is None:
+            # Gaps left behind by seeks are filled when they are requested
+            if self.next_missing(0) is None:
+                print("All segments encoded.")
+            return
+        if self.hold_at is not None and upcoming >= self.hold_at:
+            return
+        async with self._lock:
+            # Another viewer's job may already be on its way there
+            if not job.stopped and self._job_for(upcoming) is None and not any(
+                other.running() and other.first <= upcoming < other.last for other in self.jobs
+            ):
+                await self._start(upcoming, requested=job.requested)
+
+    async def release(self) -> None:
+        """Lifts the prepare hold and resumes encoding."""
+        self.hold_at = None
+        async with self._lock:
+            if not self.running():
+                upcoming = self.next_missing(max((job.last for job in self.jobs), default=0))
+                if upcoming is not None:
+                    await self._start(upcoming)
+
+    async def segment_path(self, index: int) -> Path:
+        """Waits for a segment, starting a job there if nothing will reach it soon."""
+        if not 0 <= index < len(self.plan):
+            raise IndexError(index)
+        elapsed = 0.0
+        while elapsed < self.segment_timeout:
+            self.refresh()
+            if index in self.ready:
+                return self.output_dir / self.ready[index]
+            failed = next((job for job in self.jobs if job.first == index and job.error is not None), None)
+            if failed is not None:
+                # Let the next request retry instead of relaunching in a tight loop
+                self.jobs.remove(failed)
+                self.error = None
+                raise RuntimeError(f"ffmpeg failed to encode segment {index}")
+            async with self._lock:
+                job = self._job_for(index)
+                if job is not None:
+                    job.requested = time.monotonic()
+                elif index not in self.ready and await self._start(index):
+                    print(f"Seek: started an encode at segment {index} ({self.plan[index][0]:.3f}s)")
+                    self.stats["restarts"] += 1
+            await asyncio.sleep(0.1)
+            elapsed += 0.1
+        raise TimeoutError(f"Segment {index} not ready after {self.segment_timeout}s")
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        async with self._lock:
+            for job in self.jobs:
+                await self._stop_job(job)
+
+
+def create_app(
+    hls_dir: Path,
+    playlist_name: str,
+    source_url: str,
+    using_gpu: bool,
+    idle_manager: IdleTimeout,
+    session_stats: dict | None = None,
+    audio_renditions: AudioRenditions | None = None,
+    on_play: Callable[[], Awaitable[None]] | None = None,
+    vod_session: VodSession | None = None,
+    thumbnails: ThumbnailSprites | None = None,
+    serve_workers: ServeWorkers | None = None,
+    direct_relay: UpstreamRelay | None = None,
+    subtitles: SubtitleTracks | None = None,
+    egress: EgressScheduler | None = None,
+) -> web.Application:
+    # On prepare rather than in a middleware: streamed responses send their headers inside the handler
+    async def add_cors_headers(_: web.Request, response: web.StreamResponse) -> None:
         response.headers['Access-Control-Allow-Origin'] = '*'
         response.headers['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
-        response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
-        return response
+        response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Range'
+        response.headers['Access-Control-Expose-Headers'] = 'Content-Length, Content-Range, Accept-Ranges'
 
     @web.middleware
     async def idle_middleware(request, handler):
-        idle_manager.update()
+        # Activity reports count only from the workers themselves
+        if request.path != "/workers/activity" or is_loopback(request.remote):
+            idle_manager.update()
         return await handler(request)
 
-    app = web.Application(middlewares=[cors_middleware, idle_middleware])
+    app = web.Application(middlewares=[idle_middleware])
+    app.on_response_prepare.append(add_cors_headers)
     playlist_url = f"/hls/{playlist_name}"
     
     gpu_status_html = ""
@@ -607,17 +1763,29 @@ def create_app(hls_dir: Path, playlist_name: str, source_url: str, using_gpu: bo
         gpu_status_html = '<p style="color: #4ade80; margin-top: 0.5rem; font-weight: bold;">🎬 GPU-accelerated streaming</p>'
 
     async def index(_: web.Request) -> web.Response:
+        if on_play is not None:
+            await on_play()
         return web.Response(
             text=HTML_TEMPLATE.format(
                 source_url=source_url, 
                 playlist_url=playlist_url,
-                gpu_status=gpu_status_html
+                gpu_status=gpu_status_html,
+                thumbnails_enabled="true" if thumbnails is not None else "false",
             ),
             content_type="text/html",
         )
 
     async def health(_: web.Request) -> web.Response:
-        return web.json_response({"status": "ok", "source": source_url, "playlist": playlist_url})
+        return web.json_response({
+            "status": "ok",
+            "source": source_url,
+            "playlist": playlist_url,
+            **(session_stats or {}),
+            "thumbnails": thumbnails.stats if thumbnails is not None else None,
+            "subtitles": subtitles.stats if subtitles is not None else None,
+            "serving": serve_workers.stats if serve_workers is not None else None,
+            "egress": egress.stats if egress is not None else None,
+        })
 
     async def shutdown(_: web.Request) -> web.Response:
         try:
@@ -634,6 +1802,103 @@ def create_app(hls_dir: Path, playlist_name: str, source_url: str, using_gpu: bo
             traceback.print_exc()
             return web.json_response({"status": "error", "message": str(e)}, status=500)
 
+    async def play(_: web.Request) -> web.Response:
+        if on_play is not None:
+            await on_play()
+        return web.json_response({"status": "playing"})
+
+    async def audio_playlist(request: web.Request) -> web.StreamResponse:
+        position = int(request.match_info["position"])
+        if audio_renditions is None:
+            # Pre-transcoded packages ship their audio playlists as plain files
+            playlist_path = hls_dir / AudioRenditions.playlist_name(position)
+            if not playlist_path.exists():
+                raise web.HTTPNotFound()
+            return web.FileResponse(playlist_path)
+        if not 0 < position < len(audio_renditions.tracks):
+            raise web.HTTPNotFound()
+        try:
+            playlist_path = await audio_renditions.ensure(position)
+        except TimeoutError:
+            raise web.HTTPServiceUnavailable(text="Audio track is still starting")
+        except RuntimeError as e:
+            raise web.HTTPBadGateway(text=str(e))
+        return web.FileResponse(playlist_path, headers={"Cache-Control": "no-cache"})
+
+    async def vod_segment(request: web.Request) -> web.StreamResponse:
+        if vod_session is None:
+            raise web.HTTPNotFound()
+        index = int(request.match_info["index"])
+        try:
+            segment_path = await vod_session.segment_path(index)
+        except IndexError:
+            raise web.HTTPNotFound()
+        except (TimeoutError, RuntimeError) as e:
+            raise web.HTTPServiceUnavailable(text=str(e))
+        if egress is not None:
+            return await egress.serve(request, segment_path, VodSession.segment_name(index))
+        return web.FileResponse(segment_path)
+
+    async def media_file(request: web.Request) -> web.StreamResponse:
+        name = request.match_info["name"]
+        if name.startswith("."):
+            raise web.HTTPNotFound()
+        return await egress.serve(request, hls_dir / name)
+
+    async def subtitle_playlist(request: web.Request) -> web.StreamResponse:
+        position = int(request.match_info["position"])
+        if subtitles is None or not 0 <= position < len(subtitles.tracks):
+            raise web.HTTPNotFound()
+        # Extraction reads the whole source, so get it going before the cues are asked for
+        await subtitles.prefetch(position)
+        return web.FileResponse(hls_dir / subtitles.playlist_name(position))
+
+    async def subtitle_track(request: web.Request) -> web.StreamResponse:
+        position = int(request.match_info["position"])
+        chunk = int(request.match_info["chunk"])
+        if subtitles is None or not 0 <= position < len(subtitles.tracks) or not 0 <= chunk < subtitles.chunks:
+            raise web.HTTPNotFound()
+        if subtitles.chunk_ready(position, chunk):
+            return web.Response(text=await subtitles.render_vtt(position, chunk), content_type="text/vtt")
+        # Still extracting: answer with headers right away so the player's
+        # time-to-first-byte timeout doesn't fire, and send the cues when done
+        response = web.StreamResponse()
+        response.content_type = "text/vtt"
+        response.charset = "utf-8"
+        await response.prepare(request)
+        try:
+            text = await subtitles.render_vtt(position, chunk)
+        except (TimeoutError, RuntimeError) as e:
+            # Too late for an error status: a dropped connection makes the player retry
+            print(f"Subtitle track {position}: {e}")
+            if request.transport is not None:
+                request.transport.close()
+            return response
+        await response.write(text.encode("utf-8"))
+        await response.write_eof()
+        return response
+
+    async def thumbnails_vtt(_: web.Request) -> web.Response:
+        if thumbnails is None:
+            raise web.HTTPNotFound()
+        return web.Response(text=thumbnails.render_vtt(), content_type="text/vtt", headers={"Cache-Control": "no-cache"})
+
+    async def thumbnail_sheet(request: web.Request) -> web.StreamResponse:
+        index = int(request.match_info["index"])
+        # Only whole sheets: the one ffmpeg is still writing would be truncated
+        if thumbnails is None or index >= thumbnails.completed_sheets():
+            raise web.HTTPNotFound()
+        return web.FileResponse(hls_dir / thumbnails.sheet_name(index))
+
+    async def worker_activity(request: web.Request) -> web.Response:
+        # Workers report over loopback; from anywhere else this would keep the session alive
+        if not is_loopback(request.remote):
+            raise web.HTTPForbidden()
+        # Reaching this handler already reset the idle timer
+        if serve_workers is not None:
+            serve_workers.report(await request.json())
+        return web.Response(status=204)
+
     async def handle_options(_: web.Request) -> web.Response:
         return web.Response(status=204, headers={
             'Access-Control-Allow-Origin': '*',
@@ -645,7 +1910,23 @@ def create_app(hls_dir: Path, playlist_name: str, source_url: str, using_gpu: bo
     app.router.add_get("/", index)
     app.router.add_get("/health", health)
     app.router.add_post("/shutdown", shutdown)
+    app.router.add_post("/play", play)
+    app.router.add_post("/workers/activity", worker_activity)
     app.router.add_route('OPTIONS', '/{tail:.*}', handle_options)
+    # Registered before the static route so first requests can start the encode
+    app.router.add_get(r"/hls/audio_{position:\d+}.m3u8", audio_playlist)
+    app.router.add_get(r"/hls/seg_{index:\d+}.ts", vod_segment)
+    app.router.add_get(r"/hls/subtitles_{position:\d+}.m3u8", subtitle_playlist)
+    app.router.add_get(r"/hls/subtitles_{position:\d+}_{chunk:\d+}.vtt", subtitle_track)
+    app.router.add_get("/hls/thumbnails.vtt", thumbnails_vtt)
+    app.router.add_get(r"/hls/thumbs_{index:\d+}.jpg", thumbnail_sheet)
+    if direct_relay is not None:
+        # Direct play: the browser's Range requests go straight to the relay
+        app.router.add_route("GET", f"/hls/{DIRECT_PLAY_NAME}", direct_relay.handle)
+        app.router.add_route("HEAD", f"/hls/{DIRECT_PLAY_NAME}", direct_relay.handle)
+    if egress is not None:
+        # Media goes through the egress scheduler; playlists, cues and sprites stay static
+        app.router.add_get(r"/hls/{name:[^/]+\.(?:ts|mp4|m4s)}", media_file)
     app.router.add_static("/hls/", path=str(hls_dir), show_index=False)
     return app
 
@@ -654,7 +1935,17 @@ def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(
         description="Transcode any remote video/audio URL to browser-friendly HLS for in-browser playback.",
     )
-    parser.add_argument("--url", required=True, help="Remote HTTPS/HTTP media URL to relay")
+    parser.add_argument("--url", help="Remote HTTPS/HTTP media URL to relay")
+    parser.add_argument(
+        "--batch",
+        help="Pre-transcode the URLs listed in this file ('-' reads a queue from stdin) into the package cache, then exit",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=2,
+        help="Concurrent ffmpeg jobs in --batch mode",
+    )
     parser.add_argument("--host", default="127.0.0.1", help="Local interface to bind")
     parser.add_argument("--port", type=int, default=8000, help="Port to expose the proxy on")
     parser.add_argument(
@@ -675,8 +1966,7 @@ def parse_args() -> argparse.Namespace:
     )
     parser.add_argument(
         "--preset",
-        default="ultrafast",
-        help="x264 preset controlling CPU vs. compression efficiency",
+        help="x264 preset controlling CPU vs. compression efficiency (default: calibrated, else ultrafast)",
     )
     parser.add_argument(
         "--startup-timeout",
@@ -702,7 +1992,597 @@ def parse_args() -> argparse.Namespace:
         default=300, # 5 minutes default
         help="Seconds of inactivity before shutting down",
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--fast-start",
+        type=float,
+        default=0,
+        help="Seconds to encode with the cheap startup profile before switching to full quality (0 disables)",
+    )
+    parser.add_argument(
+        "--fast-start-height",
+        type=int,
+        default=480,
+        help="Output height of the fast-start rendition",
+    )
+    parser.add_argument(
+        "--fast-start-bitrate",
+        default="1000k",
+        help="Video bitrate of the fast-start rendition",
+    )
+    parser.add_argument(
+        "--segment-format",
+        choices=["ts", "fmp4"],
+        default="ts",
+        help="HLS segment container: one .ts file per segment, or a single byte-range addressed fMP4 file",
+    )
+    parser.add_argument(
+        "--hevc-passthrough",
+        action="store_true",
+        help="The client decodes HEVC; copy HEVC video instead of re-encoding (implies fmp4)",
+    )
+    parser.add_argument(
+        "--no-relay",
+        action="store_true",
+        help="Let ffprobe/ffmpeg read the upstream directly instead of through the local caching relay",
+    )
+    parser.add_argument(
+        "--mirror",
+        action="append",
+        help="Another URL serving the same file; raced against --url (repeatable)",
+    )
+    parser.add_argument(
+        "--header-profile",
+        action="append",
+        help="Header set to race: 'none', 'browser' or a JSON dict; --headers is always raced as 'default' (repeatable)",
+    )
+    parser.add_argument(
+        "--switch-below-mbps",
+        type=float,
+        default=0,
+        help="Move the relay to the runner-up candidate when upstream throughput stays below this (0 disables)",
+    )
+    parser.add_argument(
+        "--relay-memory-mb",
+        type=int,
+        default=64,
+        help="Memory for the relay's chunk cache",
+    )
+    parser.add_argument(
+        "--relay-disk-mb",
+        type=int,
+        default=2048,
+        help="Disk space for the relay's chunk cache (inside the session temp dir)",
+    )
+    parser.add_argument(
+        "--read-ahead-mb",
+        type=int,
+        default=32,
+        help="Jitter buffer: how far the relay keeps fetching ahead of each reader (0 disables)",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=Path,
+        default=CACHE_DIR,
+        help="Persistent cache for probe results and keyframe indexes",
+    )
+    parser.add_argument(
+        "--keyframe-scan",
+        action="store_true",
+        help="Index keyframes with a background ffprobe pass when the container has no cues (reads the whole file once)",
+    )
+    parser.add_argument(
+        "--no-vod",
+        action="store_true",
+        help="Don't serve the keyframe-planned VOD playlist even when an index is available",
+    )
+    parser.add_argument(
+        "--thumbnails",
+        action="store_true",
+        help="Generate seek-preview sprite sheets in an idle-priority side job",
+    )
+    parser.add_argument(
+        "--thumbnail-interval",
+        type=int,
+        default=10,
+        help="Seconds of video per preview thumbnail",
+    )
+    parser.add_argument(
+        "--thumbnail-readrate",
+        type=float,
+        default=8,
+        help="Cap the preview job's read speed to this multiple of real time",
+    )
+    parser.add_argument(
+        "--subtitle-readrate",
+        type=float,
+        default=8,
+        help="Cap subtitle extraction's read speed to this multiple of real time",
+    )
+    parser.add_argument(
+        "--prepare",
+        type=int,
+        default=0,
+        help="Warm the session: encode only this many segments at prepare priority until /play is called",
+    )
+    parser.add_argument(
+        "--prepare-ttl",
+        type=int,
+        default=120,
+        help="Seconds a prepared session that nobody plays stays alive",
+    )
+    parser.add_argument(
+        "--priority",
+        choices=list(PRIORITIES),
+        default="play",
+        help="Scheduling class of this session; playback always wins over prepare/background work",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        help="Encoder threads to request from the scheduler (default: calibrated, else 4)",
+    )
+    parser.add_argument(
+        "--cpu-budget",
+        type=int,
+        default=None,
+        help="Cores shared by all transcodes on this host (defaults to the CPU count)",
+    )
+    parser.add_argument(
+        "--max-gpu-sessions",
+        type=int,
+        default=3,
+        help="Concurrent hardware encoder sessions before new jobs fall back to CPU",
+    )
+    parser.add_argument(
+        "--cpu-affinity",
+        action="store_true",
+        help="Pin each transcode to its own cores (Linux only)",
+    )
+    parser.add_argument(
+        "--queue-timeout",
+        type=float,
+        default=10,
+        help="Seconds a playing session waits for capacity before starting degraded",
+    )
+    parser.add_argument(
+        "--degraded-height",
+        type=int,
+        default=720,
+        help="Output height used when the scheduler admits a session degraded",
+    )
+    parser.add_argument(
+        "--no-direct-play",
+        action="store_true",
+        help="Always transcode, even when the source is a fast-start MP4 the browser could play as is",
+    )
+    parser.add_argument(
+        "--serve-workers",
+        type=int,
+        default=1,
+        help="Processes serving HTTP on the shared port (SO_REUSEPORT); only the first runs ffmpeg",
+    )
+    parser.add_argument(
+        "--uvloop",
+        action="store_true",
+        help="Run the event loop on uvloop when it is installed",
+    )
+    parser.add_argument(
+        "--egress-mbps",
+        type=float,
+        default=0,
+        help="Uplink budget for media segments; within it, segments near a viewer's playhead go before read-ahead (0 disables)",
+    )
+    parser.add_argument(
+        "--client-mbps",
+        type=float,
+        default=0,
+        help="Cap on each viewer's segment download rate (0 disables)",
+    )
+    args = parser.parse_args()
+    if not args.url and not args.batch:
+        parser.error("one of --url or --batch is required")
+    return args
+
+
+DIRECT_PLAY_NAME = "source.mp4"
+PACKAGES_DIR = "packages"
+PACKAGE_MANIFEST = "package.json"
+
+
+async def source_size(url: str) -> int | None:
+    """The upstream size as the relay would learn it, so batch and live sessions agree on cache keys."""
+    try:
+        async with aiohttp.ClientSession(headers=HEADERS, timeout=aiohttp.ClientTimeout(total=15)) as session:
+            async with session.get(url, headers={"Range": "bytes=0-0"}) as resp:
+                total = resp.headers.get("Content-Range", "").rpartition("/")[2]
+                return int(total) if resp.status == 206 and total.isdigit() else None
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        return None
+
+
+def encoded_extent(playlist_path: Path) -> tuple[float, int]:
+    """(seconds, segments) listed in a media playlist ffmpeg is writing."""
+    _, segments, _ = read_media_playlist(playlist_path)
+    seconds = sum(float(line.split(":", 1)[1].split(",")[0]) for line in segments if line.startswith("#EXTINF:"))
+    return seconds, sum(1 for line in segments if not line.startswith("#"))
+
+
+def finalize_package(work_dir: Path, tracks: List[dict], args: argparse.Namespace) -> int:
+    """Writes the VOD playlists of a finished encode; returns the segment count."""
+    header, segments, _ = read_media_playlist(work_dir / "video_encode.m3u8")
+    video_playlist = "video.m3u8" if len(tracks) > 1 else "stream.m3u8"
+    lines = [line for line in header if not line.startswith("#EXT-X-PLAYLIST-TYPE")]
+    lines.append("#EXT-X-PLAYLIST-TYPE:VOD")
+    lines.extend(segments)
+    lines.append("#EXT-X-ENDLIST")
+    (work_dir / video_playlist).write_text("\n".join(lines) + "\n")
+    if len(tracks) > 1:
+        audio_renditions = AudioRenditions(
+            output_dir=work_dir,
+            source_url="",
+            tracks=tracks,
+            segment_duration=args.segment_duration,
+            audio_bitrate=args.audio_bitrate,
+            segment_format="ts",
+            startup_timeout=args.startup_timeout,
+        )
+        write_master_playlist(
+            work_dir / "stream.m3u8", video_playlist, args.video_bitrate, args.audio_bitrate, "ts", audio_renditions,
+        )
+    return sum(1 for line in segments if not line.startswith("#"))
+
+
+async def run_batch_encode(cmd: List[str], cwd: Path, lease: Lease, prefix: str, stats: dict) -> None:
+    proc = await launch_ffmpeg(cmd, cwd)
+    apply_process_limits(proc.pid, lease)
+    log_tasks = [
+        asyncio.create_task(pipe_progress(proc.stdout, prefix, stats, log_interval=30)),
+        asyncio.create_task(pipe_stream(proc.stderr, prefix)),
+    ]
+    try:
+        returncode = await proc.wait()
+    finally:
+        # Interrupted: leave the listed segments for the next run to resume from
+        if proc.returncode is None:
+            proc.terminate()
+            await proc.wait()
+        for task in log_tasks:
+            task.cancel()
+    if returncode != 0:
+        raise RuntimeError(f"ffmpeg exited with code {returncode}")
+
+
+async def pretranscode(
+    url: str,
+    args: argparse.Namespace,
+    encoder_settings: tuple[str, str, str, List[str]],
+    scheduler: TranscodeScheduler,
+    prefix: str,
+) -> dict:
+    """
+    Encodes one source into a VOD HLS package in the cache. An interrupted
+    encode resumes after the last complete segment of the previous run.
+    """
+    # Keyed the way a live session for this URL will look it up, relayed or not
+    size = await source_size(url) if url.startswith("http") else None
+    key = cache_key(url, size)
+    packages_root = args.cache_dir / PACKAGES_DIR
+    package_dir = packages_root / key
+    if (package_dir / PACKAGE_MANIFEST).exists():
+        print(f"{prefix} already packaged: {url}")
+        return {"url": url, "status": "cached"}
+    work_dir = packages_root / f"{key}.partial"
+    work_dir.mkdir(parents=True, exist_ok=True)
+
+    metadata = load_cached(args.cache_dir, key, "probe")
+    if metadata is None:
+        metadata = await asyncio.to_thread(get_video_metadata, url)
+        if metadata["duration"]:
+            store_cached(args.cache_dir, key, "probe", metadata)
+    tracks = metadata["tracks"]
+    duration = metadata["duration"]
+
+    encoder, encoder_preset, encoder_opts, hw_accel_args = encoder_settings
+    height = (metadata.get("video") or {}).get("height")
+    tuned = lookup_tuning(encoder, height)
+    if encoder == "libx264" and args.preset:
+        encoder_preset = args.preset
+    elif tuned:
+        encoder_preset = tuned["preset"]
+
+    # Background priority: live sessions on this host always come first
+    lease = await scheduler.admit(
+        priority="background",
+        want_threads=args.threads or (tuned or {}).get("threads") or 4,
+        gpu=encoder != "libx264",
+    )
+    if encoder != "libx264" and not lease.gpu:
+        encoder, encoder_opts, hw_accel_args = "libx264", "-tune zerolatency", []
+        encoder_preset = args.preset or (lookup_tuning("libx264", height) or {}).get("preset", "veryfast")
+
+    async def heartbeat() -> None:
+        while True:
+            await asyncio.sleep(5)
+            await asyncio.to_thread(scheduler.heartbeat, lease, stats.get("speed"))
+
+    stats: dict = {}
+    heartbeat_task = asyncio.create_task(heartbeat())
+    started = time.monotonic()
+    encoded_from = 0.0
+    def covers(seconds: float) -> bool:
+        # The last segment may be shorter than the rest, never missing
+        return bool(duration) and seconds >= duration - args.segment_duration
+
+    try:
+        # Segments sit on a forced keyframe grid, so the listed durations
+        # add up to exactly where the next segment starts
+        encoded_from, done_count = encoded_extent(work_dir / "video_encode.m3u8")
+        if not covers(encoded_from):
+            if done_count:
+                print(f"{prefix} resuming {url} at {encoded_from:.1f}s ({done_count} segments done)")
+            else:
+                print(f"{prefix} encoding {url} ({encoder} {encoder_preset}, {lease.threads} thread(s))")
+            cmd = build_ffmpeg_command(
+                source_url=url,
+                output_dir=work_dir,
+                segment_duration=args.segment_duration,
+                video_bitrate=args.video_bitrate,
+                audio_bitrate=args.audio_bitrate,
+                encoder=encoder,
+                encoder_preset=encoder_preset,
+                encoder_opts=encoder_opts,
+                hw_accel_args=hw_accel_args,
+                audio_tracks=tracks[:1],
+                playlist_name="video_encode.m3u8",
+                segment_filename="video_%05d.ts",
+                start_time=encoded_from,
+                start_number=done_count,
+                threads=lease.threads,
+                keyframe_grid=True,
+                append_list=done_count > 0,
+                omit_endlist=True,
+            )
+            await run_batch_encode(cmd, work_dir, lease, prefix, stats)
+            # ffmpeg also exits cleanly when the upstream ends early
+            encoded_to, _ = encoded_extent(work_dir / "video_encode.m3u8")
+            if duration and not covers(encoded_to):
+                raise RuntimeError(f"encode stopped at {encoded_to:.1f}s of {duration:.1f}s")
+
+        # Alternate audio tracks as separate renditions, like a live session serves them
+        for position in range(1, len(tracks)):
+            playlist_name = AudioRenditions.playlist_name(position)
+            # ENDLIST is no proof here either: a killed ffmpeg writes it too
+            if not covers(encoded_extent(work_dir / playlist_name)[0]):
+                cmd = build_audio_command(url, position, args.segment_duration, args.audio_bitrate, playlist_name)
+                await run_batch_encode(cmd, work_dir, lease, f"{prefix}-audio{position}", {})
+                track_seconds, _ = encoded_extent(work_dir / playlist_name)
+                if duration and not covers(track_seconds):
+                    raise RuntimeError(f"audio track {position} stopped at {track_seconds:.1f}s of {duration:.1f}s")
+    finally:
+        heartbeat_task.cancel()
+        await asyncio.to_thread(scheduler.release, lease)
+
+    segments = finalize_package(work_dir, tracks, args)
+    wall_seconds = time.monotonic() - started
+    encoded_seconds = (duration or 0) - encoded_from
+    manifest = {
+        "url": url,
+        "size": size,
+        "duration": duration,
+        "tracks": tracks,
+        "segments": segments,
+        "encoder": encoder,
+        "preset": encoder_preset,
+        "wall_seconds": round(wall_seconds, 1),
+        "speed": round(encoded_seconds / wall_seconds, 2) if encoded_seconds > 0 else None,
+        "created": time.time(),
+    }
+    (work_dir / PACKAGE_MANIFEST).write_text(json.dumps(manifest, indent=2))
+    shutil.rmtree(package_dir, ignore_errors=True)
+    work_dir.rename(package_dir)
+    speed = f" at {manifest['speed']}x real time" if manifest["speed"] else ""
+    print(f"{prefix} packaged {url}: {segments} segments in {wall_seconds:.0f}s{speed}")
+    return {"url": url, "status": "packaged", "speed": manifest["speed"], "wall_seconds": manifest["wall_seconds"]}
+
+
+async def run_batch(args: argparse.Namespace) -> None:
+    """Pre-transcodes a list (or stdin queue) of URLs with a bounded pool of ffmpeg workers."""
+    if args.headers:
+        try:
+            HEADERS.update(json.loads(args.headers))
+        except json.JSONDecodeError:
+            print("Warning: Invalid JSON in --headers, ignoring.")
+
+    encoder_settings = await detect_gpu_encoder()
+    scheduler = TranscodeScheduler(
+        cpu_budget=args.cpu_budget,
+        gpu_sessions=args.max_gpu_sessions,
+        pin_cores=args.cpu_affinity,
+    )
+    queue: asyncio.Queue = asyncio.Queue()
+    results: List[dict] = []
+    queued = 0
+
+    def parse_line(line: str) -> str | None:
+        line = line.strip()
+        return line if line and not line.startswith("#") else None
+
+    async def feed() -> None:
+        nonlocal queued
+        if args.batch == "-":
+            # A queue: URLs are picked up as they are written to stdin
+            while line := await asyncio.to_thread(sys.stdin.readline):
+                if url := parse_line(line):
+                    queued += 1
+                    await queue.put((queued, url))
+        else:
+            for line in Path(args.batch).read_text().splitlines():
+                if url := parse_line(line):
+                    queued += 1
+                    await queue.put((queued, url))
+        for _ in range(args.workers):
+            await queue.put(None)
+
+    async def worker() -> None:
+        while (item := await queue.get()) is not None:
+            number, url = item
+            prefix = f"batch[{number}]"
+            try:
+                results.append(await pretranscode(url, args, encoder_settings, scheduler, prefix))
+            except Exception as e:
+                print(f"{prefix} failed: {url} ({e})")
+                results.append({"url": url, "status": "failed", "error": str(e)})
+
+    print(f"Batch: {args.workers} worker(s), packages in {args.cache_dir / PACKAGES_DIR}")
+    await asyncio.gather(feed(), *(worker() for _ in range(args.workers)))
+
+    print("================ Batch summary ================")
+    for result in results:
+        detail = f" ({result['speed']}x, {result['wall_seconds']}s)" if result.get("speed") else ""
+        print(f"{result['status']:<9} {result['url']}{detail}{' - ' + result['error'] if 'error' in result else ''}")
+    if any(result["status"] == "failed" for result in results):
+        raise RuntimeError("Some sources failed; run the batch again to resume them.")
+
+
+async def serve_package(args: argparse.Namespace, package_dir: Path) -> None:
+    """Serves a pre-transcoded package straight from the cache: no probe, no ffmpeg."""
+    manifest = json.loads((package_dir / PACKAGE_MANIFEST).read_text())
+    stop_event = asyncio.Event()
+    idle_manager = IdleTimeout(args.idle_timeout, stop_event)
+    serve_workers = make_serve_workers(args, package_dir)
+    egress = make_egress(args, package_dir)
+    app = create_app(
+        package_dir,
+        "stream.m3u8",
+        args.url,
+        using_gpu=False,
+        idle_manager=idle_manager,
+        session_stats={"package": {"segments": manifest["segments"], "created": manifest["created"]}},
+        serve_workers=serve_workers,
+        egress=egress,
+    )
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await bind_site(runner, args, "stream.m3u8", manifest.get("duration"), serve_workers)
+        print("Press Ctrl+C to stop.")
+        asyncio.create_task(idle_manager.start())
+        while not stop_event.is_set():
+            await asyncio.sleep(1)
+    finally:
+        if serve_workers is not None:
+            await serve_workers.stop()
+        if egress is not None:
+            await egress.stop()
+        await runner.cleanup()
+
+
+def make_serve_workers(args: argparse.Namespace, hls_dir: Path) -> ServeWorkers | None:
+    if args.serve_workers <= 1:
+        return None
+    if not reuse_port_supported():
+        print("Warning: SO_REUSEPORT is not available here, serving from a single process")
+        return None
+    return ServeWorkers(args.serve_workers, hls_dir, args.uvloop)
+
+
+def make_egress(args: argparse.Namespace, hls_dir: Path) -> EgressScheduler | None:
+    if not args.egress_mbps and not args.client_mbps:
+        return None
+    if args.serve_workers > 1:
+        print("Warning: Worker processes serve without egress shaping; only the proxy process's share is scheduled")
+    return EgressScheduler(hls_dir, args.egress_mbps * 1e6 / 8, args.client_mbps * 1e6 / 8)
+
+
+async def serve_direct(args: argparse.Namespace, relay: UpstreamRelay, hls_dir: Path, duration: float | None) -> None:
+    """Serves the source itself through the relay: no ffmpeg, no segments."""
+    # Upstreams often label files application/octet-stream
+    relay.content_type = "video/mp4"
+    stop_event = asyncio.Event()
+    idle_manager = IdleTimeout(args.idle_timeout, stop_event)
+    serve_workers = make_serve_workers(args, hls_dir)
+    app = create_app(
+        hls_dir,
+        DIRECT_PLAY_NAME,
+        args.url,
+        using_gpu=False,
+        idle_manager=idle_manager,
+        session_stats={"direct": True, "relay": relay.stats},
+        serve_workers=serve_workers,
+        direct_relay=relay,
+    )
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await bind_site(runner, args, DIRECT_PLAY_NAME, duration, serve_workers)
+        print("Press Ctrl+C to stop.")
+        asyncio.create_task(idle_manager.start())
+        while not stop_event.is_set():
+            await asyncio.sleep(1)
+    finally:
+        if serve_workers is not None:
+            await serve_workers.stop()
+        await runner.cleanup()
+
+
+async def bind_site(
+    runner: web.AppRunner,
+    args: argparse.Namespace,
+    playlist_name: str,
+    duration: float | None,
+    serve_workers: ServeWorkers | None = None,
+    prepared: bool = False,
+) -> None:
+    """
+    Binds the first free port from --port upwards and announces it to the
+    Node.js API. prepared tells it the session waits for /play.
+    """
+    # Try to bind to the requested port, or find the next available one
+    retries = 500
+    for i in range(retries):
+        try:
+            if serve_workers is not None:
+                # Shared with the serving workers started below
+                site = web.SockSite(runner, bind_shared_socket(args.host, args.port + i))
+            else:
+                site = web.TCPSite(runner, host=args.host, port=args.port + i)
+            await site.start()
+            # Update args.port to the actual bound port
+            args.port = args.port + i
+            break
+        except OSError as e:
+            # Check for common port errors:
+            # 13: EACCES (Permission denied)
+            # 48: EADDRINUSE (Address already in use - Mac/Linux)
+            # 98: EADDRINUSE (Address already in use - Linux)
+            # 10013: WSAEACCES (Permission denied - Windows)
+            # 10048: WSAEADDRINUSE (Address already in use - Windows)
+            if e.errno in {13, 48, 98, 10013, 10048}:
+                print(f"Port {args.port + i} is busy or restricted, trying {args.port + i + 1}...")
+                if i == retries - 1:
+                    raise RuntimeError(f"Could not find an available port starting from {args.port}") from e
+            else:
+                raise
+
+    if serve_workers is not None:
+        await serve_workers.start(runner, args.host, args.port)
+
+    # Emit bound event IMMEDIATELY after binding, before playlist wait
+    # This allows the Node.js API to proceed without timing out
+    display_host = "127.0.0.1" if args.host in {"0.0.0.0", "::"} else args.host
+    print(json.dumps({
+        "event": "bound",
+        "port": args.port,
+        "url": f"http://{display_host}:{args.port}/",
+        "hls": f"http://{display_host}:{args.port}/hls/{playlist_name}",
+        "duration": duration,
+        "prepared": prepared,
+    }), flush=True)
+
+    print("================ Universal Streaming Proxy ================")
+    print(f"Remote source : {args.url}")
+    print(f"Browser player : http://{display_host}:{args.port}/")
+    print(f"Raw playlist   : http://{display_host}:{args.port}/hls/{playlist_name}")
 
 
 async def run_proxy(args: argparse.Namespace) -> None:
@@ -710,9 +2590,23 @@ async def run_proxy(args: argparse.Namespace) -> None:
     playlist_name = "stream.m3u8"
     playlist_path = temp_dir / playlist_name
     ffmpeg_proc: asyncio.subprocess.Process | None = None
+    startup_proc: asyncio.subprocess.Process | None = None
     proxy_proc: web.AppRunner | None = None
     log_tasks: list[asyncio.Task] = []
     runner: web.AppRunner | None = None
+    zip_proc = None
+    stitch_task: asyncio.Task | None = None
+    stitch_stop = asyncio.Event()
+    audio_renditions: AudioRenditions | None = None
+    scheduler: TranscodeScheduler | None = None
+    lease: Lease | None = None
+    transcode_stats: dict = {}
+    relay: UpstreamRelay | None = None
+    vod_session: VodSession | None = None
+    thumbnails: ThumbnailSprites | None = None
+    subtitles: SubtitleTracks | None = None
+    serve_workers = make_serve_workers(args, temp_dir)
+    egress = make_egress(args, temp_dir)
 
     try:
         # Trim whitespace from URL to prevent ffmpeg errors
@@ -729,19 +2623,134 @@ async def run_proxy(args: argparse.Namespace) -> None:
             # Default behavior: no default referer for generic URLs
             pass
 
+        # Mirrors and header profiles are raced; args.url stays the cache identity
+        upstream_url = args.url
+        fallbacks: list[tuple[str, dict]] = []
+        mirrors = [m.strip() for m in args.mirror or []]
+        if args.url.startswith("http") and (mirrors or args.header_profile):
+            print("Racing source candidates...")
+            ranked = await select_source(
+                [args.url, *mirrors],
+                parse_profiles(args.header_profile, HEADERS),
+                args.cache_dir / SOURCES_FILE.name,
+            )
+            if ranked:
+                upstream_url = ranked[0].url
+                HEADERS.clear()
+                HEADERS.update(ranked[0].headers)
+                print(f"Using {ranked[0].describe()}")
+                if args.switch_below_mbps:
+                    # The best profile per URL; another profile on the same mirror rarely helps
+                    seen = {upstream_url}
+                    for candidate in ranked[1:]:
+                        if candidate.url not in seen:
+                            seen.add(candidate.url)
+                            fallbacks.append((candidate.url, candidate.headers))
+            else:
+                print("Warning: No candidate answered the probe, trying the source as given")
+
+        # Every reader of the source (ffprobe, each ffmpeg, the ZIP reader) goes
+        # through one local relay, so header/cue bytes are fetched upstream once
+        source_url = upstream_url
+        if upstream_url.startswith("http") and not args.no_relay:
+            relay = UpstreamRelay(
+                upstream_url,
+                dict(HEADERS),
+                temp_dir / "relay_cache",
+                memory_limit=args.relay_memory_mb * 1024 * 1024,
+                disk_limit=args.relay_disk_mb * 1024 * 1024,
+                read_ahead=args.read_ahead_mb * 1024 * 1024,
+                fallbacks=fallbacks,
+                min_throughput=args.switch_below_mbps * 1e6 / 8,
+            )
+            relay_url = await relay.start()
+            if relay_url:
+                source_url = relay_url
+                print(f"Relaying upstream through {relay_url} ({relay.size} bytes)")
+            else:
+                await relay.stop()
+                relay = None
+
+        # Pre-transcoded by --batch: nothing to encode
+        if not args.zip_file:
+            if relay is not None:
+                package_size = relay.size
+            elif args.url.startswith("http"):
+                package_size = await source_size(upstream_url)
+            else:
+                package_size = None
+            package_dir = args.cache_dir / PACKAGES_DIR / cache_key(args.url, package_size)
+            if (package_dir / PACKAGE_MANIFEST).exists():
+                print(f"Serving pre-transcoded package {package_dir.name}")
+                if relay is not None:
+                    await relay.stop()
+                    relay = None
+                await serve_package(args, package_dir)
+                return
+
         # Probe for audio tracks and duration
         audio_tracks = []
+        subtitle_tracks = []
         detected_duration = None
+        video_info = None
+        keyframe_index: KeyframeIndex | None = None
         if not args.zip_file:
-            print("Probing source for metadata...")
-            metadata = get_video_metadata(args.url)
+            # The relay's size doubles as a validator for the persistent cache
+            source_key = cache_key(args.url, relay.size if relay else None)
+            metadata = load_cached(args.cache_dir, source_key, "probe")
+            if metadata is not None and "subtitles" not in metadata:
+                # Cached before subtitle streams were probed
+                metadata = None
+            if metadata is not None:
+                print("Using cached probe results")
+            else:
+                print("Probing source for metadata...")
+                # In a thread: the relay serving ffprobe runs on this event loop
+                metadata = await asyncio.to_thread(get_video_metadata, source_url)
+                # A failed probe returns defaults; don't remember those
+                if metadata["duration"]:
+                    store_cached(args.cache_dir, source_key, "probe", metadata)
             audio_tracks = metadata["tracks"]
             detected_duration = metadata["duration"]
+            video_info = metadata.get("video")
+            subtitle_tracks = metadata["subtitles"]
             print(f"Found {len(audio_tracks)} audio track(s):")
             for t in audio_tracks:
                 print(f" - Track {t['index']}: {t.get('title', 'Unknown')} ({t.get('lang', 'und')})")
+            if subtitle_tracks:
+                print(f"Found {len(subtitle_tracks)} text subtitle track(s), converted to WebVTT on demand")
             if detected_duration:
                 print(f"Detected duration: {detected_duration}s")
+
+            # Already browser-playable and seekable over Range: skip ffmpeg entirely
+            if (
+                relay is not None
+                and not args.no_direct_play
+                and can_direct_play(metadata, args.hevc_passthrough)
+            ):
+                try:
+                    moov_first = await asyncio.to_thread(mp4_moov_first, source_url, {})
+                except OSError as e:
+                    print(f"Warning: Could not inspect MP4 layout ({e})")
+                    moov_first = False
+                if moov_first:
+                    print("Source is a fast-start MP4 the browser can play: direct play, no transcode")
+                    await serve_direct(args, relay, temp_dir, detected_duration)
+                    return
+
+            keyframe_index = await asyncio.to_thread(load_keyframe_index, args.cache_dir, source_key, source_url, dict(HEADERS))
+            if keyframe_index is not None:
+                print(f"Keyframe index: {len(keyframe_index.times)} keyframes ({keyframe_index.source})")
+            elif args.keyframe_scan:
+                async def index_in_background() -> None:
+                    # Read straight from upstream so the scan doesn't churn the relay cache
+                    index = await scan_keyframes(upstream_url, dict(HEADERS))
+                    if index is not None:
+                        store_cached(args.cache_dir, source_key, "keyframes", index.to_dict())
+                        print(f"Keyframe scan finished: {len(index.times)} keyframes cached for the next session")
+
+                print("No container cues, scanning keyframes in the background...")
+                log_tasks.append(asyncio.create_task(index_in_background()))
         else:
             print("Streaming from ZIP, skipping metadata probe (using default mapping).")
 
@@ -752,13 +2761,144 @@ async def run_proxy(args: argparse.Namespace) -> None:
         # but for GPU we stick to optimized defaults unless we want to allow override.
         # The requirements say "Use p1 for NVENC", etc. so we respect the detection.
         # However, if the user explicitly passed --preset, we might want to respect it for CPU.
-        if encoder == "libx264" and args.preset != "veryfast":
+        if encoder == "libx264" and args.preset:
              encoder_preset = args.preset
 
-        ffmpeg_source = args.url
+        # Presets/threads measured on this host by `tuning.py calibrate`;
+        # explicit --preset/--threads still win
+        source_height = video_info.get("height") if video_info else None
+        tuned = lookup_tuning(encoder, source_height)
+        if tuned and not (encoder == "libx264" and args.preset):
+            encoder_preset = tuned["preset"]
+            print(f"Tuning: {encoder} preset {encoder_preset} for {source_height or 'unknown'}p (calibrated)")
+        elif encoder == "libx264" and not args.preset:
+            encoder_preset = "ultrafast"
+        want_threads = args.threads or (tuned or {}).get("threads") or 4
+
+        # HEVC can only reach browsers inside fMP4, so passthrough implies CMAF output
+        segment_format = args.segment_format
+        video_copy = False
+        if args.hevc_passthrough and video_info and video_info.get("codec") == "hevc":
+            print("Client decodes HEVC natively: copying video instead of re-encoding")
+            video_copy = True
+            segment_format = "fmp4"
+
+        # Ask the host-wide scheduler for a share of the CPU/encoder budget
+        scheduler = TranscodeScheduler(
+            cpu_budget=args.cpu_budget,
+            gpu_sessions=args.max_gpu_sessions,
+            pin_cores=args.cpu_affinity,
+        )
+        try:
+            lease = await scheduler.admit(
+                priority="prepare" if args.prepare else args.priority,
+                # Remuxing only needs a thread for demux/mux and audio
+                want_threads=1 if video_copy else want_threads,
+                gpu=encoder != "libx264" and not video_copy,
+                queue_timeout=args.queue_timeout,
+                # Nobody waits on a prepared session: past its TTL it isn't worth queueing for
+                give_up_after=args.prepare_ttl if args.prepare else None,
+            )
+        except TimeoutError as e:
+            raise RuntimeError(f"Scheduler: {e}, not preparing this session")
+        if encoder != "libx264" and not video_copy and not lease.gpu:
+            print("Scheduler: all GPU encoder sessions busy, falling back to CPU (libx264)")
+            cpu_preset = args.preset or (lookup_tuning("libx264", source_height) or {}).get("preset", "ultrafast")
+            encoder, encoder_preset, encoder_opts, hw_accel_args = "libx264", cpu_preset, "-tune zerolatency", []
+        scale_height = None
+        if lease.degraded and not video_copy:
+            print(f"Scheduler: host under load, running degraded ({lease.threads} thread(s), {args.degraded_height}p)")
+            scale_height = args.degraded_height
+            if encoder == "libx264":
+                encoder_preset = "ultrafast"
+        else:
+            print(f"Scheduler: admitted with {lease.threads} thread(s)")
+        transcode_stats["output"] = {"format": segment_format, "video": "copy" if video_copy else encoder}
+        transcode_stats["scheduler"] = {
+            "job": lease.job_id,
+            "priority": lease.priority,
+            "threads": lease.threads,
+            "cores": lease.cores,
+            "degraded": lease.degraded,
+        }
+
+        ffmpeg_source = source_url
         if args.zip_file:
             ffmpeg_source = "pipe:0"
 
+        # The startup rendition needs a second, seekable reader of the source
+        fast_start_window = 0.0
+        if args.fast_start > 0:
+            if args.zip_file:
+                print("Fast-start disabled: ZIP sources can only be read once.")
+            elif video_copy:
+                print("Fast-start disabled: video is copied, the first segment is already cheap.")
+            else:
+                # Round up to whole segments so the hand-over lands on a segment boundary
+                fast_start_window = math.ceil(args.fast_start / args.segment_duration) * args.segment_duration
+                if detected_duration and fast_start_window >= detected_duration:
+                    fast_start_window = 0.0
+
+        # A prepared session only encodes its first segments and holds the
+        # full encode back until someone actually presses play
+        prepare_window = 0.0
+        if args.prepare > 0:
+            if args.zip_file or video_copy:
+                print("Prepare: session can't be split, running the full job at prepare priority.")
+            else:
+                prepare_window = args.prepare * args.segment_duration
+                if detected_duration and prepare_window >= detected_duration:
+                    prepare_window = 0.0
+        startup_window = max(fast_start_window, prepare_window)
+
+        # With a keyframe index the whole playlist is known up front: segments
+        # are planned on source keyframes and encoded, or re-encoded after a
+        # seek, as the player asks for them
+        vod_plan = None
+        if keyframe_index is not None and detected_duration and not args.no_vod:
+            if video_copy or segment_format != "ts":
+                print("VOD playlist disabled: it needs re-encoded TS segments.")
+            else:
+                vod_plan = keyframe_index.plan_segments(args.segment_duration, detected_duration)
+
+        # Only the default audio track is encoded up front; the others are
+        # advertised in a master playlist and encoded when first requested.
+        # A ZIP pipe can only be read once, so those sessions keep every track muxed.
+        # So do VOD-planned ones: an audio-only encode runs once from the start
+        # on its own grid, and couldn't follow the plan's keyframe cuts or seeks.
+        audio_renditions = None
+        video_tracks = audio_tracks
+        video_playlist_name = playlist_name
+        if not args.zip_file and not vod_plan and len(audio_tracks) > 1:
+            audio_renditions = AudioRenditions(
+                output_dir=temp_dir,
+                source_url=source_url,
+                tracks=audio_tracks,
+                segment_duration=args.segment_duration,
+                audio_bitrate=args.audio_bitrate,
+                segment_format=segment_format,
+                startup_timeout=args.startup_timeout,
+            )
+            video_tracks = audio_tracks[:1]
+            video_playlist_name = "video.m3u8"
+            print(f"Encoding default audio track now, {len(audio_tracks) - 1} more on demand")
+
+        # Subtitles never touch the video encode: a side job converts them to WebVTT
+        if subtitle_tracks and detected_duration:
+            subtitles = SubtitleTracks(
+                output_dir=temp_dir,
+                source_url=upstream_url,
+                tracks=subtitle_tracks,
+                duration=detected_duration,
+                cache_dir=args.cache_dir,
+                cache_key=source_key,
+                segment_format=segment_format,
+                readrate=args.subtitle_readrate,
+            )
+            subtitles.write_playlists()
+            video_playlist_name = "video.m3u8"
+        video_playlist_path = temp_dir / video_playlist_name
+
         cmd = build_ffmpeg_command(
             source_url=ffmpeg_source,
             output_dir=temp_dir,
@@ -769,18 +2909,90 @@ async def run_proxy(args: argparse.Namespace) -> None:
             encoder_preset=encoder_preset,
             encoder_opts=encoder_opts,
             hw_accel_args=hw_accel_args,
-            audio_tracks=audio_tracks,
+            audio_tracks=video_tracks,
+            playlist_name="main.m3u8" if startup_window else video_playlist_name,
+            segment_filename="main_%05d.ts" if startup_window and segment_format == "ts" else None,
+            start_time=startup_window,
+            scale_height=scale_height,
+            threads=lease.threads,
+            segment_format=segment_format,
+            video_copy=video_copy,
+            keyframe_grid=audio_renditions is not None,
         )
 
+        stop_event = asyncio.Event()
+        # Prepared sessions nobody plays expire after the (short) prepare TTL
+        idle_manager = IdleTimeout(args.prepare_ttl if args.prepare else args.idle_timeout, stop_event)
+        monitor_tasks: list[asyncio.Task] = []
+
+        async def monitor_ffmpeg() -> None:
+            if ffmpeg_proc is None:
+                return
+            returncode = await ffmpeg_proc.wait()
+            if returncode == 0:
+                print("ffmpeg exited cleanly (source ended).")
+            else:
+                print(f"ffmpeg exited with code {returncode}.")
+            stop_event.set()
+
+        async def start_main_job() -> None:
+            nonlocal ffmpeg_proc
+            ffmpeg_proc = await launch_ffmpeg(cmd, temp_dir, stdin=zip_proc.stdout if zip_proc else None)
+            apply_process_limits(ffmpeg_proc.pid, lease)
+            log_tasks.extend([
+                asyncio.create_task(pipe_progress(ffmpeg_proc.stdout, "ffmpeg", transcode_stats)),
+                asyncio.create_task(pipe_stream(ffmpeg_proc.stderr, "ffmpeg")),
+            ])
+            monitor_tasks.append(asyncio.create_task(monitor_ffmpeg()))
+
+        # Concurrent VOD jobs split the lease's threads instead of each taking all of them
+        vod_max_jobs = max(1, min(VOD_MAX_JOBS, lease.threads // VOD_JOB_MIN_THREADS))
+        vod_job_threads = max(1, lease.threads // vod_max_jobs)
+
+        async def launch_vod_job(first: int, last: int, cheap: bool, name: str) -> asyncio.subprocess.Process:
+            start = vod_plan[first][0]
+            end = vod_plan[last - 1][0] + vod_plan[last - 1][1]
+            job_cmd = build_ffmpeg_command(
+                source_url=ffmpeg_source,
+                output_dir=temp_dir,
+                segment_duration=args.segment_duration,
+                video_bitrate=args.fast_start_bitrate if cheap else args.video_bitrate,
+                audio_bitrate=args.audio_bitrate,
+                encoder=encoder,
+                encoder_preset="ultrafast" if cheap and encoder == "libx264" else encoder_preset,
+                encoder_opts=encoder_opts,
+                hw_accel_args=hw_accel_args,
+                audio_tracks=video_tracks,
+                playlist_name=VodSession.job_playlist(name),
+                segment_filename=VodSession.job_segment_pattern(name),
+                start_time=start,
+                duration_limit=end - start if last < len(vod_plan) else None,
+                scale_height=min(args.fast_start_height, scale_height or args.fast_start_height) if cheap else scale_height,
+                start_number=first,
+                threads=vod_job_threads,
+                segment_times=[vod_plan[index][0] for index in range(first + 1, last)],
+            )
+            proc = await launch_ffmpeg(job_cmd, temp_dir)
+            apply_process_limits(proc.pid, lease)
+            log_tasks.extend([
+                asyncio.create_task(pipe_progress(proc.stdout, "ffmpeg", transcode_stats)),
+                asyncio.create_task(pipe_stream(proc.stderr, "ffmpeg")),
+            ])
+            return proc
+
         print("Launching ffmpeg to transcode into HLS...")
 
-        zip_proc = None
+        awaiting_play = False
         if args.zip_file:
             # Launch zip_helper to stream to stdout using standard subprocess to get a pipeable file handle
             zip_cmd = [
-                sys.executable, "src/python/zip_helper.py", "stream",
-                "--url", args.url,
-                "--file", args.zip_file
+                sys.executable, str(Path(__file__).with_name("zip_helper.py")),
+                "--cache-dir", str(args.cache_dir),
+                "stream",
+                "--url", source_url,
+                "--file", args.zip_file,
+                # source_url may be the local relay; the index is cached under the real URL
+                "--index-url", args.url,
             ]
             print(f"Zip helper command: {' '.join(zip_cmd)}")
             # Use subprocess.Popen to get a real file object for stdout
@@ -789,36 +3001,100 @@ async def run_proxy(args: argparse.Namespace) -> None:
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE
             )
-            
-            try:
-                ffmpeg_proc = await asyncio.create_subprocess_exec(
-                    *cmd,
-                    stdin=zip_proc.stdout,
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE,
-                    cwd=str(temp_dir)
-                )
-            except FileNotFoundError as exc:
-                raise RuntimeError(
-                    "ffmpeg binary not found. Install it and ensure it is available on PATH."
-                ) from exc
+            await start_main_job()
+        elif vod_plan:
+            # The fast-start/prepare window becomes the first job's span
+            first_span = None
+            if startup_window:
+                first_span = next((index for index, (start, _) in enumerate(vod_plan) if start >= startup_window), len(vod_plan))
+            cheap = fast_start_window > 0
+            vod_session = VodSession(temp_dir, vod_plan, launch_vod_job, args.startup_timeout, max_jobs=vod_max_jobs)
+            vod_session.write_playlist(video_playlist_path, discontinuity_at=first_span if cheap else 0)
+            print(f"VOD playlist: {len(vod_plan)} segments cut on source keyframes")
+            if cheap:
+                print(f"Fast-start: first {vod_plan[first_span - 1][0] + vod_plan[first_span - 1][1]:g}s at {args.fast_start_height}p, then full quality")
+            if args.prepare:
+                vod_session.hold_at = first_span
+                print("Prepare: encoding the first segments, the rest starts on play")
+            await vod_session.start(0, cheap=cheap, last=first_span)
+        elif startup_window:
+            # Fast-start uses the cheap profile; a plain prepare encodes its
+            # segments at full quality so nothing changes when playback starts
+            cheap = fast_start_window > 0
+            startup_cmd = build_ffmpeg_command(
+                source_url=ffmpeg_source,
+                output_dir=temp_dir,
+                segment_duration=args.segment_duration,
+                video_bitrate=args.fast_start_bitrate if cheap else args.video_bitrate,
+                audio_bitrate=args.audio_bitrate,
+                encoder=encoder,
+                # The whole point is speed, so always use the fastest CPU preset
+                encoder_preset="ultrafast" if cheap and encoder == "libx264" else encoder_preset,
+                encoder_opts=encoder_opts,
+                hw_accel_args=hw_accel_args,
+                audio_tracks=video_tracks,
+                playlist_name="startup.m3u8",
+                segment_filename="startup_%05d.ts" if segment_format == "ts" else None,
+                duration_limit=startup_window,
+                scale_height=min(args.fast_start_height, scale_height or args.fast_start_height) if cheap else scale_height,
+                threads=lease.threads,
+                segment_format=segment_format,
+            )
+            if cheap:
+                print(f"Fast-start: first {startup_window:g}s at {args.fast_start_height}p, then full quality")
+            else:
+                print(f"Prepare: encoding the first {startup_window:g}s, full encode starts on play")
+            startup_proc = await launch_ffmpeg(startup_cmd, temp_dir)
+            apply_process_limits(startup_proc.pid, lease)
+            log_tasks.extend([
+                asyncio.create_task(pipe_progress(startup_proc.stdout, "ffmpeg-startup", {})),
+                asyncio.create_task(pipe_stream(startup_proc.stderr, "ffmpeg-startup")),
+            ])
+
+            stitcher = FastStartPlaylist(temp_dir, video_playlist_name, "startup.m3u8", "main.m3u8")
+            stitch_task = asyncio.create_task(stitcher.run(stitch_stop))
+
+            if args.prepare:
+                awaiting_play = True
+            else:
+                # Hold the full-quality encode back until the first cheap segment exists,
+                # so it doesn't steal CPU from the segment the viewer is waiting on
+                elapsed = 0.0
+                while elapsed < args.startup_timeout and not stitcher.startup_ready():
+                    if startup_proc.returncode is not None and startup_proc.returncode != 0:
+                        raise RuntimeError(f"Fast-start ffmpeg exited early with code {startup_proc.returncode}. Check logs for details.")
+                    await asyncio.sleep(0.1)
+                    elapsed += 0.1
+
+                await start_main_job()
         else:
-            try:
-                ffmpeg_proc = await asyncio.create_subprocess_exec(
-                    *cmd,
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE,
-                    cwd=str(temp_dir)
-                )
-            except FileNotFoundError as exc:
-                raise RuntimeError(
-                    "ffmpeg binary not found. Install it and ensure it is available on PATH."
-                ) from exc
-
-        log_tasks = [
-            asyncio.create_task(pipe_stream(ffmpeg_proc.stdout, "ffmpeg")),
-            asyncio.create_task(pipe_stream(ffmpeg_proc.stderr, "ffmpeg")),
-        ]
+            await start_main_job()
+
+        async def scheduler_heartbeat() -> None:
+            # Keeps our lease alive and lets other proxies see whether we keep up
+            while True:
+                await asyncio.to_thread(scheduler.heartbeat, lease, transcode_stats.get("speed"))
+                await asyncio.sleep(5)
+
+        log_tasks.append(asyncio.create_task(scheduler_heartbeat()))
+
+        async def promote_to_play() -> None:
+            """Turns a prepared session into a playing one."""
+            nonlocal awaiting_play
+            if lease.priority == "play" and not awaiting_play:
+                return
+            start_main = awaiting_play
+            awaiting_play = False
+            print("▶️ Prepared session is now playing")
+            idle_manager.timeout_seconds = args.idle_timeout
+            await asyncio.to_thread(scheduler.promote, lease, "play")
+            transcode_stats["scheduler"]["priority"] = "play"
+            if vod_session is not None:
+                await vod_session.release()
+            elif start_main:
+                await start_main_job()
+            if thumbnails is not None:
+                await thumbnails.start()
 
         # Wait for playlist, but also check if ffmpeg fails early
         elapsed = 0.0
@@ -827,12 +3103,33 @@ async def run_proxy(args: argparse.Namespace) -> None:
         print(f"Waiting for playlist generation (timeout: {args.startup_timeout}s)...")
         
         while elapsed < args.startup_timeout:
-            if ffmpeg_proc.returncode is not None:
-                # Process exited early
-                raise RuntimeError(f"ffmpeg exited early with code {ffmpeg_proc.returncode}. Check logs for details.")
+            for proc in (ffmpeg_proc, startup_proc):
+                # The startup job is expected to finish once its window is done
+                if proc is not None and proc.returncode is not None and (proc is ffmpeg_proc or proc.returncode != 0):
+                    # Process exited early
+                    raise RuntimeError(f"ffmpeg exited early with code {proc.returncode}. Check logs for details.")
             
-            if playlist_path.exists() and playlist_path.stat().st_size > 0:
+            if vod_session is not None:
+                # The VOD playlist is written up front; wait for its first segment instead
+                vod_session.refresh()
+                if vod_session.error is not None:
+                    raise RuntimeError(f"ffmpeg exited early with code {vod_session.error}. Check logs for details.")
+                output_ready = 0 in vod_session.ready
+            else:
+                output_ready = video_playlist_path.exists() and video_playlist_path.stat().st_size > 0
+
+            if output_ready:
                 playlist_ready = True
+                if video_playlist_name != playlist_name:
+                    write_master_playlist(
+                        playlist_path,
+                        video_playlist_name,
+                        args.video_bitrate,
+                        args.audio_bitrate,
+                        segment_format,
+                        audio_renditions,
+                        subtitles,
+                    )
                 print("Playlist generated successfully!")
                 break
             
@@ -845,50 +3142,49 @@ async def run_proxy(args: argparse.Namespace) -> None:
         if not playlist_ready:
              raise TimeoutError(f"Timed out after {args.startup_timeout}s waiting for HLS playlist. Check your network connection or the URL.")
 
-        stop_event = asyncio.Event()
-        idle_manager = IdleTimeout(args.idle_timeout, stop_event)
-        
-        app = create_app(temp_dir, playlist_name, args.url, using_gpu=(encoder != "libx264"), idle_manager=idle_manager)
+        # Seek previews only start once playback has what it needs
+        if args.thumbnails:
+            if args.zip_file:
+                print("Thumbnails disabled: ZIP sources can only be read once.")
+            elif lease.degraded:
+                print("Thumbnails disabled: host is under load.")
+            else:
+                thumbnails = ThumbnailSprites(
+                    temp_dir,
+                    # Like the keyframe scan: a full pass over the file would churn the relay's cache
+                    upstream_url,
+                    detected_duration,
+                    video_info,
+                    interval=args.thumbnail_interval,
+                    readrate=args.thumbnail_readrate,
+                )
+                # A prepared session starts them when it is played
+                if not args.prepare:
+                    await thumbnails.start()
+
+        app = create_app(
+            temp_dir,
+            playlist_name,
+            args.url,
+            using_gpu=(encoder != "libx264"),
+            idle_manager=idle_manager,
+            session_stats={
+                "transcode": transcode_stats,
+                "relay": relay.stats if relay else None,
+                "vod": vod_session.stats if vod_session else None,
+            },
+            audio_renditions=audio_renditions,
+            on_play=promote_to_play,
+            vod_session=vod_session,
+            thumbnails=thumbnails,
+            serve_workers=serve_workers,
+            subtitles=subtitles,
+            egress=egress,
+        )
         runner = web.AppRunner(app)
         await runner.setup()
-        # Try to bind to the requested port, or find the next available one
-        retries = 500
-        for i in range(retries):
-            try:
-                site = web.TCPSite(runner, host=args.host, port=args.port + i)
-                await site.start()
-                # Update args.port to the actual bound port
-                args.port = args.port + i
-                break
-            except OSError as e:
-                # Check for common port errors:
-                # 13: EACCES (Permission denied)
-                # 48: EADDRINUSE (Address already in use - Mac/Linux)
-                # 98: EADDRINUSE (Address already in use - Linux)
-                # 10013: WSAEACCES (Permission denied - Windows)
-                # 10048: WSAEADDRINUSE (Address already in use - Windows)
-                if e.errno in {13, 48, 98, 10013, 10048}:
-                    print(f"Port {args.port + i} is busy or restricted, trying {args.port + i + 1}...")
-                    if i == retries - 1:
-                        raise RuntimeError(f"Could not find an available port starting from {args.port}") from e
-                else:
-                    raise
-
-        # Emit bound event IMMEDIATELY after binding, before playlist wait
-        # This allows the Node.js API to proceed without timing out
-        display_host = "127.0.0.1" if args.host in {"0.0.0.0", "::"} else args.host
-        print(json.dumps({
-            "event": "bound",
-            "port": args.port,
-            "url": f"http://{display_host}:{args.port}/",
-            "hls": f"http://{display_host}:{args.port}/hls/{playlist_name}",
-            "duration": detected_duration
-        }), flush=True)
-        
-        print("================ Universal Streaming Proxy ================")
-        print(f"Remote source : {args.url}")
-        print(f"Browser player : http://{display_host}:{args.port}/")
-        print(f"Raw playlist   : http://{display_host}:{args.port}/hls/{playlist_name}")
+        # Only a live encode is held back for /play; packages and direct play serve at once
+        await bind_site(runner, args, playlist_name, detected_duration, serve_workers, prepared=args.prepare > 0)
 
         print("Press Ctrl+C to stop.")
 
@@ -897,18 +3193,6 @@ async def run_proxy(args: argparse.Namespace) -> None:
         # Start idle monitor
         asyncio.create_task(idle_manager.start())
 
-        async def monitor_ffmpeg() -> None:
-            if ffmpeg_proc is None:
-                return
-            returncode = await ffmpeg_proc.wait()
-            if returncode == 0:
-                print("ffmpeg exited cleanly (source ended).")
-            else:
-                print(f"ffmpeg exited with code {returncode}.")
-            stop_event.set()
-
-        monitor_task = asyncio.create_task(monitor_ffmpeg())
-
         try:
             while not stop_event.is_set():
                 await asyncio.sleep(1)
@@ -917,18 +3201,42 @@ async def run_proxy(args: argparse.Namespace) -> None:
             print("💥 Stopping proxy (Interrupt/Cancel)...")
             stop_event.set()
         finally:
-            monitor_task.cancel()
+            for task in monitor_tasks:
+                task.cancel()
     finally:
         if proxy_proc:
             print(f"[CLEANUP] Cleaning up resources for port {args.port}...")
-        if ffmpeg_proc and ffmpeg_proc.returncode is None:
-            ffmpeg_proc.terminate()
-            try:
-                await asyncio.wait_for(ffmpeg_proc.wait(), timeout=5)
-            except asyncio.TimeoutError:
-                ffmpeg_proc.kill()
-                await ffmpeg_proc.wait()
+        stitch_stop.set()
+        if stitch_task is not None:
+            stitch_task.cancel()
+
+        for proc in (startup_proc, ffmpeg_proc):
+            if proc and proc.returncode is None:
+                proc.terminate()
+                try:
+                    await asyncio.wait_for(proc.wait(), timeout=5)
+                except asyncio.TimeoutError:
+                    proc.kill()
+                    await proc.wait()
         
+        if vod_session is not None:
+            await vod_session.stop()
+
+        if thumbnails is not None:
+            await thumbnails.stop()
+
+        if serve_workers is not None:
+            await serve_workers.stop()
+
+        if egress is not None:
+            await egress.stop()
+
+        if audio_renditions is not None:
+            await audio_renditions.stop()
+
+        if subtitles is not None:
+            await subtitles.stop()
+
         if zip_proc:
             if zip_proc.returncode is None:
                 zip_proc.terminate()
@@ -941,6 +3249,12 @@ async def run_proxy(args: argparse.Namespace) -> None:
         for task in log_tasks:
             task.cancel()
 
+        if relay is not None:
+            await relay.stop()
+
+        if scheduler is not None and lease is not None:
+            scheduler.release(lease)
+
         if runner is not None:
             await runner.cleanup()
 
@@ -951,7 +3265,7 @@ async def run_proxy(args: argparse.Namespace) -> None:
 def main() -> None:
     args = parse_args()
     try:
-        asyncio.run(run_proxy(args))
+        run_event_loop(run_batch(args) if args.batch else run_proxy(args), args.uvloop)
     except RuntimeError as exc:
         print(f"Error: {exc}", file=sys.stderr)
         sys.exit(1)
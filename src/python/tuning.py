@@ -0,0 +1,238 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import re
+import sys
+import time
+from pathlib import Path
+from typing import List
+
+from keyframes import CACHE_DIR
+
+TUNING_FILE = CACHE_DIR / "tuning.json"
+
+# Sources are bucketed by height; a class covers everything up to its height
+RESOLUTION_CLASSES = [480, 720, 1080, 2160]
+
+# Fastest first: a preset that can't keep up rules out every slower one
+CANDIDATE_PRESETS = {
+    "libx264": ["ultrafast", "superfast", "veryfast", "faster", "fast", "medium"],
+    "h264_nvenc": ["p1", "p2", "p3", "p4", "p5"],
+    "h264_qsv": ["veryfast", "faster", "fast", "medium"],
+    "h264_amf": ["speed", "balanced", "quality"],
+}
+
+# Live sessions share the host with demuxing, audio and other sessions,
+# so a setting must beat real time by this factor on an idle box
+SAFE_MARGIN = 1.5
+
+
+def resolution_class(height: int | None) -> int:
+    if not height:
+        return 1080
+    return next((c for c in RESOLUTION_CLASSES if height <= c), RESOLUTION_CLASSES[-1])
+
+
+def load_table(path: Path = TUNING_FILE) -> dict:
+    try:
+        return json.loads(path.read_text())
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def lookup_tuning(encoder: str, height: int | None, path: Path = TUNING_FILE) -> dict | None:
+    """Returns the calibrated {'preset', 'threads', ...} for this encoder and resolution, if any."""
+    return load_table(path).get("encoders", {}).get(encoder, {}).get(str(resolution_class(height)))
+
+
+def pick_best(trials: List[dict], margin: float = SAFE_MARGIN) -> dict | None:
+    """
+    Chooses among trials that keep the margin: the best measured quality, or
+    without a quality metric the slowest (best compressing) preset.
+    """
+    passing = [trial for trial in trials if trial["speed"] and trial["speed"] >= margin]
+    if not passing:
+        return None
+    if all(trial.get("psnr") is not None for trial in passing):
+        return max(passing, key=lambda trial: trial["psnr"])
+    return passing[-1]
+
+
+def build_trial_command(
+    source_url: str | None,
+    encoder: str,
+    preset: str,
+    encoder_opts: str,
+    hw_accel_args: List[str],
+    threads: int | None,
+    height: int,
+    video_bitrate: str,
+    seconds: int,
+    headers: dict,
+    offset: float = 0,
+) -> List[str]:
+    cmd = ["ffmpeg", "-hide_banner", "-y", "-nostats", "-progress", "pipe:1"]
+    if source_url:
+        if source_url.startswith("http"):
+            cmd.extend(["-headers", "".join(f"{k}: {v}\r\n" for k, v in headers.items())])
+        cmd.extend(hw_accel_args)
+        if offset:
+            cmd.extend(["-ss", f"{offset:.3f}"])
+        cmd.extend(["-t", str(seconds), "-i", source_url])
+        if "cuda" in hw_accel_args:
+            scale = f"scale_cuda=-2:{height}"
+        elif "qsv" in hw_accel_args:
+            scale = f"scale_qsv=-1:{height}"
+        else:
+            scale = f"scale=-2:{height}"
+        cmd.extend(["-map", "0:v:0", "-vf", scale])
+    else:
+        # Synthetic clip with moving detail; frames are generated at the target size
+        width = height * 16 // 9 // 2 * 2
+        cmd.extend(["-f", "lavfi", "-i", f"testsrc2=size={width}x{height}:rate=24:duration={seconds}"])
+    cmd.extend(["-an", "-c:v", encoder, "-preset", preset])
+    if encoder_opts:
+        cmd.extend(encoder_opts.split())
+    if threads:
+        cmd.extend(["-threads", str(threads)])
+    cmd.extend(["-b:v", video_bitrate])
+    # Only libx264 reports PSNR; other encoders are judged by preset order
+    if encoder == "libx264":
+        cmd.extend(["-flags", "+psnr"])
+    cmd.extend(["-f", "null", "-"])
+    return cmd
+
+
+async def run_trial(cmd: List[str]) -> dict:
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL,
+    )
+    stdout, _ = await proc.communicate()
+    speed = None
+    psnr = None
+    # -progress repeats its block; the last values describe the whole run
+    for line in stdout.decode(errors="ignore").splitlines():
+        key, _, value = line.strip().partition("=")
+        if key == "speed" and value.endswith("x"):
+            try:
+                speed = float(value[:-1])
+            except ValueError:
+                pass
+        elif re.fullmatch(r"stream_\d+_\d+_psnr_all", key):
+            try:
+                psnr = float(value)
+            except ValueError:
+                pass
+    return {"speed": speed if proc.returncode == 0 else None, "psnr": psnr}
+
+
+async def calibrate(args: argparse.Namespace) -> None:
+    # Imported here: stream_proxy imports this module for lookup_tuning
+    from stream_proxy import HEADERS, detect_gpu_encoder, get_video_metadata
+
+    encoder, _, encoder_opts, hw_accel_args = await detect_gpu_encoder()
+    if args.cpu:
+        encoder, encoder_opts, hw_accel_args = "libx264", "-tune zerolatency", []
+    presets = CANDIDATE_PRESETS.get(encoder, [])
+    if not presets:
+        print(f"No candidate presets known for {encoder}", file=sys.stderr)
+        sys.exit(1)
+
+    if args.headers:
+        HEADERS.update(json.loads(args.headers))
+
+    classes = args.classes
+    offset = 0.0
+    if args.url:
+        metadata = await asyncio.to_thread(get_video_metadata, args.url)
+        source_height = (metadata.get("video") or {}).get("height")
+        if not classes:
+            # Calibrating above the source's own resolution tells us nothing
+            classes = [c for c in RESOLUTION_CLASSES if not source_height or c <= resolution_class(source_height)]
+        if metadata.get("duration"):
+            # Skip opening titles, which are often easier to encode than the film
+            offset = min(300.0, metadata["duration"] / 4)
+    classes = classes or [480, 720, 1080]
+
+    if encoder == "libx264":
+        thread_counts = [n for n in (1, 2, 4, 8, 16) if n <= min(args.max_threads, os.cpu_count() or 1)]
+    else:
+        # Hardware encoders don't scale with CPU threads
+        thread_counts = [None]
+
+    table = load_table(args.tuning_file)
+    results = table.setdefault("encoders", {}).setdefault(encoder, {})
+    print(f"Calibrating {encoder} on {'the source' if args.url else 'a synthetic clip'} ({args.seconds}s per trial)")
+
+    for height in classes:
+        trials = []
+        for preset in presets:
+            last_trial = None
+            for threads in thread_counts:
+                cmd = build_trial_command(
+                    args.url, encoder, preset, encoder_opts, hw_accel_args,
+                    threads, height, args.video_bitrate, args.seconds, HEADERS, offset,
+                )
+                started = time.monotonic()
+                result = await run_trial(cmd)
+                trial = {"preset": preset, "threads": threads, **result}
+                psnr = f", PSNR {result['psnr']:.2f}" if result["psnr"] is not None else ""
+                print(
+                    f"  {height}p {preset:<10} threads={threads or '-':<3} "
+                    f"speed={result['speed'] or 0:.2f}x{psnr} ({time.monotonic() - started:.1f}s)"
+                )
+                last_trial = trial
+                # The fewest threads that keep the margin leave room for other sessions
+                if result["speed"] and result["speed"] >= args.margin:
+                    trials.append(trial)
+                    break
+            if not last_trial or not last_trial["speed"] or last_trial["speed"] < args.margin:
+                # Slower presets can only do worse
+                break
+
+        best = pick_best(trials, args.margin)
+        if best is None:
+            print(f"  {height}p: nothing keeps {args.margin}x real time, leaving defaults")
+            results.pop(str(height), None)
+            continue
+        results[str(height)] = {**best, "bitrate": args.video_bitrate}
+        print(f"  {height}p -> {best['preset']} with {best['threads'] or 'default'} thread(s)")
+
+    table["host"] = platform.node()
+    table["calibrated"] = time.time()
+    table["margin"] = args.margin
+    args.tuning_file.parent.mkdir(parents=True, exist_ok=True)
+    args.tuning_file.write_text(json.dumps(table, indent=2))
+    print(f"Saved tuning table to {args.tuning_file}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-host encoder preset tuning")
+    parser.add_argument("--tuning-file", type=Path, default=TUNING_FILE, help="Where the tuning table is stored")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    calibrate_parser = subparsers.add_parser("calibrate", help="Time candidate presets and store the best per resolution")
+    calibrate_parser.add_argument("--url", help="Encode a few seconds of this source instead of a synthetic clip")
+    calibrate_parser.add_argument("--headers", help="JSON dict of headers for --url")
+    calibrate_parser.add_argument("--seconds", type=int, default=8, help="Length of each trial encode")
+    calibrate_parser.add_argument("--classes", type=int, nargs="+", choices=RESOLUTION_CLASSES, help="Resolution classes to calibrate")
+    calibrate_parser.add_argument("--max-threads", type=int, default=4, help="Largest thread count to try")
+    calibrate_parser.add_argument("--margin", type=float, default=SAFE_MARGIN, help="Required speed as a multiple of real time")
+    calibrate_parser.add_argument("--video-bitrate", default="3500k", help="Bitrate the trials encode at")
+    calibrate_parser.add_argument("--cpu", action="store_true", help="Calibrate libx264 even when a GPU encoder is available")
+
+    subparsers.add_parser("show", help="Print the tuning table")
+
+    args = parser.parse_args()
+    if args.command == "calibrate":
+        asyncio.run(calibrate(args))
+    elif args.command == "show":
+        print(json.dumps(load_table(args.tuning_file), indent=2))
+
+
+if __name__ == "__main__":
+    main()
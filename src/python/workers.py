@@ -0,0 +1,267 @@
+import argparse
+import asyncio
+import os
+import re
+import socket
+import sys
+import time
+from pathlib import Path
+from typing import Coroutine, List
+
+import aiohttp
+from aiohttp import web
+
+from egress import EgressScheduler
+
+# Hop-by-hop and framing headers are re-generated by whichever side sends the body
+SKIP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "content-length", "host"}
+
+# Files only the owner can answer for: lazily started or still being written
+OWNER_FILES = re.compile(r"^(audio_\d+\.m3u8|subtitles_\d+\.(m3u8|vtt)|thumbnails\.vtt|thumbs_\d+\.jpg)$")
+VOD_SEGMENT = re.compile(r"^seg_(\d+)\.ts$")
+
+REPORT_INTERVAL = 2
+
+
+def bind_shared_socket(host: str, port: int, probe: bool = True) -> socket.socket:
+    """
+    Binds a listening socket other processes of this user can bind as well
+    (SO_REUSEPORT); the kernel spreads incoming connections across them.
+    """
+    family, _, _, _, address = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)[0]
+    if probe:
+        # A port another proxy shares with its workers would accept our
+        # SO_REUSEPORT bind too; a plain bind tells us it is taken
+        with socket.socket(family, socket.SOCK_STREAM) as probe_sock:
+            probe_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            probe_sock.bind(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(address)
+        sock.listen(128)
+        sock.setblocking(False)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def reuse_port_supported() -> bool:
+    return hasattr(socket, "SO_REUSEPORT") and sys.platform != "win32"
+
+
+def run_event_loop(main: Coroutine, use_uvloop: bool = False):
+    """asyncio.run, on uvloop when asked for and installed."""
+    if use_uvloop:
+        try:
+            import uvloop
+        except ImportError:
+            print("Warning: uvloop is not installed, using the default event loop")
+        else:
+            return uvloop.run(main)
+    return asyncio.run(main)
+
+
+class ServeWorkers:
+    """
+    Extra processes serving a session's HLS directory on the same port.
+
+    The proxy process stays the owner: it runs ffmpeg, the relay and the
+    idle timer, and answers everything that needs that state on a private
+    loopback port. Workers serve finished files from disk themselves and
+    forward the rest there.
+    """
+
+    def __init__(self, count: int, hls_dir: Path, use_uvloop: bool = False):
+        self.count = count
+        self.hls_dir = hls_dir
+        self.use_uvloop = use_uvloop
+        self.owner_port: int | None = None
+        self.procs: List[asyncio.subprocess.Process] = []
+        self.reports: dict[int, dict] = {}
+
+    async def start(self, runner: web.AppRunner, host: str, port: int) -> None:
+        # The owner's private entrance, so forwarded requests can't land on a worker again
+        owner_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        owner_sock.bind(("127.0.0.1", 0))
+        owner_sock.listen(128)
+        owner_sock.setblocking(False)
+        self.owner_port = owner_sock.getsockname()[1]
+        await web.SockSite(runner, owner_sock).start()
+
+        for worker_id in range(1, self.count):
+            cmd = [
+                sys.executable, str(Path(__file__).resolve()),
+                "--hls-dir", str(self.hls_dir),
+                "--host", host,
+                "--port", str(port),
+                "--owner-port", str(self.owner_port),
+                "--worker-id", str(worker_id),
+            ]
+            if self.use_uvloop:
+                cmd.append("--uvloop")
+            self.procs.append(await asyncio.create_subprocess_exec(*cmd))
+        print(f"Serving with {self.count} processes on port {port} (SO_REUSEPORT)")
+
+    def report(self, data: dict) -> None:
+        self.reports[int(data.get("worker", 0))] = {**data, "received": time.time()}
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "processes": self.count,
+            "alive": 1 + sum(1 for proc in self.procs if proc.returncode is None),
+            "workers": list(self.reports.values()),
+        }
+
+    async def stop(self) -> None:
+        for proc in self.procs:
+            if proc.returncode is None:
+                proc.terminate()
+        for proc in self.procs:
+            try:
+                await asyncio.wait_for(proc.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+
+
+def create_worker_app(hls_dir: Path, owner_port: int, counters: dict) -> web.Application:
+    # Imported here: stream_proxy imports this module for ServeWorkers
+    from stream_proxy import read_media_playlist
+
+    owner = f"http://127.0.0.1:{owner_port}"
+    # Segment index -> file of the VOD job that finished it first
+    vod_ready: dict[int, str] = {}
+    client: aiohttp.ClientSession | None = None
+
+    def refresh_vod_ready() -> None:
+        # Oldest job first, matching which file the owner serves
+        for job_playlist in sorted(hls_dir.glob("job_*.m3u8")):
+            _, segments, _ = read_media_playlist(job_playlist)
+            for line in segments:
+                if not line.startswith("#"):
+                    vod_ready.setdefault(int(Path(line).stem.rsplit("_", 1)[1]), line)
+
+    async def forward(request: web.Request) -> web.StreamResponse:
+        nonlocal client
+        if client is None:
+            client = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=5),
+                auto_decompress=False,
+            )
+        if request.path.startswith("/workers/"):
+            # Owner-only: forwarded, a viewer's request would arrive from loopback
+            raise web.HTTPNotFound()
+        counters["forwarded"] += 1
+        headers = {k: v for k, v in request.headers.items() if k.lower() not in SKIP_HEADERS and k.lower() != "x-forwarded-for"}
+        # The owner sees this worker's loopback address: pass on who the viewer is
+        headers["X-Forwarded-For"] = EgressScheduler.client_id(request)
+        body = await request.read() if request.can_read_body else None
+        try:
+            async with client.request(request.method, owner + request.path_qs, headers=headers, data=body, allow_redirects=False) as upstream:
+                response = web.StreamResponse(
+                    status=upstream.status,
+                    headers={k: v for k, v in upstream.headers.items() if k.lower() not in SKIP_HEADERS},
+                )
+                if upstream.content_length is not None:
+                    response.content_length = upstream.content_length
+                await response.prepare(request)
+                async for chunk in upstream.content.iter_chunked(256 * 1024):
+                    await response.write(chunk)
+                await response.write_eof()
+                return response
+        except aiohttp.ClientError:
+            raise web.HTTPBadGateway(text="Session owner is not reachable")
+
+    async def hls_file(request: web.Request) -> web.StreamResponse:
+        name = request.match_info["name"]
+        if name.startswith(".") or OWNER_FILES.match(name):
+            return await forward(request)
+        match = VOD_SEGMENT.match(name)
+        if match:
+            index = int(match.group(1))
+            if index not in vod_ready:
+                refresh_vod_ready()
+            # Not encoded yet: the owner decides whether to wait or seek
+            if index not in vod_ready:
+                return await forward(request)
+            name = vod_ready[index]
+        path = hls_dir / name
+        if not path.is_file():
+            return await forward(request)
+        counters["served"] += 1
+        return web.FileResponse(path)
+
+    @web.middleware
+    async def cors_middleware(request, handler):
+        counters["requests"] += 1
+        response = await handler(request)
+        if response.prepared:
+            # Forwarded: already sent with the owner's CORS headers
+            return response
+        response.headers['Access-Control-Allow-Origin'] = '*'
+        response.headers['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
+        response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Range'
+        response.headers['Access-Control-Expose-Headers'] = 'Content-Length, Content-Range, Accept-Ranges'
+        return response
+
+    async def close_client(_: web.Application) -> None:
+        if client is not None:
+            await client.close()
+
+    app = web.Application(middlewares=[cors_middleware])
+    app.router.add_get("/hls/{name}", hls_file)
+    app.router.add_route("*", "/{tail:.*}", forward)
+    app.on_cleanup.append(close_client)
+    return app
+
+
+async def run_worker(args: argparse.Namespace) -> None:
+    parent = os.getppid()
+    counters = {"requests": 0, "served": 0, "forwarded": 0}
+    app = create_worker_app(args.hls_dir, args.owner_port, counters)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.SockSite(runner, bind_shared_socket(args.host, args.port, probe=False)).start()
+
+    reported = -1
+    try:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=5)) as client:
+            # Orphaned when the owner is killed outright: exit with it
+            while os.getppid() == parent:
+                if counters["requests"] != reported:
+                    # Viewers served here keep the owner's idle timer from firing
+                    try:
+                        async with client.post(
+                            f"http://127.0.0.1:{args.owner_port}/workers/activity",
+                            json={"worker": args.worker_id, "pid": os.getpid(), **counters},
+                        ):
+                            pass
+                        reported = counters["requests"]
+                    except (aiohttp.ClientError, asyncio.TimeoutError):
+                        pass
+                await asyncio.sleep(REPORT_INTERVAL)
+    finally:
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extra HLS serving process for a stream_proxy session")
+    parser.add_argument("--hls-dir", type=Path, required=True)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, required=True)
+    parser.add_argument("--owner-port", type=int, required=True)
+    parser.add_argument("--worker-id", type=int, default=1)
+    parser.add_argument("--uvloop", action="store_true")
+    args = parser.parse_args()
+    try:
+        run_event_loop(run_worker(args), args.uvloop)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from relay import parse_range
+from zip_helper import RemoteFile
+
+HELPER = Path(__file__).with_name("zip_helper.py")
+VIDEO_NAME = "movie.mkv"
+# Small companions a release archive usually carries next to the video
+EXTRAS = {"movie.srt": b"1\n00:00:01,000 --> 00:00:02,000\nHello\n" * 200, "release.nfo": b"x" * 4096}
+
+
+class RangeServer(ThreadingHTTPServer):
+    """
+    Stand-in for a CDN: serves a directory with Range support, ETag and
+    Last-Modified, adds a fixed latency before every response and counts
+    what the client asked for.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, root: Path, latency: float):
+        super().__init__(("127.0.0.1", 0), RangeHandler)
+        self.root = root
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.counters = {"requests": 0, "connections": 0, "bytes": 0}
+
+    def count(self, **deltas: int) -> None:
+        with self.lock:
+            for key, value in deltas.items():
+                self.counters[key] += value
+
+    def handle_error(self, request, client_address):
+        # Readers close keep-alive connections whenever they are done with them
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def url(self, name: str) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/{name}"
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.count(connections=1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.respond(send_body=False)
+
+    def do_GET(self):
+        self.respond(send_body=True)
+
+    def respond(self, send_body: bool) -> None:
+        self.server.count(requests=1)
+        time.sleep(self.server.latency)
+        path = self.server.root / self.path.lstrip("/").split("?")[0]
+        if not path.is_file():
+            self.send_error(404)
+            return
+        stat = path.stat()
+        size = stat.st_size
+        start, end, status = 0, size - 1, 200
+        if "Range" in self.headers:
+            parsed = parse_range(self.headers["Range"], size)
+            if parsed is None:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            (start, end), status = parsed, 206
+        self.send_response(status)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("ETag", f'"{stat.st_mtime_ns:x}-{size:x}"')
+        self.send_header("Last-Modified", formatdate(stat.st_mtime, usegmt=True))
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        if not send_body:
+            return
+        with path.open("rb") as source:
+            source.seek(start)
+            remaining = end - start + 1
+            try:
+                while remaining > 0:
+                    block = source.read(min(256 * 1024, remaining))
+                    self.wfile.write(block)
+                    self.server.count(bytes=len(block))
+                    remaining -= len(block)
+            except (BrokenPipeError, ConnectionResetError):
+                # The reader got what it needed and hung up
+                self.close_connection = True
+
+
+def build_archives(directory: Path, size: int, zip64_entries: int) -> dict[str, Path]:
+    """STORED, DEFLATE and Zip64 archives, each with a video entry of about size bytes."""
+    megabyte = 1024 * 1024
+    archives = {}
+
+    stored = directory / f"stored_{size // megabyte}m.zip"
+    with zipfile.ZipFile(stored, "w", zipfile.ZIP_STORED) as archive:
+        # Encoded video doesn't compress, which is why release archives store it
+        with archive.open(VIDEO_NAME, "w") as entry:
+            for offset in range(0, size, megabyte):
+                entry.write(os.urandom(min(megabyte, size - offset)))
+        for name, data in EXTRAS.items():
+            archive.writestr(name, data)
+    archives["stored"] = stored
+
+    deflated = directory / f"deflate_{size // megabyte}m.zip"
+    with zipfile.ZipFile(deflated, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as archive:
+        with archive.open(VIDEO_NAME, "w") as entry:
+            # Half random, half repeated: decompression does real work and the ratio is near 2
+            for offset in range(0, size, megabyte):
+                length = min(megabyte, size - offset)
+                entry.write((os.urandom(length // 2) + b"\0" * length)[:length])
+        for name, data in EXTRAS.items():
+            archive.writestr(name, data)
+    archives["deflate"] = deflated
+
+    zip64 = directory / f"zip64_{size // megabyte}m_{zip64_entries}.zip"
+    with zipfile.ZipFile(zip64, "w", zipfile.ZIP_STORED) as archive:
+        # More entries than the classic EOCD can count, and a directory bigger than one tail read
+        for number in range(zip64_entries):
+            archive.writestr(f"frames/{number:06d}.txt", b"")
+        with archive.open(VIDEO_NAME, "w", force_zip64=True) as entry:
+            for offset in range(0, size, megabyte):
+                entry.write(os.urandom(min(megabyte, size - offset)))
+    archives["zip64"] = zip64
+    return archives
+
+
+def run_helper(server: RangeServer, args: list[str]) -> tuple[float, int, dict]:
+    """Runs zip_helper.py as the proxy does; returns (seconds, stdout bytes, server counters)."""
+    server.reset()
+    started = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, str(HELPER), *args], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output = 0
+    while chunk := proc.stdout.read(1024 * 1024):
+        output += len(chunk)
+    _, stderr = proc.communicate()
+    elapsed = time.perf_counter() - started
+    if proc.returncode != 0:
+        raise RuntimeError(f"zip_helper {' '.join(args[2:4])} failed: {stderr.decode(errors='ignore').strip()}")
+    return elapsed, output, dict(server.counters)
+
+
+def run_zipfile(server: RangeServer, url: str, read_entry: bool) -> tuple[float, int, dict]:
+    """The old path: zipfile on top of RemoteFile, one request per read."""
+    server.reset()
+    started = time.perf_counter()
+    output = 0
+    with zipfile.ZipFile(RemoteFile(url)) as archive:
+        archive.namelist()
+        if read_entry:
+            with archive.open(VIDEO_NAME) as source:
+                while chunk := source.read(64 * 1024):
+                    output += len(chunk)
+    return time.perf_counter() - started, output, dict(server.counters)
+
+
+def measure(server: RangeServer, archive: Path, cache_dir: Path, baseline: bool) -> list[dict]:
+    url = server.url(archive.name)
+    with zipfile.ZipFile(archive) as local:
+        info = local.getinfo(VIDEO_NAME)
+        infos = local.infolist()
+    archive_size = archive.stat().st_size
+    # What an ideal reader fetches: the directory records for a listing, the entry for a stream
+    directory_bytes = sum(46 + len(i.filename.encode()) + len(i.extra) + len(i.comment) for i in infos) + 22
+    entry_bytes = info.compress_size
+
+    index_cache = cache_dir / archive.stem
+    helper = ["--cache-dir", str(index_cache)]
+
+    def helper_list():
+        return run_helper(server, [*helper, "list", "--url", url])
+
+    def helper_stream():
+        return run_helper(server, [*helper, "stream", "--url", url, "--file", VIDEO_NAME])
+
+    def helper_stream_cold():
+        for cached in index_cache.glob("*.zipindex.json"):
+            cached.unlink()
+        return helper_stream()
+
+    cases = [
+        ("list (cold)", helper_list, directory_bytes),
+        ("list (cached index)", helper_list, 0),
+        ("stream (cold)", helper_stream_cold, directory_bytes + entry_bytes),
+        ("stream (cached index)", helper_stream, entry_bytes),
+    ]
+    if baseline:
+        cases.append(("zipfile list", lambda: run_zipfile(server, url, False), directory_bytes))
+        cases.append(("zipfile stream", lambda: run_zipfile(server, url, True), directory_bytes + entry_bytes))
+
+    results = []
+    for label, run, needed in cases:
+        elapsed, output, counters = run()
+        results.append({
+            "archive": archive.name,
+            "archive_bytes": archive_size,
+            "operation": label,
+            "seconds": round(elapsed, 3),
+            "requests": counters["requests"],
+            "connections": counters["connections"],
+            "upstream_bytes": counters["bytes"],
+            "needed_bytes": needed,
+            "amplification": round(counters["bytes"] / needed, 2) if needed else None,
+            "output_bytes": output,
+            "throughput_mbps": round(output * 8 / elapsed / 1e6, 1) if output > 1024 * 1024 else None,
+        })
+    return results
+
+
+def print_table(results: list[dict]) -> None:
+    columns = [
+        ("archive", 24), ("operation", 22), ("requests", 8), ("connections", 11),
+        ("upstream_bytes", 14), ("amplification", 13), ("seconds", 8), ("throughput_mbps", 15),
+    ]
+    print("  ".join(name.ljust(width) for name, width in columns))
+    for result in results:
+        print("  ".join(str(result[name] if result[name] is not None else "-").ljust(width) for name, width in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure upstream requests and bytes of zip_helper list/stream on local archives")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[8, 64], help="Video entry sizes to build, in MiB")
+    parser.add_argument("--latency-ms", type=float, default=40, help="Delay the stand-in server adds before every response")
+    parser.add_argument("--zip64-entries", type=int, default=70000, help="Entries in the Zip64 archive (over 65535 forces Zip64 records)")
+    parser.add_argument("--kinds", nargs="+", choices=["stored", "deflate", "zip64"], default=["stored", "deflate", "zip64"])
+    parser.add_argument("--baseline", action="store_true", help="Also time plain zipfile over RemoteFile (one request per read; slow)")
+    parser.add_argument("--work-dir", type=Path, help="Keep archives here instead of a temporary directory")
+    parser.add_argument("--json", type=Path, help="Also write the results to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="zip_bench_") as temp:
+        work_dir = args.work_dir or Path(temp)
+        work_dir.mkdir(parents=True, exist_ok=True)
+        archives = []
+        for size in args.sizes:
+            print(f"Building {size} MiB archives in {work_dir}...")
+            built = build_archives(work_dir, size * 1024 * 1024, args.zip64_entries)
+            archives.extend(built[kind] for kind in args.kinds)
+
+        server = RangeServer(work_dir, args.latency_ms / 1000)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f"Serving on {server.url('')} with {args.latency_ms:g} ms latency per response\n")
+        results = []
+        try:
+            for archive in archives:
+                results.extend(measure(server, archive, Path(temp) / "index_cache", args.baseline))
+        finally:
+            server.shutdown()
+
+    print_table(results)
+    if args.json:
+        args.json.write_text(json.dumps({"latency_ms": args.latency_ms, "results": results}, indent=2))
+        print(f"\nSaved results to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
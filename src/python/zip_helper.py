@@ -1,10 +1,39 @@
 import argparse
+import bz2
 import json
+import struct
 import sys
 import zipfile
+import zlib
 import io
+from pathlib import Path
+
 import requests
 
+from keyframes import CACHE_DIR, cache_key, load_cached, store_cached
+
+# One suffix range covers the EOCD with the longest possible comment, the
+# Zip64 records and, for archives of a few video files, the whole central directory
+TAIL_BYTES = 256 * 1024
+
+EOCD_SIG = b"PK\x05\x06"
+EOCD_SIZE = 22
+ZIP64_LOCATOR_SIG = b"PK\x06\x07"
+ZIP64_LOCATOR_SIZE = 20
+ZIP64_EOCD_SIG = b"PK\x06\x06"
+CENTRAL_SIG = b"PK\x01\x02"
+CENTRAL_HEADER = struct.Struct("<4s6H3I5H2I")
+LOCAL_SIG = b"PK\x03\x04"
+LOCAL_HEADER = struct.Struct("<4s5H3I2H")
+ZIP64_EXTRA_ID = 0x0001
+
+STORED = 0
+DEFLATED = 8
+BZIP2 = 12
+
+VIDEO_EXTENSIONS = ('.mkv', '.mp4', '.avi', '.mov', '.flv', '.wmv')
+
+
 class RemoteFile:
     def __init__(self, url):
         self.url = url
@@ -54,36 +83,293 @@ class RemoteFile:
     def close(self):
         pass
 
-def list_files(url):
+
+def validator(response: requests.Response, total: int) -> dict:
+    """What identifies this version of the archive: its size plus any ETag/Last-Modified."""
+    return {
+        "size": total,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+    }
+
+
+def response_total(response: requests.Response) -> int:
+    content_range = response.headers.get("Content-Range", "")
+    total = content_range.rpartition("/")[2]
+    if response.status_code == 206 and total.isdigit():
+        return int(total)
+    # Range ignored: the body is the whole archive
+    return int(response.headers.get("Content-Length") or len(response.content))
+
+
+def fetch_tail(session: requests.Session, url: str, length: int) -> tuple[bytes, int, dict]:
+    """Returns (last bytes of the archive, archive size, validator) from one suffix range request."""
+    response = session.get(url, headers={"Range": f"bytes=-{length}"}, timeout=30)
+    if response.status_code not in (200, 206):
+        raise OSError(f"HTTP {response.status_code}")
+    total = response_total(response)
+    data = response.content
+    if response.status_code == 200:
+        data = data[-length:]
+    return data, total, validator(response, total)
+
+
+def fetch_range(session: requests.Session, url: str, start: int, length: int) -> bytes:
+    response = session.get(url, headers={"Range": f"bytes={start}-{start + length - 1}"}, timeout=30)
+    if response.status_code not in (200, 206):
+        raise OSError(f"HTTP {response.status_code}")
+    return response.content if response.status_code == 206 else response.content[start:start + length]
+
+
+def parse_zip64_extra(extra: bytes, size: int, compressed_size: int, offset: int) -> tuple[int, int, int]:
+    """Replaces the 0xFFFFFFFF placeholders with the values from the Zip64 extra field."""
+    pos = 0
+    while pos + 4 <= len(extra):
+        header_id, length = struct.unpack_from("<2H", extra, pos)
+        if header_id == ZIP64_EXTRA_ID:
+            field = extra[pos + 4:pos + 4 + length]
+            values = [struct.unpack_from("<Q", field, i)[0] for i in range(0, len(field) - 7, 8)]
+            # Only the fields that overflowed are present, in this order
+            if size == 0xFFFFFFFF and values:
+                size = values.pop(0)
+            if compressed_size == 0xFFFFFFFF and values:
+                compressed_size = values.pop(0)
+            if offset == 0xFFFFFFFF and values:
+                offset = values.pop(0)
+            break
+        pos += 4 + length
+    return size, compressed_size, offset
+
+
+def parse_central_directory(data: bytes, count: int) -> list[dict]:
+    entries = []
+    pos = 0
+    for _ in range(count):
+        if data[pos:pos + 4] != CENTRAL_SIG:
+            raise zipfile.BadZipFile("Bad central directory entry")
+        (
+            _, _, _, flags, method, _, _, crc, compressed_size, size,
+            name_length, extra_length, comment_length, _, _, _, offset,
+        ) = CENTRAL_HEADER.unpack_from(data, pos)
+        pos += CENTRAL_HEADER.size
+        raw_name = data[pos:pos + name_length]
+        extra = data[pos + name_length:pos + name_length + extra_length]
+        pos += name_length + extra_length + comment_length
+        size, compressed_size, offset = parse_zip64_extra(extra, size, compressed_size, offset)
+        entries.append({
+            # Bit 11: the name is UTF-8, otherwise the legacy DOS code page
+            "name": raw_name.decode("utf-8" if flags & 0x800 else "cp437"),
+            "method": method,
+            "flags": flags,
+            "crc": crc,
+            "compressed_size": compressed_size,
+            "size": size,
+            "offset": offset,
+        })
+    return entries
+
+
+def read_index(url: str, session: requests.Session | None = None) -> dict:
+    """
+    Reads the central directory of a remote archive: one suffix range
+    request, plus one more only when the directory doesn't fit in the tail.
+    """
+    session = session or requests.Session()
+    tail, total, version = fetch_tail(session, url, TAIL_BYTES)
+    tail_start = total - len(tail)
+
+    def ends_archive(pos: int) -> bool:
+        # File data and comments may contain the signature; the real record's comment ends the file
+        return pos + EOCD_SIZE <= len(tail) and pos + EOCD_SIZE + struct.unpack_from("<H", tail, pos + 20)[0] == len(tail)
+
+    eocd = tail.rfind(EOCD_SIG)
+    while eocd >= 0 and not ends_archive(eocd):
+        eocd = tail.rfind(EOCD_SIG, 0, eocd)
+    if eocd < 0:
+        raise zipfile.BadZipFile("End of central directory not found")
+    _, _, _, _, count, cd_size, cd_offset, _ = struct.unpack_from("<4s4H2IH", tail, eocd)
+
+    if count == 0xFFFF or cd_size == 0xFFFFFFFF or cd_offset == 0xFFFFFFFF:
+        locator = eocd - ZIP64_LOCATOR_SIZE
+        if locator < 0 or tail[locator:locator + 4] != ZIP64_LOCATOR_SIG:
+            raise zipfile.BadZipFile("Zip64 locator not found")
+        zip64_offset = struct.unpack_from("<Q", tail, locator + 8)[0]
+        record = tail[zip64_offset - tail_start:] if zip64_offset >= tail_start else fetch_range(session, url, zip64_offset, 56)
+        if record[:4] != ZIP64_EOCD_SIG:
+            raise zipfile.BadZipFile("Bad Zip64 end of central directory")
+        count, cd_size, cd_offset = struct.unpack_from("<3Q", record, 32)
+
+    if cd_offset >= tail_start:
+        directory = tail[cd_offset - tail_start:cd_offset - tail_start + cd_size]
+    else:
+        directory = fetch_range(session, url, cd_offset, cd_size)
+    return {"validator": version, "entries": parse_central_directory(directory, count)}
+
+
+def still_current(session: requests.Session, url: str, version: dict) -> bool:
+    """Whether the archive is still the version an index was read from, by a 1-byte range request."""
+    with session.get(url, headers={"Range": "bytes=0-0"}, stream=True, timeout=30) as response:
+        if response.status_code not in (200, 206):
+            raise OSError(f"HTTP {response.status_code}")
+        if response.status_code == 200 and not response.headers.get("Content-Length"):
+            # Range ignored and no size to compare without reading the whole archive
+            return False
+        if response.status_code == 206:
+            # Read the byte so the connection can be reused for a re-read
+            response.content
+        return same_version(version, response)
+
+
+def load_index(
+    url: str,
+    cache_dir: Path = CACHE_DIR,
+    session: requests.Session | None = None,
+    refresh: bool = False,
+    revalidate: bool = False,
+) -> dict:
+    """
+    The archive's index from the persistent cache, or read and cached. With
+    revalidate, a cached index is first checked against the archive's
+    size/ETag/Last-Modified; callers that check the version themselves
+    (streaming an entry does) skip that request.
+    """
+    key = cache_key(url)
+    index = None if refresh else load_cached(cache_dir, key, "zipindex")
+    if index is not None and revalidate:
+        session = session or requests.Session()
+        if not still_current(session, url, index["validator"]):
+            print("Archive changed since it was indexed, re-reading the index", file=sys.stderr)
+            index = None
+    if index is None:
+        index = read_index(url, session)
+        store_cached(cache_dir, key, "zipindex", index)
+    return index
+
+
+def list_files(url, cache_dir: Path = CACHE_DIR):
     try:
-        remote_file = RemoteFile(url)
-        with zipfile.ZipFile(remote_file) as zf:
-            file_list = zf.namelist()
-            # Filter for video files
-            video_extensions = ('.mkv', '.mp4', '.avi', '.mov', '.flv', '.wmv')
-            video_files = [f for f in file_list if f.lower().endswith(video_extensions)]
-            print(json.dumps(video_files))
+        index = load_index(url, cache_dir, revalidate=True)
+        # Filter for video files
+        video_files = [entry["name"] for entry in index["entries"] if entry["name"].lower().endswith(VIDEO_EXTENSIONS)]
+        print(json.dumps(video_files))
     except Exception as e:
         print(json.dumps({"error": str(e)}))
         sys.exit(1)
 
-def stream_file(url, filename):
+
+def same_version(cached: dict, response: requests.Response) -> bool:
+    current = validator(response, response_total(response))
+    return all(cached.get(field) == current[field] for field in ("size", "etag", "last_modified") if current[field] is not None)
+
+
+def read_exact(raw, length: int) -> bytes:
+    data = b""
+    while len(data) < length:
+        chunk = raw.read(length - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def iter_entry(session: requests.Session, url: str, entry: dict, version: dict, chunk_size: int = 64 * 1024):
+    """
+    Yields the uncompressed bytes of one entry from a single ranged GET
+    starting at its local header. Raises LookupError if the archive changed
+    since it was indexed.
+    """
+    # The local extra field can differ from the central one; allow for the largest
+    end = min(entry["offset"] + LOCAL_HEADER.size + 2 * 0xFFFF + entry["compressed_size"], version["size"]) - 1
+    with session.get(url, headers={"Range": f"bytes={entry['offset']}-{end}"}, stream=True, timeout=30) as response:
+        if response.status_code == 416:
+            raise LookupError("Archive shrank since it was indexed")
+        if response.status_code != 206:
+            raise OSError(f"HTTP {response.status_code}: the server must support Range requests")
+        if not same_version(version, response):
+            raise LookupError("Archive changed since it was indexed")
+        raw = response.raw
+        header = read_exact(raw, LOCAL_HEADER.size)
+        if len(header) < LOCAL_HEADER.size or header[:4] != LOCAL_SIG:
+            raise LookupError("Local header not where the index says")
+        name_length, extra_length = LOCAL_HEADER.unpack(header)[-2:]
+        read_exact(raw, name_length + extra_length)
+
+        if entry["method"] == STORED:
+            decompressor = None
+        elif entry["method"] == DEFLATED:
+            decompressor = zlib.decompressobj(-15)
+        else:
+            decompressor = bz2.BZ2Decompressor()
+        crc = 0
+        remaining = entry["compressed_size"]
+        while remaining > 0:
+            chunk = raw.read(min(chunk_size, remaining))
+            if not chunk:
+                raise OSError("Connection closed before the end of the entry")
+            remaining -= len(chunk)
+            data = chunk if decompressor is None else decompressor.decompress(chunk)
+            if data:
+                crc = zlib.crc32(data, crc)
+                yield data
+        if decompressor is not None and hasattr(decompressor, "flush"):
+            data = decompressor.flush()
+            if data:
+                crc = zlib.crc32(data, crc)
+                yield data
+        if crc != entry["crc"]:
+            raise zipfile.BadZipFile(f"CRC mismatch for {entry['name']}")
+
+
+def stream_zipfile(url, filename):
+    # Methods we don't decode ourselves (LZMA, ...) go through zipfile
+    remote_file = RemoteFile(url)
+    with zipfile.ZipFile(remote_file) as zf:
+        with zf.open(filename) as source:
+            while True:
+                chunk = source.read(64 * 1024)
+                if not chunk:
+                    break
+                sys.stdout.buffer.write(chunk)
+                sys.stdout.buffer.flush()
+
+
+def stream_file(url, filename, cache_dir: Path = CACHE_DIR, index_url: str | None = None):
+    """
+    Streams one entry to stdout. index_url is the archive's public URL when
+    url is a local relay in front of it, so the cached index is shared.
+    """
+    session = requests.Session()
+    written = False
     try:
-        remote_file = RemoteFile(url)
-        with zipfile.ZipFile(remote_file) as zf:
-            with zf.open(filename) as source:
-                while True:
-                    chunk = source.read(64 * 1024)
-                    if not chunk:
-                        break
-                    sys.stdout.buffer.write(chunk)
-                    sys.stdout.buffer.flush()
+        for attempt in range(2):
+            index = load_index(index_url or url, cache_dir, session, refresh=attempt > 0)
+            entry = next((entry for entry in index["entries"] if entry["name"] == filename), None)
+            if entry is None:
+                raise KeyError(f"There is no item named {filename!r} in the archive")
+            if entry["flags"] & 0x1:
+                raise RuntimeError(f"{filename} is encrypted")
+            if entry["method"] not in (STORED, DEFLATED, BZIP2):
+                stream_zipfile(url, filename)
+                return
+            try:
+                for data in iter_entry(session, url, entry, index["validator"]):
+                    sys.stdout.buffer.write(data)
+                    written = True
+                sys.stdout.buffer.flush()
+                return
+            except LookupError as e:
+                # Stale index: re-read it once, unless bytes already went out
+                if written or attempt:
+                    raise
+                print(f"{e}, re-reading the archive index", file=sys.stderr)
     except Exception as e:
         print(f"Error streaming file: {e}", file=sys.stderr)
         sys.exit(1)
 
+
 def main():
     parser = argparse.ArgumentParser(description="Remote ZIP Helper")
+    parser.add_argument("--cache-dir", type=Path, default=CACHE_DIR, help="Where archive indexes are cached")
     subparsers = parser.add_subparsers(dest="command", required=True)
 
     list_parser = subparsers.add_parser("list", help="List files in remote ZIP")
@@ -92,13 +378,14 @@ def main():
     stream_parser = subparsers.add_parser("stream", help="Stream a file from remote ZIP")
     stream_parser.add_argument("--url", required=True, help="URL of the remote ZIP")
     stream_parser.add_argument("--file", required=True, help="Filename inside the ZIP to stream")
+    stream_parser.add_argument("--index-url", help="URL the archive index is cached under, when --url is a local relay")
 
     args = parser.parse_args()
 
     if args.command == "list":
-        list_files(args.url)
+        list_files(args.url, args.cache_dir)
     elif args.command == "stream":
-        stream_file(args.url, args.file)
+        stream_file(args.url, args.file, args.cache_dir, args.index_url)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,21 @@
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+# The proxy's modules import each other by bare name, as they do when run as scripts
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "python"))
+
+from zip_bench import RangeServer  # noqa: E402
+
+
+@pytest.fixture
+def range_server(tmp_path):
+    """Serves tmp_path with Range support and counts the requests made."""
+    server = RangeServer(tmp_path, latency=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,96 @@
+import keyframes
+from keyframes import KeyframeIndex, read_mkv_cues
+
+
+def element(element_id, body):
+    """An EBML element with an 8-byte size, as muxers that patch sizes later write them."""
+    return element_id.to_bytes((element_id.bit_length() + 7) // 8, "big") + (0x01 << 56 | len(body)).to_bytes(8, "big") + body
+
+
+def uint(element_id, value, width=None):
+    return element(element_id, value.to_bytes(width or max(1, (value.bit_length() + 7) // 8), "big"))
+
+
+def cue_point(time, track, position):
+    positions = uint(keyframes.CUE_TRACK, track) + uint(keyframes.CUE_CLUSTER_POSITION, position)
+    return element(keyframes.CUE_POINT, uint(keyframes.CUE_TIME, time) + element(keyframes.CUE_TRACK_POSITIONS, positions))
+
+
+def build_mkv(cue_points, cluster_bytes=1024, cues_first=False, timestamp_scale=1_000_000):
+    """
+    A Matroska file with a video track 1 and an audio track 2. The Cues go
+    after the cluster and are found through the SeekHead, or before it.
+    Returns (file bytes, offset of the segment body).
+    """
+    info = element(keyframes.INFO, uint(keyframes.TIMESTAMP_SCALE, timestamp_scale))
+    tracks = element(keyframes.TRACKS, b"".join(
+        element(keyframes.TRACK_ENTRY, uint(keyframes.TRACK_NUMBER, number) + uint(keyframes.TRACK_TYPE, track_type))
+        for number, track_type in ((1, 1), (2, 2))
+    ))
+    cluster = element(keyframes.CLUSTER, b"\0" * cluster_bytes)
+    cues = element(keyframes.CUES, b"".join(cue_point(*point) for point in cue_points))
+
+    def seek_head(cues_position):
+        seek = uint(keyframes.SEEK_ID, keyframes.CUES) + uint(keyframes.SEEK_POSITION, cues_position, width=8)
+        return element(keyframes.SEEK_HEAD, element(keyframes.SEEK, seek))
+
+    # The position is written on 8 bytes, so the SeekHead is as long whatever it points at
+    head_length = len(seek_head(0)) + len(info) + len(tracks)
+    if cues_first:
+        body = seek_head(head_length) + info + tracks + cues + cluster
+    else:
+        body = seek_head(head_length + len(cluster)) + info + tracks + cluster + cues
+    ebml = element(keyframes.EBML_HEADER, uint(0x4282, 0x6D6B76))
+    segment = element(keyframes.SEGMENT, body)
+    return ebml + segment, len(ebml) + len(segment) - len(body)
+
+
+POINTS = [(0, 1, 100), (0, 2, 100), (4000, 1, 200), (6500, 2, 250), (9000, 1, 300)]
+
+
+def test_cues_after_the_clusters_are_read_through_the_seek_head(tmp_path, range_server):
+    data, segment_start = build_mkv(POINTS, cluster_bytes=keyframes.MKV_HEAD_BYTES)
+    (tmp_path / "movie.mkv").write_bytes(data)
+    range_server.reset()
+    index = read_mkv_cues(range_server.url("movie.mkv"), {})
+    # Audio-only cue points don't count; offsets are absolute in the file
+    assert index.times == [0.0, 4.0, 9.0]
+    assert index.offsets == [segment_start + 100, segment_start + 200, segment_start + 300]
+    assert index.source == "cues"
+    # Head, Cues header, Cues body: nothing in between is read
+    assert range_server.counters["requests"] == 3
+    assert range_server.counters["bytes"] < keyframes.MKV_HEAD_BYTES + 1024
+
+
+def test_cues_inside_the_head_need_no_more_requests(tmp_path, range_server):
+    data, segment_start = build_mkv(POINTS, cues_first=True)
+    (tmp_path / "movie.mkv").write_bytes(data)
+    range_server.reset()
+    index = read_mkv_cues(range_server.url("movie.mkv"), {})
+    assert index.times == [0.0, 4.0, 9.0]
+    assert range_server.counters["requests"] == 1
+
+
+def test_timestamp_scale(tmp_path, range_server):
+    data, _ = build_mkv([(0, 1, 10), (400, 1, 20)], timestamp_scale=10_000_000)
+    (tmp_path / "movie.mkv").write_bytes(data)
+    assert read_mkv_cues(range_server.url("movie.mkv"), {}).times == [0.0, 4.0]
+
+
+def test_unusable_sources(tmp_path, range_server):
+    # Not Matroska
+    (tmp_path / "movie.mp4").write_bytes(b"\0\0\0\x18ftypisom" + b"\0" * 100)
+    assert read_mkv_cues(range_server.url("movie.mp4"), {}) is None
+    # A single video keyframe can't plan anything
+    data, _ = build_mkv([(0, 1, 100), (4000, 2, 200)])
+    (tmp_path / "one.mkv").write_bytes(data)
+    assert read_mkv_cues(range_server.url("one.mkv"), {}) is None
+
+
+def test_plan_segments_cuts_on_keyframes():
+    index = KeyframeIndex(times=[0.0, 2.0, 4.5, 6.0, 9.0, 12.5, 13.0], offsets=[None] * 7, source="cues")
+    plan = index.plan_segments(4, 14.0)
+    assert plan == [(0.0, 4.5), (4.5, 4.5), (9.0, 5.0)]
+    # The plan covers the source end to end, each segment starting where the last ended
+    assert sum(duration for _, duration in plan) == 14.0
+    assert all(start + duration == following for (start, duration), (following, _) in zip(plan, plan[1:]))
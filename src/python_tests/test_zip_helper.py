@@ -0,0 +1,121 @@
+import struct
+import zipfile
+
+import pytest
+
+import zip_helper
+from zip_helper import parse_zip64_extra, read_index
+
+
+def build_archive(path, entries, compression=zipfile.ZIP_STORED, comment=b""):
+    with zipfile.ZipFile(path, "w", compression) as archive:
+        for name, data in entries.items():
+            archive.writestr(name, data)
+        archive.comment = comment
+    return path
+
+
+def build_zip64_archive(path, entries, monkeypatch):
+    """
+    A small archive with the Zip64 EOCD, locator and extra fields, whose
+    classic EOCD holds the overflow placeholders of a really large one.
+    """
+    # Tiny limits make zipfile write the Zip64 records and extra fields
+    monkeypatch.setattr(zipfile, "ZIP64_LIMIT", 1024)
+    monkeypatch.setattr(zipfile, "ZIP_FILECOUNT_LIMIT", 2)
+    build_archive(path, entries)
+    monkeypatch.undo()
+    data = bytearray(path.read_bytes())
+    eocd = data.rfind(zip_helper.EOCD_SIG)
+    struct.pack_into("<2H2I", data, eocd + 8, 0xFFFF, 0xFFFF, 0xFFFFFFFF, 0xFFFFFFFF)
+    path.write_bytes(bytes(data))
+    return path
+
+
+def expected_entries(path):
+    with zipfile.ZipFile(path) as archive:
+        return [
+            {
+                "name": info.filename,
+                "method": info.compress_type,
+                "crc": info.CRC,
+                "compressed_size": info.compress_size,
+                "size": info.file_size,
+                "offset": info.header_offset,
+            }
+            for info in archive.infolist()
+        ]
+
+
+def indexed_entries(index):
+    return [{key: entry[key] for key in ("name", "method", "crc", "compressed_size", "size", "offset")} for entry in index["entries"]]
+
+
+def test_stored_and_deflated_entries_match_zipfile(tmp_path, range_server):
+    entries = {"movie.mkv": bytes(range(256)) * 64, "notes/readme.txt": b"hello " * 500, "ünïcode.srt": b"1\n"}
+    for name, compression in (("stored.zip", zipfile.ZIP_STORED), ("deflate.zip", zipfile.ZIP_DEFLATED)):
+        path = build_archive(tmp_path / name, entries, compression)
+        index = read_index(range_server.url(name))
+        assert indexed_entries(index) == expected_entries(path)
+        assert index["validator"]["size"] == path.stat().st_size
+
+
+def test_small_archive_is_indexed_with_one_request(tmp_path, range_server):
+    build_archive(tmp_path / "small.zip", {"movie.mkv": b"x" * 1000, "movie.srt": b"y" * 10})
+    range_server.reset()
+    read_index(range_server.url("small.zip"))
+    assert range_server.counters["requests"] == 1
+
+
+def test_signature_inside_comment_is_not_taken_for_the_end_record(tmp_path, range_server):
+    # A comment that looks like an empty EOCD must not hide the real one
+    # (zipfile itself falls for it, so the same archive without the comment is the reference)
+    fake_eocd = zip_helper.EOCD_SIG + b"\0" * 18
+    build_archive(tmp_path / "comment.zip", {"movie.mkv": b"x" * 100}, comment=b"release " + fake_eocd + b" info")
+    plain = build_archive(tmp_path / "plain.zip", {"movie.mkv": b"x" * 100})
+    index = read_index(range_server.url("comment.zip"))
+    assert indexed_entries(index) == expected_entries(plain)
+
+
+def test_directory_past_the_tail_costs_one_more_request(tmp_path, range_server, monkeypatch):
+    path = build_archive(tmp_path / "many.zip", {f"frames/{number:04d}.txt": b"" for number in range(200)})
+    monkeypatch.setattr(zip_helper, "TAIL_BYTES", 1024)
+    range_server.reset()
+    index = read_index(range_server.url("many.zip"))
+    assert range_server.counters["requests"] == 2
+    assert indexed_entries(index) == expected_entries(path)
+
+
+def test_zip64_records_and_extra_fields(tmp_path, range_server, monkeypatch):
+    entries = {"movie.mkv": b"v" * 4096, "a.txt": b"a" * 2000, "b.txt": b"b"}
+    path = build_zip64_archive(tmp_path / "zip64.zip", entries, monkeypatch)
+    index = read_index(range_server.url("zip64.zip"))
+    assert indexed_entries(index) == expected_entries(path)
+    assert [entry["size"] for entry in index["entries"]] == [4096, 2000, 1]
+
+
+def test_zip64_record_outside_the_tail_is_fetched(tmp_path, range_server, monkeypatch):
+    path = build_zip64_archive(tmp_path / "zip64.zip", {f"file{number}.txt": b"z" * 300 for number in range(5)}, monkeypatch)
+
+    # Only the EOCD and the locator fit in the tail
+    monkeypatch.setattr(zip_helper, "TAIL_BYTES", zip_helper.EOCD_SIZE + zip_helper.ZIP64_LOCATOR_SIZE)
+    range_server.reset()
+    index = read_index(range_server.url("zip64.zip"))
+    assert range_server.counters["requests"] == 3
+    assert indexed_entries(index) == expected_entries(path)
+
+
+def test_not_an_archive(tmp_path, range_server):
+    (tmp_path / "movie.mkv").write_bytes(b"\x1a\x45\xdf\xa3" + b"\0" * 5000)
+    with pytest.raises(zipfile.BadZipFile):
+        read_index(range_server.url("movie.mkv"))
+
+
+def test_zip64_extra_only_replaces_overflowed_fields():
+    extra = struct.pack("<2H2Q", zip_helper.ZIP64_EXTRA_ID, 16, 5_000_000_000, 6_000_000_000)
+    # Size stays put; the compressed size and offset come from the extra, in order
+    assert parse_zip64_extra(extra, 10, 0xFFFFFFFF, 0xFFFFFFFF) == (10, 5_000_000_000, 6_000_000_000)
+    # Other extra fields before the Zip64 one are skipped
+    other = struct.pack("<2H", 0x5455, 5) + b"\0" * 5
+    assert parse_zip64_extra(other + extra, 0xFFFFFFFF, 0xFFFFFFFF, 7) == (5_000_000_000, 6_000_000_000, 7)
+    assert parse_zip64_extra(b"", 1, 2, 3) == (1, 2, 3)